@@ -0,0 +1,256 @@
+#!/usr/bin/python3
+
+# --------------------------------------------------------------------------- #
+# End to end benchmark of a publish cycle.
+# Each cycle does what periodic does for one Classic: getModbusData reads and
+# decodes the registers, encodeClassicData_readings (and, every --info_every
+# cycles, mqttHA_autodiscovery and encodeClassicData_info) builds the payloads
+# and mqttPublish sends them. The Classics are simulated (see
+# simulator/classic_simulator.py) and the broker is a local stand-in, both
+# running on a thread of their own so the cycles have the main thread.
+#
+# Reported:
+#    cycle latency p50/p99 and per stage (read, encode, publish, discovery)
+#    allocations, the peak traced memory and what each cycle leaves allocated,
+#    from tracemalloc in a separate pass
+#    CPU per device cycle, from the CPU time of the main thread
+#    devices per core, how many Classics one core keeps up with at the
+#    publish rate given (default the awake rate of 5 seconds)
+#
+# Results go to a JSON file so runs of different versions can be compared.
+#
+# Run from code/Python:
+#    python3 benchmark/bench_cycle.py [--devices 4] [--cycles 500] [--output results.json]
+# --------------------------------------------------------------------------- #
+
+import os
+import sys
+import gc
+import json
+import time
+import asyncio
+import logging
+import platform
+import argparse
+import threading
+import subprocess
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from paho.mqtt import client as mqttclient
+
+import classic_mqtt
+from classic_mqtt import mqttPublish, mqttHA_autodiscovery, DEFAULT_WAKE_RATE
+from support.classic_device import ClassicDevice
+from support.classic_modbusdecoder import getModbusData
+from support.classic_jsonencoder import encodeClassicData_readings, encodeClassicData_info
+from simulator.classic_simulator import startSimulators, loadSnapshots, DEFAULT_EXPORT
+from benchmark.mqtt_broker import MqttBroker
+
+STAGES = ("read", "encode", "publish", "discovery")
+
+
+# --------------------------------------------------------------------------- #
+# The simulated Classics run on an event loop of their own
+# --------------------------------------------------------------------------- #
+def startClassics(count, basePort, **kwargs):
+    loop = asyncio.new_event_loop()
+    simulators = loop.run_until_complete(startSimulators(count, basePort, **kwargs))
+    thread = threading.Thread(target=loop.run_forever, name="classic_simulator", daemon=True)
+    thread.start()
+    return loop, simulators
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def summary(values):
+    return {
+        'p50_ms': round(percentile(values, 0.50) * 1000, 4) if values else None,
+        'p99_ms': round(percentile(values, 0.99) * 1000, 4) if values else None,
+        'mean_ms': round(sum(values) / len(values) * 1000, 4) if values else None,
+        'count': len(values),
+    }
+
+
+# --------------------------------------------------------------------------- #
+# The cycles run one after the other on the main thread, without the event
+# loop MqttPublisher needs. This stands in for it and hands each message
+# straight to paho, which is where the publish stage would hand it
+# --------------------------------------------------------------------------- #
+class DirectPublisher:
+
+    def __init__(self, client):
+        self.client = client
+
+    def submit(self, topic, payload, qos=0, retain=False, after=None, metrics=None, properties=None):
+        self.client.publish(topic, payload, qos=qos, retain=retain)
+        return None
+
+
+# --------------------------------------------------------------------------- #
+# One publish cycle for a Classic, as periodic does it. Returns the time spent
+# in each stage.
+# --------------------------------------------------------------------------- #
+def cycle(device, client, args, fullCycle):
+    stages = {}
+
+    start = time.perf_counter()
+    data = getModbusData(True, device.classicHost, device.classicPort, args.read_gap, device.connection, fullCycle)
+    stages['read'] = time.perf_counter() - start
+    if not data:
+        return None
+
+    if fullCycle:
+        start = time.perf_counter()
+        mqttHA_autodiscovery(device, data)
+        stages['discovery'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    readings = encodeClassicData_readings(data)
+    info = encodeClassicData_info(data) if fullCycle else None
+    stages['encode'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if info is not None:
+        mqttPublish(client, device, info, "info")
+    mqttPublish(client, device, readings, "readings")
+    stages['publish'] = time.perf_counter() - start
+
+    return stages
+
+
+def runCycles(devices, client, args, cycles, timings=None):
+    failures = 0
+    for number in range(cycles):
+        fullCycle = number == 0 or (args.info_every and number % args.info_every == 0)
+        for device in devices:
+            start = time.perf_counter()
+            stages = cycle(device, client, args, fullCycle)
+            elapsed = time.perf_counter() - start
+            if stages is None:
+                failures += 1
+            elif timings is not None:
+                timings['cycle'].append(elapsed)
+                for stage, seconds in stages.items():
+                    timings[stage].append(seconds)
+    return failures
+
+
+def gitVersion():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def run(argv):
+    parser = argparse.ArgumentParser(description="End to end publish cycle benchmark")
+    parser.add_argument("--devices", type=int, default=4, help="number of simulated Classics")
+    parser.add_argument("--cycles", type=int, default=500, help="timed cycles per Classic")
+    parser.add_argument("--warmup", type=int, default=20, help="untimed cycles per Classic before timing")
+    parser.add_argument("--alloc_cycles", type=int, default=100, help="cycles per Classic traced for allocations")
+    parser.add_argument("--info_every", type=int, default=60, help="re-read the static registers and publish info and discovery every this many cycles, 0 only on the first")
+    parser.add_argument("--read_gap", type=int, default=32, help="the --modbus_read_gap to read with")
+    parser.add_argument("--publish_rate", type=float, default=DEFAULT_WAKE_RATE, help="seconds between publishes of a Classic, for devices per core")
+    parser.add_argument("--latency", type=float, default=0.0, help="milliseconds the simulated Classics take to answer")
+    parser.add_argument("--modbus_port", type=int, default=5520, help="port of the first simulated Classic")
+    parser.add_argument("--mqtt_port", type=int, default=5883, help="port of the stand-in broker")
+    parser.add_argument("--output", default="benchmark_results.json", help="file to write the results to")
+    parser.add_argument("--loglevel", default="WARNING", help="log level of classic_mqtt while measuring")
+    args = parser.parse_args(argv)
+
+    logging.getLogger('classic_mqtt').setLevel(args.loglevel)
+
+    loop, simulators = startClassics(args.devices, args.modbus_port, snapshots=loadSnapshots(DEFAULT_EXPORT),
+                                     latency=args.latency / 1000.0, maxConnections=2)
+    broker = MqttBroker(port=args.mqtt_port).start()
+
+    client = mqttclient.Client(mqttclient.CallbackAPIVersion.VERSION1, "bench_cycle")
+    client.connect("127.0.0.1", args.mqtt_port)
+    client.loop_start()
+    classic_mqtt.mqttClient = client
+    classic_mqtt.mqttPublisher = DirectPublisher(client)
+    classic_mqtt.homeassistantEnabled = True
+
+    devices = [ClassicDevice("127.0.0.1", args.modbus_port + unit, "classic{}".format(unit),
+                             DEFAULT_WAKE_RATE, 300, 60) for unit in range(args.devices)]
+
+    try:
+        runCycles(devices, client, args, args.warmup)
+
+        # Timing pass
+        timings = {name: [] for name in ("cycle",) + STAGES}
+        gc.collect()
+        wallStart = time.perf_counter()
+        cpuStart = time.thread_time()
+        failures = runCycles(devices, client, args, args.cycles, timings)
+        cpu = time.thread_time() - cpuStart
+        wall = time.perf_counter() - wallStart
+
+        # Allocation pass, tracemalloc slows everything down so it is not timed
+        gc.collect()
+        tracemalloc.start()
+        blocksStart = sys.getallocatedblocks()
+        tracemalloc.reset_peak()
+        allocStart, _ = tracemalloc.get_traced_memory()
+        runCycles(devices, client, args, args.alloc_cycles)
+        allocEnd, allocPeak = tracemalloc.get_traced_memory()
+        blocksEnd = sys.getallocatedblocks()
+        tracemalloc.stop()
+    finally:
+        client.loop_stop()
+        client.disconnect()
+        for device in devices:
+            device.connection.close()
+        for simulator in simulators:
+            asyncio.run_coroutine_threadsafe(simulator.stop(), loop).result(5)
+        loop.call_soon_threadsafe(loop.stop)
+        broker.stop()
+
+    deviceCycles = args.cycles * args.devices - failures
+    allocCycles = args.alloc_cycles * args.devices
+    cpuPerCycle = cpu / deviceCycles if deviceCycles else None
+    results = {
+        'benchmark': 'bench_cycle',
+        'version': gitVersion(),
+        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': vars(args),
+        'device_cycles': deviceCycles,
+        'failed_cycles': failures,
+        'cycle': summary(timings['cycle']),
+        'stages': {stage: summary(timings[stage]) for stage in STAGES},
+        'cycles_per_second': round(deviceCycles / wall, 2) if wall else None,
+        'cpu_per_device_cycle_ms': round(cpuPerCycle * 1000, 4) if cpuPerCycle else None,
+        'cpu_per_device_percent': round(cpuPerCycle / args.publish_rate * 100, 4) if cpuPerCycle else None,
+        'max_devices_per_core': int(args.publish_rate / cpuPerCycle) if cpuPerCycle else None,
+        'alloc_peak_kib': round(allocPeak / 1024, 2),
+        'alloc_retained_bytes_per_cycle': round((allocEnd - allocStart) / allocCycles, 1),
+        'alloc_retained_blocks_per_cycle': round((blocksEnd - blocksStart) / allocCycles, 2),
+        'mqtt_messages': broker.messageCount,
+        'mqtt_payload_bytes': broker.byteCount,
+        'modbus_requests': sum(simulator.requests for simulator in simulators),
+    }
+
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent=2)
+
+    print("cycle          p50 {p50_ms} ms  p99 {p99_ms} ms".format(**results['cycle']))
+    for stage in STAGES:
+        print("  {:12} p50 {p50_ms} ms  p99 {p99_ms} ms".format(stage, **results['stages'][stage]))
+    print("cpu per device cycle   {} ms ({}% of a core per Classic)".format(results['cpu_per_device_cycle_ms'], results['cpu_per_device_percent']))
+    print("max devices per core   {} at one publish every {}s".format(results['max_devices_per_core'], args.publish_rate))
+    print("allocations            peak {} KiB, retained {} bytes per cycle".format(results['alloc_peak_kib'], results['alloc_retained_bytes_per_cycle']))
+    print("results written to {}".format(args.output))
+
+
+if __name__ == "__main__":
+    run(sys.argv[1:])
@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+
+# --------------------------------------------------------------------------- #
+# Micro benchmark of the register decoding.
+# Compares doDecode (one BinaryPayloadDecoder call per field) with the compiled
+# register map (one struct unpack per block) for all the blocks read from the
+# Classic. The outputs are checked to be the same before timing them, and
+# decodeModbusData is checked to give the same output for a poll where only
+# StatusRoll/RsetTmms changed (the unchanged fingerprint path) as a full decode.
+#
+# Run from code/Python:
+#    python3 benchmark/bench_decode.py [--count 20000]
+# --------------------------------------------------------------------------- #
+
+import os
+import sys
+import timeit
+import random
+import argparse
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from support.classic_modbusdecoder import doDecode, getDataDecoder, decodeModbusData, ModbusConnection, REGISTER_BLOCKS
+from support.classic_registermap import decodeBlock
+
+
+def randomBlocks(seed):
+    rnd = random.Random(seed)
+    return {addr: [rnd.randint(0, 65535) for _ in range(cnt)] for addr, cnt in REGISTER_BLOCKS}
+
+
+def decodeReference(blocks):
+    decoded = {}
+    for addr in blocks:
+        decoded.update(doDecode(addr, getDataDecoder(blocks[addr])))
+    return decoded
+
+
+def decodeCompiled(blocks):
+    decoded = {}
+    for addr in blocks:
+        decoded.update(decodeBlock(addr, blocks[addr]))
+    return decoded
+
+
+# --------------------------------------------------------------------------- #
+# Two polls in a row on one connection, the second with only the counters in
+# the fingerprint's ignored registers moved, decode as a full decode does
+# --------------------------------------------------------------------------- #
+def checkUnchangedDecode(seed):
+    blocks = randomBlocks(seed)
+    if seed % 2:
+        blocks[4100][0] = (blocks[4100][0] & 0xFF00) | 251     #Type 251 is turned into "250 KS"
+    connection = ModbusConnection("127.0.0.1", 502)
+    first = decodeModbusData(blocks, "127.0.0.1", connection)
+    assert first == decodeModbusData(blocks, "127.0.0.1"), "First decode differs for seed {}".format(seed)
+    blocks = {addr: list(registers) for addr, registers in blocks.items()}
+    blocks[4100][12] = (blocks[4100][12] + 1) & 0xFFFF          #StatusRoll
+    blocks[4100][13] = (blocks[4100][13] + 1) & 0xFFFF          #RsetTmms
+    second = decodeModbusData(blocks, "127.0.0.1", connection)
+    assert not connection.changed, "StatusRoll changed the fingerprint for seed {}".format(seed)
+    assert second == decodeModbusData(blocks, "127.0.0.1"), "Unchanged decode differs for seed {}".format(seed)
+
+
+def run(argv):
+    parser = argparse.ArgumentParser(description="Register decoding micro benchmark")
+    parser.add_argument("--count", type=int, default=20000, help="decodes per timing run")
+    parser.add_argument("--repeat", type=int, default=5, help="timing runs, the best one is reported")
+    args = parser.parse_args(argv)
+
+    # Same output, field for field, on a spread of register values
+    for seed in range(200):
+        blocks = randomBlocks(seed)
+        reference = decodeReference(blocks)
+        compiled = decodeCompiled(blocks)
+        assert list(reference.items()) == list(compiled.items()), "Decoders disagree for seed {}".format(seed)
+
+    # The random registers have codes without a text, which get logged
+    logging.disable(logging.ERROR)
+    for seed in range(200):
+        checkUnchangedDecode(seed)
+    logging.disable(logging.NOTSET)
+
+    blocks = randomBlocks(0)
+    reference = min(timeit.repeat(lambda: decodeReference(blocks), number=args.count, repeat=args.repeat))
+    compiled = min(timeit.repeat(lambda: decodeCompiled(blocks), number=args.count, repeat=args.repeat))
+
+    print("doDecode:        {:8.2f} us per cycle".format(reference / args.count * 1e6))
+    print("compiled map:    {:8.2f} us per cycle".format(compiled / args.count * 1e6))
+    print("speedup:         {:8.2f}x".format(reference / compiled))
+
+
+if __name__ == "__main__":
+    run(sys.argv[1:])
@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+
+# --------------------------------------------------------------------------- #
+# Micro benchmark of the readings and info JSON encoding.
+# Compares the templated encoders in classic_jsonencoder with json.dumps of
+# the same dict, the way the payloads used to be built. The outputs are
+# checked to be byte for byte the same before timing them, on a spread of
+# register values and on values json.dumps writes in its own way (NaN,
+# Infinity, None, quotes, non ASCII text).
+#
+# Run from code/Python:
+#    python3 benchmark/bench_encode.py [--count 20000]
+# --------------------------------------------------------------------------- #
+
+import os
+import sys
+import json
+import timeit
+import random
+import logging
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from support.classic_modbusdecoder import decodeModbusData, REGISTER_BLOCKS
+from support.classic_jsonencoder import encodeClassicData_readings, encodeClassicData_info, classicData_readings, classicData_info, \
+                                        READINGS_TEMPLATE
+
+ODD_VALUES = [float("nan"), float("inf"), float("-inf"), None, 'say "hi"\\', "café ☀", "%s %d", 1e22, -0.0, True, 2**70]
+
+
+def randomDecoded(seed):
+    rnd = random.Random(seed)
+    blocks = {addr: [rnd.randint(0, 65535) for _ in range(cnt)] for addr, cnt in REGISTER_BLOCKS}
+    decoded = dict(decodeModbusData(blocks, "bench"))
+    # a build date that exists
+    decoded["Year"], decoded["Month"], decoded["Day"] = rnd.randint(2010, 2030), rnd.randint(1, 12), rnd.randint(1, 28)
+    return decoded
+
+
+def dumps(data):
+    return json.dumps(data, sort_keys=False, separators=(',', ':'))
+
+
+def check(count):
+    for seed in range(count):
+        decoded = randomDecoded(seed)
+        assert encodeClassicData_readings(decoded) == dumps(classicData_readings(decoded)), "Readings differ for seed {}".format(seed)
+        assert encodeClassicData_info(decoded) == dumps(classicData_info(decoded)), "Info differs for seed {}".format(seed)
+
+    rnd = random.Random(0)
+    values = list(classicData_readings(randomDecoded(0)).values())
+    for _ in range(count):
+        odd = list(values)
+        for index in rnd.sample(range(len(odd)), 3):
+            odd[index] = rnd.choice(ODD_VALUES)
+        assert READINGS_TEMPLATE.encode(odd) == dumps(dict(zip(READINGS_TEMPLATE.keys, odd))), "Readings differ for {}".format(odd)
+
+
+def run(argv):
+    parser = argparse.ArgumentParser(description="JSON encoding micro benchmark")
+    parser.add_argument("--count", type=int, default=20000, help="encodes per timing run")
+    parser.add_argument("--repeat", type=int, default=5, help="timing runs, the best one is reported")
+    args = parser.parse_args(argv)
+
+    logging.disable(logging.CRITICAL)
+    check(500)
+
+    decoded = randomDecoded(0)
+    results = {}
+    for name, templated, reference in (("readings", encodeClassicData_readings, classicData_readings),
+                                       ("info", encodeClassicData_info, classicData_info)):
+        results[name] = (min(timeit.repeat(lambda: dumps(reference(decoded)), number=args.count, repeat=args.repeat)),
+                         min(timeit.repeat(lambda: templated(decoded), number=args.count, repeat=args.repeat)))
+
+    for name, (reference, templated) in results.items():
+        print("{:9}json.dumps: {:8.2f} us  templated: {:8.2f} us  speedup: {:5.2f}x".format(
+            name, reference / args.count * 1e6, templated / args.count * 1e6, reference / templated))
+
+
+if __name__ == "__main__":
+    run(sys.argv[1:])
@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+
+# --------------------------------------------------------------------------- #
+# A stand-in for the InfluxDB write endpoint, to try the InfluxDB writer
+# (support/classic_influx.py) against.
+# It takes POSTs on /write (1.x) and /api/v2/write (2.x), gzipped or not,
+# and keeps the lines and the requests. With failures=N the next N writes
+# get HTTP 503, to see the writer retry.
+#
+#    python3 benchmark/influx_server.py --port 8086
+#
+# prints each batch written, classic_mqtt is then started with
+# --influx_url http://127.0.0.1:8086/write?db=mqtt_solar
+# --------------------------------------------------------------------------- #
+
+import argparse
+import gzip
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WRITE_PATHS = ("/write", "/api/v2/write")
+
+
+class InfluxServer:
+
+    def __init__(self, host="127.0.0.1", port=8086, failures=0, verbose=False):
+        self.host = host
+        self.port = port
+        self.failures = failures    #writes still to fail
+        self.verbose = verbose
+        self.lines = []
+        self.requests = []          #(time, path, headers, number of lines, status)
+        self.server = None
+        self.thread = None
+
+    def handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.headers.get("Content-Encoding") == "gzip":
+                    body = gzip.decompress(body)
+                lines = [line for line in body.decode("utf-8").split("\n") if line]
+                if self.path.split("?")[0] not in WRITE_PATHS:
+                    status = 404
+                elif stub.failures > 0:
+                    stub.failures -= 1
+                    status = 503
+                else:
+                    stub.lines += lines
+                    status = 204
+                stub.requests.append((time.time(), self.path, dict(self.headers), len(lines), status))
+                if stub.verbose:
+                    print("{} {} lines -> {}".format(self.path, len(lines), status))
+                    for line in lines:
+                        print("  " + line[:200])
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.server = ThreadingHTTPServer((self.host, self.port), self.handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, name="influx_server", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stand-in InfluxDB write endpoint")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8086)
+    parser.add_argument("--failures", type=int, default=0, help="answer this many writes with HTTP 503 first")
+    args = parser.parse_args()
+    server = InfluxServer(args.host, args.port, args.failures, verbose=True).start()
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        server.stop()
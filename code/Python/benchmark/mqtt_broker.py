@@ -0,0 +1,213 @@
+#!/usr/bin/python3
+
+# --------------------------------------------------------------------------- #
+# A minimal MQTT 3.1.1 and 5 broker to benchmark against.
+# Enough of the protocol for classic_mqtt: CONNECT, PUBLISH at QoS 0 and 1,
+# SUBSCRIBE, PINGREQ and DISCONNECT. Published messages are counted and,
+# if asked for, kept so the output can be checked. Nothing is forwarded to
+# subscribers, the broker is only there to take what is published.
+#
+# MQTT 5 clients get a Topic Alias Maximum of topicAliasMaximum, the topic
+# aliases are resolved and the PUBLISH properties are kept with the message.
+# With v5=False it answers MQTT 5 connects like a 3.1.1 only broker, and
+# pubackReason is the reason code of the MQTT 5 PUBACKs.
+#
+# It runs on its own thread so the code being measured has the main thread to
+# itself.
+# --------------------------------------------------------------------------- #
+
+import asyncio
+import struct
+import threading
+import time
+
+CONNECT     = 1
+PUBLISH     = 3
+SUBSCRIBE   = 8
+PINGREQ     = 12
+DISCONNECT  = 14
+
+# MQTT 5 properties, id: kind
+PROPERTY_KINDS = {1: "byte", 2: "int", 3: "string", 8: "string", 9: "binary", 11: "varint", 35: "short", 38: "pair"}
+PROPERTY_NAMES = {1: "PayloadFormatIndicator", 2: "MessageExpiryInterval", 3: "ContentType", 8: "ResponseTopic",
+                  9: "CorrelationData", 11: "SubscriptionIdentifier", 35: "TopicAlias", 38: "UserProperty"}
+
+
+def readVarint(data, position):
+    multiplier, value = 1, 0
+    while True:
+        digit = data[position]
+        position += 1
+        value += (digit & 127) * multiplier
+        multiplier *= 128
+        if not digit & 128:
+            return value, position
+
+
+def readString(data, position):
+    length = struct.unpack_from(">H", data, position)[0]
+    return data[position + 2:position + 2 + length], position + 2 + length
+
+
+# The MQTT 5 properties at position, as a dict, and the position after them
+def readProperties(data, position):
+    length, position = readVarint(data, position)
+    end = position + length
+    properties = {}
+    while position < end:
+        identifier = data[position]
+        kind = PROPERTY_KINDS[identifier]
+        position += 1
+        if kind == "byte":
+            value = data[position]
+            position += 1
+        elif kind == "short":
+            value = struct.unpack_from(">H", data, position)[0]
+            position += 2
+        elif kind == "int":
+            value = struct.unpack_from(">I", data, position)[0]
+            position += 4
+        elif kind == "varint":
+            value, position = readVarint(data, position)
+        elif kind == "pair":
+            name, position = readString(data, position)
+            text, position = readString(data, position)
+            value = (name.decode(), text.decode())
+        else:
+            value, position = readString(data, position)
+            if kind == "string":
+                value = value.decode()
+        name = PROPERTY_NAMES[identifier]
+        if name == "UserProperty":
+            properties.setdefault(name, []).append(value)
+        else:
+            properties[name] = value
+    return properties, end
+
+
+class MqttBroker:
+
+    def __init__(self, host="127.0.0.1", port=1883, keepMessages=False, v5=True, topicAliasMaximum=10, pubackReason=0):
+        self.host = host
+        self.port = port
+        self.keepMessages = keepMessages
+        self.v5 = v5
+        self.topicAliasMaximum = topicAliasMaximum
+        self.pubackReason = pubackReason
+        self.messages = []          #(time, topic, payload) when keepMessages
+        self.properties = []        #the MQTT 5 properties of each message kept
+        self.protocols = []         #the protocol level of each connect
+        self.messageCount = 0
+        self.byteCount = 0
+        self.loop = None
+        self.server = None
+        self.thread = None
+        self.writers = set()
+
+    async def handle(self, reader, writer):
+        self.writers.add(writer)
+        level = 4
+        aliases = {}
+        try:
+            while True:
+                header = (await reader.readexactly(1))[0]
+                multiplier, length = 1, 0
+                while True:
+                    digit = (await reader.readexactly(1))[0]
+                    length += (digit & 127) * multiplier
+                    multiplier *= 128
+                    if not digit & 128:
+                        break
+                body = await reader.readexactly(length) if length else b''
+
+                packetType = header >> 4
+                if packetType == CONNECT:
+                    level = body[6]
+                    self.protocols.append(level)
+                    if level == 5 and not self.v5:
+                        # what a 3.1.1 broker answers, then it hangs up
+                        writer.write(b'\x20\x02\x00\x01')
+                        await writer.drain()
+                        break
+                    if level == 5:
+                        writer.write(b'\x20\x06\x00\x00\x03\x22' + struct.pack(">H", self.topicAliasMaximum))
+                    else:
+                        writer.write(b'\x20\x02\x00\x00')
+                elif packetType == PUBLISH:
+                    qos = (header >> 1) & 3
+                    topicLength = struct.unpack_from(">H", body)[0]
+                    topic = body[2:2 + topicLength].decode()
+                    position = 2 + topicLength
+                    packetId = body[position:position + 2]
+                    if qos:
+                        position += 2
+                    properties = {}
+                    if level == 5:
+                        properties, position = readProperties(body, position)
+                        if "TopicAlias" in properties:
+                            if topic:
+                                aliases[properties["TopicAlias"]] = topic
+                            else:
+                                topic = aliases[properties["TopicAlias"]]
+                    if qos:
+                        if level == 5 and self.pubackReason:
+                            writer.write(b'\x40\x03' + packetId + bytes([self.pubackReason]))
+                        else:
+                            writer.write(b'\x40\x02' + packetId)
+                    self.messageCount += 1
+                    self.byteCount += len(body) - position
+                    if self.keepMessages:
+                        self.messages.append((time.time(), topic, body[position:]))
+                        self.properties.append(properties)
+                elif packetType == SUBSCRIBE:
+                    # Grant QoS 0 for every filter
+                    filters, position = 0, 2
+                    if level == 5:
+                        position = readProperties(body, position)[1]
+                    while position < len(body):
+                        position += 2 + struct.unpack_from(">H", body, position)[0] + 1
+                        filters += 1
+                    if level == 5:
+                        writer.write(bytes([0x90, 3 + filters]) + body[:2] + b'\x00' + b'\x00' * filters)
+                    else:
+                        writer.write(bytes([0x90, 2 + filters]) + body[:2] + b'\x00' * filters)
+                elif packetType == PINGREQ:
+                    writer.write(b'\xd0\x00')
+                elif packetType == DISCONNECT:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        self.writers.discard(writer)
+        writer.close()
+
+    def start(self):
+        started = threading.Event()
+
+        async def serve():
+            self.server = await asyncio.start_server(self.handle, self.host, self.port)
+            started.set()
+            async with self.server:
+                try:
+                    await self.server.serve_forever()
+                except asyncio.CancelledError:
+                    pass
+
+        def runLoop():
+            self.loop = asyncio.new_event_loop()
+            self.loop.run_until_complete(serve())
+
+        self.thread = threading.Thread(target=runLoop, name="mqtt_broker", daemon=True)
+        self.thread.start()
+        started.wait(5)
+        return self
+
+    # Closes the client connections too, like a broker going away
+    def stop(self):
+        if self.loop is not None and self.server is not None:
+            def close():
+                self.server.close()
+                for writer in list(self.writers):
+                    writer.close()
+            self.loop.call_soon_threadsafe(close)
+            self.thread.join(5)
@@ -9,17 +9,34 @@ from collections import OrderedDict
 import json
 import time
 import socket
-import threading
+import asyncio
 import logging
 import os
 import sys
 from random import randint, seed
 from enum import Enum
 
-from support.classic_modbusdecoder import getModbusData
-from support.classic_jsonencoder import encodeClassicData_readings, encodeClassicData_info
+from support.classic_modbusdecoder import getModbusDataAsync, getRegistersAsync
+from support.classic_device import ClassicDevice
+from support.classic_asyncmqtt import AsyncioHelper
+from support.classic_publisher import MqttPublisher
+from support.classic_spool import ReadingsSpool
+from support.classic_capture import CaptureWindow
+from support.classic_readingsbatch import ReadingsBatch
+from support.classic_history import ReadingsHistory, DEFAULT_QUERY_SECONDS, DEFAULT_QUERY_STEP
+from support.classic_influx import InfluxWriter, readingsLine, readingsSeries
+from support.classic_prometheus import PrometheusExporter
+from support.classic_archive import ReadingsArchive
+from support.classic_sharedstate import SharedStateWriter
+from support.classic_metrics import ClassicMetrics, histogramLayout
+from support.classic_modbusproxy import ModbusProxy
+from support.classic_jsonencoder import encodeClassicData_readings, encodeClassicData_info, updateClassicData_readingsTime, classicData_readings, readingsValues
+from support.classic_fieldpublish import FieldPublisher
+from support.classic_binaryencoder import encodeClassicData_readingsBinary, SCHEMA_JSON, SCHEMA, SCHEMA_VERSION
+from support.classic_hadiscovery import haDeviceInfo, haDiscoveryMessages
 from support.classic_validate import handleArgs
-from time import time_ns
+from time import time_ns, perf_counter
+from datetime import datetime
 
 
 # --------------------------------------------------------------------------- # 
@@ -40,6 +57,47 @@ MQTT_MAX_ERROR_COUNT        = 300       #Number of errors on the MQTT before the
 MAIN_LOOP_SLEEP_SECS        = 5         #Seconds to sleep in the main loop
 
 HA_ENABLED                  = False     #Home-Assistant Auto Discovery
+HA_DISCOVERY_MODES          = ("device", "entity") #one discovery message per Classic or one per sensor
+HA_DISCOVERY_QOS            = 1         #the discovery is acknowledged before the state is published
+DEFAULT_HA_DISCOVERY        = "entity"
+
+DEFAULT_PUBLISH_QUEUE       = 1000      #Messages waiting to be published, the oldest is dropped when full
+DEFAULT_MQTT_QOS            = 0         #QoS of the readings and info
+MQTT_V5                     = False     #Connect with MQTT v5, falls back to v3.1.1 when the broker does not have it
+DEFAULT_MQTT_EXPIRY         = 300       #in seconds the broker keeps the readings for subscribers in MQTT v5, 0 for always
+DEFAULT_SPOOL_MAX_MB        = 100       #Most disk space a Classic's spool takes, the oldest readings go first
+DEFAULT_SPOOL_REPLAY_RATE   = 10        #Spooled readings replayed per second per Classic
+SPOOL_SUBTOPICS             = ("readings", "readingsbin", "readingsbatch", "readingsbatch/zlib") #What is spooled while MQTT is down
+DEFAULT_MODBUS_READ_GAP     = 32        #Max unused registers read to merge two blocks into one request
+DEFAULT_METRICS_INTERVAL    = 0         #Seconds between tele/STATE metrics publishes, 0 turns the metrics off
+DEFAULT_MODBUS_PROXY_PORT   = 0         #Port of the local MODBUS proxy, 0 turns it off
+DEFAULT_MODBUS_PROXY_MAX_AGE = 10       #Seconds the proxy answers from the last registers read
+MODBUS_PROXY_HOST           = "0.0.0.0" #The proxy listens on all interfaces
+PUBLISH_ON_CHANGE           = False     #Only publish readings that have changed
+DEFAULT_HEARTBEAT_INTERVAL  = 300       #in seconds, unchanged readings are published at least this often
+READINGS_MODES              = ("json", "fields", "both") #readings as one JSON, one topic per field or both
+DEFAULT_READINGS_MODE       = "json"
+DEFAULT_FIELD_REFRESH       = 300       #in seconds, all the field topics are published at least this often
+BINARY_READINGS             = False     #Also publish the readings packed in binary on stat/readingsbin
+DEFAULT_BATCH_READINGS      = 0         #Readings per stat/readingsbatch message, 0 for no limit
+DEFAULT_BATCH_SECS          = 0         #in seconds, the most a reading waits in a batch, 0 for no limit
+BATCH_COMPRESS              = False     #Compress the batches with zlib
+V5_SUBTOPICS                = SPOOL_SUBTOPICS + ("capture",) #Get a topic alias, the message expiry and the user properties in MQTT v5
+READINGS_SCHEMA             = "{}.{}".format(SCHEMA_VERSION, SCHEMA["id"]) #The schema user property, as on stat/readingsbin/schema
+DEFAULT_HISTORY_HOURS       = 0         #Hours of readings kept for history requests, 0 turns the history off
+MAX_HISTORY_HOURS           = 168       #A week
+DEFAULT_INFLUX_MEASUREMENT  = "mqtt_consumer" #Telegraf's, so the readings go with the ones Telegraf wrote
+DEFAULT_INFLUX_BATCH        = 100       #Lines per InfluxDB write
+DEFAULT_INFLUX_FLUSH        = 10        #in seconds, the most a line waits to be written
+DEFAULT_INFLUX_BUFFER       = 10000     #Lines kept while InfluxDB is unreachable, the oldest are dropped when full
+DEFAULT_ARCHIVE_FLUSH       = 30        #in seconds between writes to the archive
+DEFAULT_ARCHIVE_DAYS        = 30        #Days of readings kept in the archive, 0 keeps them all
+DEFAULT_PROMETHEUS_PORT     = 0         #Port of the Prometheus /metrics endpoint, 0 turns it off
+PROMETHEUS_HOST             = "0.0.0.0" #The endpoint listens on all interfaces
+DEFAULT_CAPTURE_INTERVAL    = 0         #in milliseconds between capture samples, 0 turns the capture off
+MIN_CAPTURE_INTERVAL        = 100       #in milliseconds
+MAX_CAPTURE_INTERVAL        = 500       #in milliseconds
+DEFAULT_CAPTURE_WINDOW      = 10        #in seconds, one stat/capture message per window
 
 # --------------------------------------------------------------------------- # 
 # Default startup values. Can be over-ridden by command line options.
@@ -56,32 +114,67 @@ argumentValues = { \
     'awakePublishRate':int(os.getenv('AWAKE_PUBLISH_RATE', str(DEFAULT_WAKE_RATE))), \
     'snoozePublishRate':int(os.getenv('SNOOZE_PUBLISH_RATE', str(DEFAULT_SNOOZE_RATE))), \
     'awakePublishLimit':int(os.getenv('AWAKE_PUBLISH_LIMIT', str(DEFAULT_WAKE_PUBLISHES))), \
-    'homeassistant':os.getenv('HA_ENABLED', str(HA_ENABLED)) \
+    'homeassistant':os.getenv('HA_ENABLED', str(HA_ENABLED)).lower() in ("true", "1", "yes"), \
+    'haDiscovery':os.getenv('HA_DISCOVERY', DEFAULT_HA_DISCOVERY), \
+    'publishQueue':int(os.getenv('PUBLISH_QUEUE', str(DEFAULT_PUBLISH_QUEUE))), \
+    'mqttQos':int(os.getenv('MQTT_QOS', str(DEFAULT_MQTT_QOS))), \
+    'mqttV5':os.getenv('MQTT_V5', str(MQTT_V5)).lower() in ("true", "1", "yes"), \
+    'mqttExpiry':int(os.getenv('MQTT_EXPIRY', str(DEFAULT_MQTT_EXPIRY))), \
+    'spoolDir':os.getenv('SPOOL_DIR', ""), \
+    'spoolMaxMB':int(os.getenv('SPOOL_MAX_MB', str(DEFAULT_SPOOL_MAX_MB))), \
+    'spoolReplayRate':int(os.getenv('SPOOL_REPLAY_RATE', str(DEFAULT_SPOOL_REPLAY_RATE))), \
+    'modbusReadGap':int(os.getenv('MODBUS_READ_GAP', str(DEFAULT_MODBUS_READ_GAP))), \
+    'fleet':os.getenv('CLASSIC_FLEET', ""), \
+    'metricsInterval':int(os.getenv('METRICS_INTERVAL', str(DEFAULT_METRICS_INTERVAL))), \
+    'modbusProxyPort':int(os.getenv('MODBUS_PROXY_PORT', str(DEFAULT_MODBUS_PROXY_PORT))), \
+    'modbusProxyMaxAge':int(os.getenv('MODBUS_PROXY_MAX_AGE', str(DEFAULT_MODBUS_PROXY_MAX_AGE))), \
+    'publishOnChange':os.getenv('PUBLISH_ON_CHANGE', str(PUBLISH_ON_CHANGE)).lower() in ("true", "1", "yes"), \
+    'heartbeatInterval':int(os.getenv('HEARTBEAT_INTERVAL', str(DEFAULT_HEARTBEAT_INTERVAL))), \
+    'readingsMode':os.getenv('READINGS_MODE', DEFAULT_READINGS_MODE), \
+    'fieldRefresh':int(os.getenv('FIELD_REFRESH', str(DEFAULT_FIELD_REFRESH))), \
+    'fieldDeadbands':os.getenv('FIELD_DEADBANDS', ""), \
+    'binaryReadings':os.getenv('BINARY_READINGS', str(BINARY_READINGS)).lower() in ("true", "1", "yes"), \
+    'batchReadings':int(os.getenv('BATCH_READINGS', str(DEFAULT_BATCH_READINGS))), \
+    'batchSecs':int(os.getenv('BATCH_SECS', str(DEFAULT_BATCH_SECS))), \
+    'batchCompress':os.getenv('BATCH_COMPRESS', str(BATCH_COMPRESS)).lower() in ("true", "1", "yes"), \
+    'historyHours':int(os.getenv('HISTORY_HOURS', str(DEFAULT_HISTORY_HOURS))), \
+    'influxUrl':os.getenv('INFLUX_URL', ""), \
+    'influxToken':os.getenv('INFLUX_TOKEN', ""), \
+    'influxMeasurement':os.getenv('INFLUX_MEASUREMENT', DEFAULT_INFLUX_MEASUREMENT), \
+    'influxBatch':int(os.getenv('INFLUX_BATCH', str(DEFAULT_INFLUX_BATCH))), \
+    'influxFlush':int(os.getenv('INFLUX_FLUSH', str(DEFAULT_INFLUX_FLUSH))), \
+    'influxBuffer':int(os.getenv('INFLUX_BUFFER', str(DEFAULT_INFLUX_BUFFER))), \
+    'archiveDb':os.getenv('ARCHIVE_DB', ""), \
+    'archiveFlush':int(os.getenv('ARCHIVE_FLUSH', str(DEFAULT_ARCHIVE_FLUSH))), \
+    'archiveDays':int(os.getenv('ARCHIVE_DAYS', str(DEFAULT_ARCHIVE_DAYS))), \
+    'sharedState':os.getenv('SHARED_STATE', ""), \
+    'prometheusPort':int(os.getenv('PROMETHEUS_PORT', str(DEFAULT_PROMETHEUS_PORT))), \
+    'captureInterval':int(os.getenv('CAPTURE_INTERVAL', str(DEFAULT_CAPTURE_INTERVAL))), \
+    'captureWindow':int(os.getenv('CAPTURE_WINDOW', str(DEFAULT_CAPTURE_WINDOW))) \
     }
 
 # --------------------------------------------------------------------------- # 
 # Counters and status variables
+# The per Classic counters and status live in ClassicDevice
 # --------------------------------------------------------------------------- # 
-infoPublished               = False
-stayAwake                   = False
 mqttConnected               = False
 doStop                      = False
-modeAwake                   = False
 
-modbusErrorCount            = 0
 mqttErrorCount              = 0
-awakePublishCount           = 0      #How many publishes have I done?
-awakePublishCycles          = 0
-snoozePublishCycles         = 0      #How many cycles have gone by?
-snoozeCycleLimit            = 0      #How many cycles before I publish in snooze mode (changes with wake rate)
-currentPollRate             = DEFAULT_WAKE_RATE
+mqttReconnectCount          = 0
 mqttClient                  = None
+mqttClientId                = None
+mqttFallback                = False  #The broker does not have MQTT v5, the main loop reconnects with v3.1.1
+mqttTopicAliasMaximum       = 0      #Topic aliases the broker takes from us, MQTT v5 only
+mqttPublisher               = None   #The publish stage, see MqttPublisher
+influxWriter                = None   #Writes the readings to InfluxDB, see InfluxWriter
+prometheusExporter          = None   #Serves the latest readings on /metrics, see PrometheusExporter
+readingsArchive             = None   #Keeps the readings in SQLite, see ReadingsArchive
+sharedState                 = None   #The latest readings in shared memory, see SharedStateWriter
 homeassistantEnabled        = False
 
-mqttDeviceModel             = 'Classic'
-mqttDeviceFirmware          = ''
-mqttLastSOCicon             = ''
-mqttLastCSicon              = ''
+devices                     = []     #The Classics being polled
+devicesByName               = {}
 
 # --------------------------------------------------------------------------- # 
 # configure the logging
@@ -98,20 +191,27 @@ if not log.handlers:
 # MQTT On Connect function
 # --------------------------------------------------------------------------- # 
 def on_connect(client, userdata, flags, rc):
-    global mqttConnected, mqttErrorCount, mqttClient, mqttDeviceModel
+    global mqttConnected, mqttErrorCount, mqttClient
     if rc==0:
         log.debug("MQTT connected OK Returned code={}".format(rc))
-        # re-initiate HA-autodiscovery
-        infoPublished = False
         #subscribe to the commands
         try:
-            topic = "{}{}/cmnd/#".format(argumentValues['mqttRoot'], argumentValues['classicName'])
-            client.subscribe(topic)
-            log.debug("Subscribed to {}".format(topic))
+            for device in devices:
+                # re-initiate HA-autodiscovery, the broker may have lost the retained one
+                device.infoPublished = False
+                device.haDiscoveryPublished = None
+
+                topic = device.topic(argumentValues['mqttRoot'], "cmnd/#")
+                client.subscribe(topic)
+                log.debug("Subscribed to {}".format(topic))
             
-            #publish that we are Online
-            will_topic = "{}{}/tele/LWT".format(argumentValues['mqttRoot'], argumentValues['classicName'])
-            mqttClient.publish(will_topic, "Online",  qos=0, retain=False)
+                #publish that we are Online
+                will_topic = device.topic(argumentValues['mqttRoot'], "tele/LWT")
+                mqttClient.publish(will_topic, "Online",  qos=0, retain=False)
+
+                #the schema the binary readings are decoded with
+                if argumentValues['binaryReadings']:
+                    mqttClient.publish(device.topic(argumentValues['mqttRoot'], "stat/readingsbin/schema"), SCHEMA_JSON, qos=0, retain=True)
             
         except Exception as e:
             log.error("MQTT Subscribe failed")
@@ -119,6 +219,7 @@ def on_connect(client, userdata, flags, rc):
 
         mqttConnected = True
         mqttErrorCount = 0
+        mqttPublisher.setConnected(True, client.protocol == mqttclient.MQTTv5, mqttTopicAliasMaximum)
     else:
         mqttConnected = False
         log.error("MQTT Bad connection Returned code={}".format(rc))
@@ -129,10 +230,36 @@ def on_connect(client, userdata, flags, rc):
 def on_disconnect(client, userdata, rc):
     global mqttConnected, mqttClient
     mqttConnected = False
+    mqttPublisher.setConnected(False)
     #if disconnetion was unexpectred (not a result of a disconnect request) then log it.
     if rc!=mqttclient.MQTT_ERR_SUCCESS:
         log.debug("on_disconnect: Disconnected. ReasonCode={}".format(rc))
 
+# --------------------------------------------------------------------------- # 
+# The MQTT v5 mode uses paho's version 2 callbacks, they pass the reason codes
+# and the properties. A broker that does not have MQTT v5 refuses the connect
+# with "Unsupported protocol version", the main loop then connects again with
+# v3.1.1. The failure reason codes count as MQTT errors.
+# --------------------------------------------------------------------------- # 
+def on_connect_v5(client, userdata, flags, reasonCode, properties):
+    global mqttErrorCount, mqttFallback, mqttTopicAliasMaximum
+    if reasonCode.is_failure:
+        mqttErrorCount += 1
+        if reasonCode == "Unsupported protocol version" and client.protocol == mqttclient.MQTTv5:
+            log.warning("The MQTT broker does not support MQTT v5, falling back to v3.1.1")
+            mqttFallback = True
+        log.error("MQTT connect refused, reason: {}".format(reasonCode))
+    mqttTopicAliasMaximum = getattr(properties, "TopicAliasMaximum", 0) if properties is not None else 0
+    on_connect(client, userdata, flags, reasonCode.value)
+
+def on_disconnect_v5(client, userdata, flags, reasonCode, properties):
+    global mqttErrorCount
+    #the broker hung up on us and told us why
+    if flags.is_disconnect_packet_from_server and reasonCode.is_failure:
+        mqttErrorCount += 1
+        log.error("MQTT broker disconnected, reason: {}".format(reasonCode))
+    on_disconnect(client, userdata, reasonCode.value)
+
 # --------------------------------------------------------------------------- # 
 # MQTT On Message
 # --------------------------------------------------------------------------- # 
@@ -140,23 +267,29 @@ def on_message(client, userdata, message):
         #print("Received message '" + str(message.payload) + "' on topic '"
         #+ message.topic + "' with QoS " + str(message.qos))
 
-        global currentPollRate, infoPublished, modeAwake, doStop, mqttConnected, mqttErrorCount, awakePublishCount, awakePublishCycles, stayAwake, argumentValues, snoozeCycleLimit
+        global doStop, mqttConnected, mqttErrorCount
 
         mqttConnected = True #got a message so we must be up again...
         mqttErrorCount = 0
 
+        #Find the Classic the command is for, the topic is <root><classicName>/cmnd/...
+        device = devicesByName.get(message.topic[len(argumentValues['mqttRoot']):].rsplit("/cmnd/", 1)[0])
+        if device is None:
+            log.error("on_message: Received a command for an unknown Classic on {}".format(message.topic))
+            return
+
         msg = message.payload.decode(encoding='UTF-8').upper()
-        log.debug("Received MQTT message {}".format(msg))
+        log.debug("Received MQTT message {} for {}".format(msg, device.classicName))
 
         #if we get a WAKE or INFO, reset the counters, re-puplish the INFO and stop snoozing.
         if msg == "{\"WAKE\"}" or msg == "{\"INFO\"}":
             #Make info packet get published
-            infoPublished = False 
-            modeAwake = True
-            awakePublishCount = 0 #reset the publish count
+            device.infoPublished = False 
+            device.modeAwake = True
+            device.awakePublishCount = 0 #reset the publish count
 
             # this will cause an immediate publish, no reason to wait for the cycles to expire
-            awakePublishCycles = argumentValues['awakePublishRate'] 
+            device.awakePublishCycles = device.awakePublishRate 
         elif msg == "{\"STOP\"}":
             doStop = True
         else: #JSON messages
@@ -164,10 +297,10 @@ def on_message(client, userdata, message):
             log.debug(theMessage)
             
             if "stayAwake" in theMessage:
-                stayAwake = theMessage['stayAwake']
-                infoPublished = False 
-                modeAwake = True
-                log.debug("StayAwake received, setting stayAwake to {}".format(stayAwake))
+                device.stayAwake = theMessage['stayAwake']
+                device.infoPublished = False 
+                device.modeAwake = True
+                log.debug("StayAwake received, setting stayAwake to {}".format(device.stayAwake))
             
             elif "wakePublishRate" in theMessage:
                 newRate_msecs = theMessage['wakePublishRate']
@@ -177,123 +310,88 @@ def on_message(client, userdata, message):
                 elif newRate > MAX_WAKE_RATE:
                     log.error("Received wakePublishRate of {} which is above maximum of {}".format(newRate,MAX_WAKE_RATE))
                 else:
-                    argumentValues['awakePublishRate'] = newRate
-                    currentPollRate = newRate
-                    snoozeCycleLimit = round(argumentValues['snoozePublishRate']/argumentValues['awakePublishRate'])
+                    device.setAwakePublishRate(newRate)
                     log.debug("wakePublishRate message received, setting rate to {}".format(newRate))
-                    log.debug("Updating snoozeCycleLimit to {}".format(snoozeCycleLimit))
+                    log.debug("Updating snoozeCycleLimit to {}".format(device.snoozeCycleLimit))
+
+            elif "history" in theMessage:
+                publishHistory(device, theMessage['history'])
             else:
                 log.error("on_message: Received something else")
+
+# --------------------------------------------------------------------------- # 
+# Answer a history request on stat/history, see classic_history
+# --------------------------------------------------------------------------- # 
+def publishHistory(device, request):
+    if device.history is None:
+        log.error("History requested for {} but it is off, see --history_hours".format(device.classicName))
+        return
+    try:
+        request = request or {}
+        answer = device.history.query(request.get('fields'), request.get('seconds', DEFAULT_QUERY_SECONDS), request.get('step', DEFAULT_QUERY_STEP), time.time())
+    except (AttributeError, TypeError, ValueError) as e:
+        log.error("Bad history request for {}: {}".format(device.classicName, e))
+        answer = {"error": str(e)}
+    mqttPublish(mqttClient, device, json.dumps(answer), "history")
             
 # --------------------------------------------------------------------------- # 
 # MQTT Publish the data
 # --------------------------------------------------------------------------- # 
-def mqttPublish(client, data, subtopic):
-    global mqttConnected, mqttErrorCount
+def mqttPublish(client, device, data, subtopic, retain=False, taken=None):
 
-    topic = "{}{}/stat/{}".format(argumentValues['mqttRoot'], argumentValues['classicName'], subtopic)
+    topic = device.topic(argumentValues['mqttRoot'], "stat/{}".format(subtopic))
     log.debug("Publishing: {}".format(topic))
-    
-    try:
-        client.publish(topic,data)
+
+    #While MQTT is down the readings go to the spool, to be replayed on stat/replay/...
+    if not mqttConnected and device.spool is not None and subtopic in SPOOL_SUBTOPICS:
+        try:
+            device.spool.append(device.topic(argumentValues['mqttRoot'], "stat/replay/{}".format(subtopic)), data, taken)
+        except OSError as e:
+            log.error("Unable to spool the {} of {}: {}".format(subtopic, device.classicName, e))
+            return False
+        if device.metrics is not None:
+            device.metrics.count("spooled")
         return True
-    except Exception as e:
-        log.error("MQTT Publish Error Topic:{}".format(topic))
-        log.exception(e, exc_info=True)
-        mqttConnected = False
+
+    #In MQTT v5 the readings get a topic alias, expire and say when they were taken
+    properties = None
+    if argumentValues['mqttV5'] and subtopic in V5_SUBTOPICS:
+        userProperties = [("ts", "%d" % (taken * 1000))] if taken is not None else []
+        if subtopic in SPOOL_SUBTOPICS:
+            userProperties.append(("schema", READINGS_SCHEMA))
+        properties = (argumentValues['mqttExpiry'], userProperties, True)
+
+    #Queued for the publish stage, the state waits for the discovery to be acknowledged
+    mqttPublisher.submit(topic, data, argumentValues['mqttQos'], retain, device.haDiscoveryAck, device.metrics, properties)
+    return True
+
+# --------------------------------------------------------------------------- # 
+# A publish failed in the publish stage
+# --------------------------------------------------------------------------- # 
+def publishFailed(request):
+    global mqttErrorCount
+    mqttErrorCount += 1
+    if request.metrics is not None:
+        request.metrics.count("publishErrors")
+
+# --------------------------------------------------------------------------- # 
+# Publish the Home Assistant discovery for a Classic, retained, when it is
+# not the same as the last one published. Returns True when it was published
+# --------------------------------------------------------------------------- # 
+def mqttHA_autodiscovery( device, data ):
+    global argumentValues
+
+    device.mqttDeviceModel, device.mqttDeviceFirmware = haDeviceInfo(data)
+    fingerprint = (argumentValues['haDiscovery'], argumentValues['mqttRoot'], device.classicName, device.mqttDeviceModel, device.mqttDeviceFirmware)
+    if fingerprint == device.haDiscoveryPublished:
         return False
 
-def mqttHApublish( sensor, name, units, icon, inforead, vtemplate, data ):
-    #publisch HA autodiscovery for 1 sensor/diagnostic
-    global mqttClient, argumentValues, mqttDeviceModel, mqttDeviceFirmware
-    #
-    HA_root = argumentValues['mqttRoot']
-    HA_name = argumentValues['classicName']
-    HA_device = '"force_update": "true", "device": {{ "identifiers": ["{}"],"name": "{}","manufacturer": "MidNite-Solar","model": "{}", "sw_version": "{}"}}'.format( HA_name, HA_name, mqttDeviceModel, mqttDeviceFirmware )
-    # Vtemplate
-    HA_vtemplate = '{{{{value_json.{0}}}}}'.format(sensor)
-    if vtemplate != '':
-        HA_vtemplate = vtemplate
-    # Units
-    HA_units = units
-    if units == 'C':
-        HA_icon = '"icon": "mdi:thermometer", '
-        if icon != '':
-            HA_icon = icon
-            icon = ''
-        HA_units = '"unit_of_meas": "°C", '+HA_icon+'"device_class": "temperature", "state_class": "measurement", '
-    if units == 'A':
-        HA_units = '"unit_of_meas": "A", "device_class": "power", "state_class": "measurement", '
-    if units == 'V':
-        HA_units = '"unit_of_meas": "V", "device_class": "power", "state_class": "measurement", '
-    if units == 'W':
-        HA_units = '"unit_of_meas": "W", "device_class": "power", "state_class": "measurement", '
-    if units == 'kWh':
-        HA_units = '"unit_of_meas": "kWh", "device_class": "power", "state_class": "measurement", '
-    if units == '%':
-        HA_icon = '' # '"icon": "mdi:battery", '
-        if icon != '':
-            HA_icon = icon
-            icon = ''
-        HA_units = '"unit_of_meas": "%", '+HA_icon+'"state_class": "measurement", '
-    if units == 's':
-        HA_icon = '"icon": "mdi:clock", '
-        if icon != '':
-            HA_icon = icon
-            icon = ''
-        HA_units = '"unit_of_meas": "s", '+HA_icon+'"state_class": "measurement", '
-    if units == 'Ah':
-        HA_units = '"unit_of_meas": "Ah", "device_class": "power", "state_class": "measurement", '
-    #
-    HA_topic = "homeassistant/sensor/{}/{}/config".format(HA_name, sensor)
-    HA_msg = '{{"~": "{0}", "unique_id": "{0}-{1}", "object_id": "{0}-{1}", "name": "{2}", {3}{4}"state_topic": "{5}{0}/stat/{6}", "value_template": "{8}", {7}}}'.format(
-    HA_name, sensor, name, icon, HA_units, HA_root, inforead, HA_device, HA_vtemplate )
-    #	0		1		2	3		4		5			6			7			8
-    #log.debug( "publish: {}".format(HA_msg) )
-    mqttClient.publish(HA_topic, HA_msg,  qos=0, retain=False)
-    #
-
-def mqttHA_autodiscovery( data ):
-    # publisch HA autodiscovery
-    global mqttClient, argumentValues, mqttDeviceModel, mqttDeviceFirmware
-    #
-    log.debug("mqttHA_autodiscovery")
-    mqttDeviceModel = "Classic {}V (rev {})".format(data["Type"],data["PCB"])
-    mqttDeviceFirmware = "{:04n}{:02n}{:02n}.app.{}.net.{}".format(data["Year"],data["Month"],data["Day"],data['app_rev'],data['net_rev'])
-    #
-    # Device info
-    mqttHApublish( 'model', 'device Model', '"entity_category": "diagnostic", ', '"icon": "mdi:teddy-bear", ', 'info', '', data )
-    mqttHApublish( 'deviceName', 'device Name', '"entity_category": "diagnostic", ', '"icon": "mdi:home-analytics", ', 'info', '', data )
-    mqttHApublish( 'deviceType', 'device Type', '"entity_category": "diagnostic", ', '"icon": "mdi:format-list-bulleted-type", ', 'info', '', data )
-    mqttHApublish( 'macAddress', 'MAC Address', '"entity_category": "diagnostic", ', '"icon": "mdi:console-network", ', 'info', '', data )
-    mqttHApublish( 'IP', 'IP Address', '"entity_category": "diagnostic", ', '"icon": "mdi:ip-network", ', 'info', '', data )
-    mqttHApublish( 'nominalBatteryVoltage', 'nominal Battery Voltage', '"entity_category": "diagnostic", "unit_of_meas": "V", ', '"icon": "mdi:battery-charging", ', 'info', '', data )
-    # Measurements
-    mqttHApublish( 'BatTemperature', 'Temperature Battery', 'C', '', 'readings', '', data )
-    mqttHApublish( 'PCBTemperature', 'Temperature PCB', 'C', '', 'readings', '', data )
-    mqttHApublish( 'FETTemperature', 'Temperature FET', 'C', '', 'readings', '', data )
-    mqttHApublish( 'ShuntTemperature', 'Temperature Shunt', 'C', '', 'readings', '', data )
-    mqttHApublish( 'PVCurrent', 'PV Current', 'A', '"icon": "mdi:solar-panel", ', 'readings', '', data )
-    mqttHApublish( 'Power', 'PV Power', 'W', '"icon": "mdi:solar-panel", ', 'readings', '', data )
-    mqttHApublish( 'PVVoltage', 'PV Voltage', 'V', '"icon": "mdi:solar-panel", ', 'readings', '', data )
-    mqttHApublish( 'BatVoltage', 'Battery Voltage', 'V', '', 'readings', '', data )
-    mqttHApublish( 'BatCurrent', 'Battery Current', 'A', '', 'readings', '', data )
-    mqttHApublish( 'WhizbangBatCurrent', 'Battery Current Whizbang', 'A', '', 'readings', '', data )
-    mqttHApublish( 'SOC', 'Charge SOC', '"unit_of_meas": "%", "state_class": "measurement", ', '"icon": "'+data['SOCicon']+'", ', 'readings', '', data )
-    mqttHApublish( 'RemainingAmpHours', 'Amp Hours Remaining', 'Ah', '', 'readings', '', data )
-    mqttHApublish( 'TotalAmpHours', 'Amp Hours Total', 'Ah', '', 'readings', '', data )
-    mqttHApublish( 'NetAmpHours', 'Amp Hours Netto', 'Ah', '', 'readings', '', data )
-    mqttHApublish( 'EnergyToday', 'Energy Today', 'kWh', '"icon": "mdi:calendar-today", ', 'readings', '', data )
-    mqttHApublish( 'TotalEnergy', 'Energy Total', 'kWh', '"icon": "mdi:home-lightning-bolt-outline", ', 'readings', '', data )
-    mqttHApublish( 'currentTime', 'Current Time', '"state_class": "measurement", ', '"icon": "mdi:calendar-clock", ', 'readings', '', data )
-    mqttHApublish( 'ChargeState', 'Charge State', '', '"icon": "'+data['ChargeStateIcon']+'", ', 'readings', '', data )
-    mqttHApublish( 'ChargeStateText', 'Charge State Text', '', '"icon": "'+data['ChargeStateIcon']+'", ', 'readings', '', data )
-    #mqttHApublish( 'ChargeStateText', 'Charge State Text', '', '"icon": "'+data['ChargeStateIcon']+'", ', 'readings', '{{ {0: \'Resting\',3: \'Absorb\',4: \'Bulk MPPT\',5: \'Float\',6: \'Float MPPT\',7: \'Equalize\',10: \'HyperVOC\',18: \'Equalize MPPT\'}[value_json.ChargeState]}}', data )
-    mqttHApublish( 'FloatTimeTodaySeconds', 'Today Float Time', 's', '', 'readings', '', data )
-    mqttHApublish( 'AbsorbTime', 'Today Absorb Time', 's', '', 'readings', '', data )
-    mqttHApublish( 'EqualizeTime', 'Today Equalize Time', 's', '', 'readings', '', data )
-    mqttHApublish( 'ReasonForResting', 'Reason For Resting', '"state_class": "measurement", ', '', 'readings', '', data )
-    mqttHApublish( 'ReasonForRestingText', 'Reason Text', '"state_class": "measurement", ', '', 'readings', '', data )
+    log.debug("mqttHA_autodiscovery for {}".format(device.classicName))
+    for topic, payload in haDiscoveryMessages(*fingerprint):
+        device.haDiscoveryAck = mqttPublisher.submit(topic, payload, HA_DISCOVERY_QOS, True, None, device.metrics)
+    device.haDiscoveryPublished = fingerprint
+    return True
+
 # {
 #     "appVersion": 1849,
 #     "deviceName": "CLASSIC\u0000", < 1 char too much / stop on 0
@@ -341,134 +439,372 @@ def mqttHA_autodiscovery( data ):
 # }       
     
 # --------------------------------------------------------------------------- # 
-# Test to see if it is time to gather data and publish.
-# periodic is called every second, so this method figures out if it is time to 
-# publish based on the mode (awake or snoozing) and the frequency rates
-# --------------------------------------------------------------------------- # 
-def timeToPublish():
-    global modeAwake, snoozePublishCycles, infoPublished, awakePublishCycles, awakePublishCount, stayAwake, argumentValues
-    #log.debug("modeAwake: {}".format(modeAwake))
-    if (modeAwake):
-        #We remain awake for a number of publishes
-        #log.debug("awakePublishCount:{}".format(awakePublishCount))
-        #log.debug("awakePublishLimit:{}".format(argumentValues['awakePublishLimit']))
-        if awakePublishCount >= argumentValues['awakePublishLimit']:
-            awakePublishCount = 0
-            if stayAwake:
-                log.debug("StayAwake enabled, so not going into snooze mode")
-                return True
-            else:
-                modeAwake = False
-                snoozePublishCycles = 0
-                return False
-        else:
-            awakePublishCount += 1
-            return True
-    else: #Snoozing
-        # We passively publish every snoozePublishCycles while snoozing
-        # log.debug("snoozePublishCycles:{}".format(snoozePublishCycles))
-        
-        if (snoozePublishCycles >= snoozeCycleLimit):
-            infoPublished = False #Makes #info# get published
-            snoozePublishCycles = 0 #Reset the cycles to start again
-            return True
-        else:
-            snoozePublishCycles += 1
-            return False
-# --------------------------------------------------------------------------- # 
-# Periodic will be called when needed.
-# If so, it will read from MODBUS and publish to MQTT
+# Periodic will be called for a Classic when its poll time comes up.
+# If it is time to publish (see ClassicDevice.timeToPublish) it will read from 
+# MODBUS and publish to MQTT
 # --------------------------------------------------------------------------- # 
-def periodic(modbus_stop):    
+async def periodic(device):    
 
-    global mqttClient, modbusErrorCount, infoPublished, mqttErrorCount, currentPollRate, mqttLastSOCicon, mqttLastCSicon, homeassistantEnabled
+    global mqttClient, mqttErrorCount, homeassistantEnabled
 
-    if not modbus_stop.is_set():
-        #Get the current time as a float of seconds.
-        beforeTime = time_ns() /  1000000000.0
-
-        #log.debug("in Periodic")
-        try:
-            if timeToPublish() and mqttConnected:
-                log.debug("Call getModbusData" )
-                data = {}
-                #Get the Modbus Data and store it.
-                data = getModbusData(modeAwake, argumentValues['classicHost'], argumentValues['classicPort'])
-                if data: # got data
+    metrics = device.metrics #None when the metrics are off
+    try:
+        #With a spool the readings are still taken while MQTT is down
+        if device.timeToPublish() and (mqttConnected or device.spool is not None):
+            log.debug("Call getModbusData for {}".format(device.classicName))
+            if metrics is not None:
+                metrics.count("cycles")
+                cycleStart = perf_counter()
+            data = {}
+            #Get the Modbus Data and store it.
+            #The static registers are only read again when the info is going to be published
+            #The capture needs the connection, it stays open while capturing
+            data = await getModbusDataAsync(device.modeAwake or device.capture is not None, device.classicHost, device.classicPort, argumentValues['modbusReadGap'], device.connection, not device.infoPublished, metrics)
+            if data: # got data
+                #
+                device.modbusErrorCount = 0
+                taken = time.time()
+                if (not device.infoPublished) and mqttConnected: #Check if the Info has been published yet
                     #
-                    modbusErrorCount = 0
-                    if (not infoPublished): #Check if the Info has been published yet
-                        #
-                        if ( homeassistantEnabled is True): #Check if HA_enabled is true
-                            mqttHA_autodiscovery( data )
-                            # wait 1 second for HA to receive and create device
-                            time.sleep(1)
+                    if ( homeassistantEnabled is True): #Check if HA_enabled is true
+                        if metrics is not None:
+                            start = perf_counter()
+                        # the info and readings are held back until HA has the discovery
+                        if mqttHA_autodiscovery( device, data ):
                             log.debug("Done mqttHAautodiscovery" )
-                            #
-                        if mqttPublish(mqttClient,encodeClassicData_info(data),"info"):
-                            infoPublished = True
-                            time.sleep(1)
-                        else:
-                            mqttErrorCount += 1
-                        #
-                    if mqttPublish(mqttClient,encodeClassicData_readings(data),"readings"):
+                        if metrics is not None:
+                            metrics.since("discovery", start)
                         #
-                        if ( homeassistantEnabled  is True): #Check if HA_enabled is true
-                            # re-send ChargeState because of icon
-                            if mqttLastCSicon != data["ChargeStateIcon"]:
-                                mqttLastCSicon = data["ChargeStateIcon"]
-                                log.debug("Call CS mqttHApublish {}".format(mqttLastCSicon) )
-                                mqttHApublish( 'ChargeState', 'Charge State', '', '"icon": "'+ data["ChargeStateIcon"] + '", ', 'readings', '', data )
-                                mqttHApublish( 'ChargeStateText', 'Charge State Text', '', '"icon": "'+data['ChargeStateIcon']+'", ', 'readings', '{{ {0: \'Resting\',3: \'Absorb\',4: \'Bulk MPPT\',5: \'Float\',6: \'Float MPPT\',7: \'Equalize\',10: \'HyperVOC\',18: \'Equalize MPPT\'}[value_json.ChargeState]}}', data )
-                            # re-send SOC because of icon
-                            if mqttLastSOCicon != data["SOCicon"]:
-                                mqttLastSOCicon = data["SOCicon"]
-                                log.debug("Call SOC mqttHApublish {}".format(mqttLastSOCicon) )
-                                mqttHApublish( 'SOC', 'Charge SOC', '"unit_of_meas": "%", "state_class": "measurement", ', '"icon": "'+ data["SOCicon"] + '", ', 'readings', '', data )
+                    if mqttPublish(mqttClient,device,encodeClassicData_info(data),"info"):
+                        device.infoPublished = True
                     else:
                         mqttErrorCount += 1
+                        if metrics is not None:
+                            metrics.count("publishErrors")
+                    #
+                if not publishReadings(device, data, metrics):
+                    mqttErrorCount += 1
+                    if metrics is not None:
+                        metrics.count("publishErrors")
 
-                else:
-                    log.error("MODBUS data not good, skipping publish")
-                    modbusErrorCount += 1
+                keepReadings(device, data, taken, metrics)
+
+                if metrics is not None:
+                    metrics.since("cycle", cycleStart)
+            else:
+                log.error("MODBUS data not good for {}, skipping publish".format(device.classicName))
+                device.modbusErrorCount += 1
+                if metrics is not None:
+                    metrics.count("modbusErrors")
+    except Exception as e:
+        log.error("Caught Error in periodic")
+        log.exception(e, exc_info=True)
+
+# --------------------------------------------------------------------------- # 
+# The readings kept in memory, written to InfluxDB, the archive or shared
+# memory and scraped by Prometheus do not go through MQTT. They are handed
+# over after the MQTT publish, each on its own so one failing does not keep
+# the readings from the others
+# --------------------------------------------------------------------------- # 
+def keepReadings(device, data, taken, metrics):
+    if device.history is None and influxWriter is None and prometheusExporter is None and readingsArchive is None and sharedState is None:
+        return
+    try:
+        values = readingsValues(data)
+    except Exception as e:
+        log.error("Unable to get the readings of {} to keep: {}".format(device.classicName, e))
+        return
+
+    if device.history is not None:
+        try:
+            device.history.append(taken, values)
         except Exception as e:
-            log.error("Caught Error in periodic")
-            log.exception(e, exc_info=True)
+            log.error("Unable to add the readings of {} to the history: {}".format(device.classicName, e))
+    if influxWriter is not None:
+        try:
+            influxWriter.add(readingsLine(device.influxSeries, values, taken))
+        except Exception as e:
+            log.error("Unable to queue the readings of {} for InfluxDB: {}".format(device.classicName, e))
+    if readingsArchive is not None:
+        try:
+            readingsArchive.add(device.classicName, values, taken)
+        except Exception as e:
+            log.error("Unable to queue the readings of {} for the archive: {}".format(device.classicName, e))
+    if sharedState is not None:
+        try:
+            sharedState.update(device.classicName, values, taken)
+        except Exception as e:
+            log.error("Unable to share the readings of {}: {}".format(device.classicName, e))
+    if prometheusExporter is not None:
+        try:
+            prometheusExporter.update(device.classicName, values, taken, dict(metrics.counters) if metrics is not None else None)
+        except Exception as e:
+            log.error("Unable to update the Prometheus metrics of {}: {}".format(device.classicName, e))
+
+# --------------------------------------------------------------------------- # 
+# Publish the readings, as one JSON on stat/readings and/or one value per
+# field on stat/readings/<Field> depending on the readings mode. The binary
+# readings go with the JSON on stat/readingsbin. When batching, the readings
+# JSON goes on stat/readingsbatch a batch at a time instead
+# --------------------------------------------------------------------------- # 
+def publishReadings(device, data, metrics):
+    published = True
+    now = time.monotonic()
+    taken = time.time()
+    values = None
+
+    if argumentValues['readingsMode'] != "fields":
+        #When only the clock has changed, the last readings are reused with the new time
+        changed = device.connection.changed or device.lastReadings is None
+        if metrics is not None:
+            start = perf_counter()
+        if changed:
+            readings = encodeClassicData_readings(data)
+        else:
+            readings = updateClassicData_readingsTime(device.lastReadings, data)
+            if metrics is not None:
+                metrics.count("unchanged")
+        if metrics is not None:
+            start = metrics.since("encode", start)
+        device.lastReadings = readings
+
+        #In publish on change mode unchanged readings wait for the heartbeat
+        if not changed and argumentValues['publishOnChange'] and now - device.lastReadingsTime < argumentValues['heartbeatInterval']:
+            log.debug("Readings of {} have not changed, not publishing".format(device.classicName))
+            if metrics is not None:
+                metrics.count("suppressed")
+        else:
+            #Batched, the readings go out together once the batch is full or old enough
+            batch = device.readingsBatch
+            if batch is None:
+                published = mqttPublish(mqttClient,device,readings,"readings",taken=taken)
+            elif batch.add(readings, taken, now):
+                published = mqttPublish(mqttClient,device,batch.take(),batch.subtopic,taken=taken)
+            if published and argumentValues['binaryReadings']:
+                values = classicData_readings(data)
+                published = mqttPublish(mqttClient,device,encodeClassicData_readingsBinary(values),"readingsbin",taken=taken)
+            if published:
+                device.lastReadingsTime = now
+            if metrics is not None:
+                metrics.since("publish", start)
+
+    #Only the fields that moved past their deadband, all of them every refresh
+    fieldPublisher = device.fieldPublisher
+    if published and fieldPublisher is not None and (device.connection.changed or fieldPublisher.refreshDue(now)):
+        if values is None:
+            values = classicData_readings(data)
+        for field, value, payload in fieldPublisher.changes(values, now):
+            if not mqttPublish(mqttClient,device,payload,"readings/{}".format(field),retain=True):
+                published = False
+                break
+            fieldPublisher.commit(field, value)
+        if published and fieldPublisher.refreshDue(now):
+            fieldPublisher.refreshed(now)
+
+    return published
+
+# --------------------------------------------------------------------------- # 
+# Each Classic gets a task on the event loop that calls periodic every poll
+# interval. While one Classic waits on MODBUS or MQTT the others keep going.
+# --------------------------------------------------------------------------- # 
+async def pollClassic(device):
+
+    while not doStop:
+        #Get the current time as a float of seconds.
+        beforeTime = time_ns() /  1000000000.0
+
+        await periodic(device)
 
         #Account for the time that has been spent on this cycle to do the actual work
-        timeUntilNextInterval = currentPollRate - (time_ns()/1000000000.0 - beforeTime)
+        timeUntilNextInterval = device.currentPollRate - (time_ns()/1000000000.0 - beforeTime)
 
         # If doing the work took too long, skip as many polling forward so that we get a time in the future.
+        if timeUntilNextInterval < 0 and device.metrics is not None:
+            device.metrics.count("overruns")
         while (timeUntilNextInterval < 0):
             log.debug("Adjusting next interval to account for cycle taking too long: {}".format(timeUntilNextInterval))
-            timeUntilNextInterval = timeUntilNextInterval + currentPollRate 
+            timeUntilNextInterval = timeUntilNextInterval + device.currentPollRate 
             log.debug("Adjusted interval: {}".format(timeUntilNextInterval))
 
-        #log.debug("Next Interval: {}".format(timeUntilNextInterval))
-        # set myself to be called again in correct number of seconds
-        threading.Timer(timeUntilNextInterval, periodic, [modbus_stop]).start()
+        # wait to be called again in correct number of seconds
+        await asyncio.sleep(timeUntilNextInterval)
+
+# --------------------------------------------------------------------------- # 
+# The high frequency capture of a Classic, see classic_capture. It samples
+# every captureInterval milliseconds over the connection periodic keeps open
+# and publishes the window's figures on stat/capture every captureWindow.
+# --------------------------------------------------------------------------- # 
+async def captureClassic(device):
+
+    window = device.capture
+    interval = argumentValues['captureInterval'] / 1000.0
+    loop = asyncio.get_running_loop()
+    nextSample = loop.time()
+    windowEnd = nextSample + argumentValues['captureWindow']
+    window.open()
+    while not doStop:
+        try:
+            connection = device.connection
+            if connection.isConnected and connection.modbusClient is not None:
+                registers = await getRegistersAsync(connection.modbusClient, window.addr, window.count)
+                if registers:
+                    window.add(registers)
+                    if device.metrics is not None:
+                        device.metrics.count("captureSamples")
+                elif device.metrics is not None:
+                    device.metrics.count("captureErrors")
+
+            if loop.time() >= windowEnd:
+                end = datetime.now()
+                summary = window.close(end)
+                if summary["samples"] and mqttConnected:
+                    mqttPublish(mqttClient, device, json.dumps(summary), "capture", taken=end.timestamp())
+                while windowEnd <= loop.time():
+                    windowEnd += argumentValues['captureWindow']
+        except Exception as e:
+            log.error("Caught Error in the capture of {}".format(device.classicName))
+            log.exception(e, exc_info=True)
+
+        #A sample that took too long skips the ones it ran over
+        nextSample += interval
+        now = loop.time()
+        if nextSample < now:
+            nextSample += (int((now - nextSample) / interval) + 1) * interval
+        await asyncio.sleep(nextSample - now)
+
+# --------------------------------------------------------------------------- # 
+# Replay what was spooled while MQTT was down, spoolReplayRate readings a
+# second for each Classic. A batch is only taken off the spool once all of it
+# has been published, so an outage during the replay does not lose any.
+# --------------------------------------------------------------------------- # 
+async def replaySpool():
+
+    backlog = {}    #readings to replay when the replay started, for the progress
+    while not doStop:
+        await asyncio.sleep(1)
+        if not mqttConnected:
+            continue
+        try:
+            for device in devices:
+                spool = device.spool
+                if not spool.pending:
+                    continue
+                if device.classicName not in backlog:
+                    backlog[device.classicName] = spool.pending
+                    log.info("Replaying {} spooled readings of {}".format(spool.pending, device.classicName))
+
+                batch, position = spool.read(argumentValues['spoolReplayRate'])
+                published = await asyncio.gather(*[mqttPublisher.submit(topic, payload, argumentValues['mqttQos'], False, None, device.metrics) for taken, topic, payload in batch])
+                if not all(published):
+                    continue
+                spool.commit(position)
+
+                if device.metrics is not None:
+                    device.metrics.count("spoolReplayed", len(batch))
+                    device.metrics.gauge("spoolReplayProgress", round(1 - spool.pending / max(backlog[device.classicName], spool.pending, 1), 3))
+                if not spool.pending:
+                    log.info("Replayed the spooled readings of {}".format(device.classicName))
+                    del backlog[device.classicName]
+        except Exception as e:
+            log.error("Caught Error replaying the spool")
+            log.exception(e, exc_info=True)
+
+# --------------------------------------------------------------------------- # 
+# Metrics snapshot of every Classic, {classicName: snapshot}, empty when the
+# metrics are off (--metrics_interval 0)
+# --------------------------------------------------------------------------- # 
+def getMetricsSnapshot():
+    snapshots = {}
+    for device in devices:
+        if device.metrics is not None:
+            device.metrics.gauge("mqttReconnects", mqttReconnectCount)
+            # the publish stage's queue and the messages waiting for on_publish
+            device.metrics.gauge("publishQueueDepth", mqttPublisher.depth())
+            device.metrics.gauge("publishInflight", mqttPublisher.inflight())
+            if influxWriter is not None:
+                device.metrics.gauge("influxBuffered", influxWriter.buffered())
+                device.metrics.gauge("influxWritten", influxWriter.written)
+                device.metrics.gauge("influxFailed", influxWriter.failed)
+                device.metrics.gauge("influxDropped", influxWriter.dropped)
+            if readingsArchive is not None:
+                device.metrics.gauge("archiveBuffered", readingsArchive.buffered())
+                device.metrics.gauge("archiveWritten", readingsArchive.written)
+                device.metrics.gauge("archiveFailed", readingsArchive.failed)
+                device.metrics.gauge("archiveDropped", readingsArchive.dropped)
+            if device.spool is not None:
+                device.metrics.gauge("spoolPending", device.spool.pending)
+                device.metrics.gauge("spoolBytes", device.spool.totalBytes())
+                device.metrics.gauge("spoolEvicted", device.spool.evicted)
+            snapshots[device.classicName] = device.metrics.snapshot()
+    return snapshots
+
+# --------------------------------------------------------------------------- # 
+# Publish the metrics of each Classic on its tele/STATE every metricsInterval
+# --------------------------------------------------------------------------- # 
+async def publishMetrics():
+    while not doStop:
+        await asyncio.sleep(argumentValues['metricsInterval'])
+        if not mqttConnected:
+            continue
+        try:
+            for classicName, snapshot in getMetricsSnapshot().items():
+                snapshot.update(histogramLayout())
+                mqttPublisher.submit(devicesByName[classicName].topic(argumentValues['mqttRoot'], "tele/STATE"), json.dumps(snapshot))
+        except Exception as e:
+            log.error("Caught Error publishing the metrics")
+            log.exception(e, exc_info=True)
 
 # --------------------------------------------------------------------------- # 
 # Main
 # --------------------------------------------------------------------------- # 
 def run(argv):
 
-    global doStop, mqttClient, awakePublishCycles, snoozePublishCycles, currentPollRate, snoozeCycleLimit, mqttLastSOCicon, mqttLastCSicon, homeassistantEnabled
+    global doStop, mqttClient, mqttClientId, homeassistantEnabled, devices, devicesByName
 
     log.info("classic_mqtt starting up...")
 
     handleArgs(argv, argumentValues)
 
-    snoozeCycleLimit = round(argumentValues['snoozePublishRate']/argumentValues['awakePublishRate'])
-    log.debug("snoozeCycleLimit: {}".format(snoozeCycleLimit))
-
-    #Make it publish right away
-    awakePublishCycles = argumentValues['awakePublishRate']
-    snoozePublishCycles =  argumentValues['snoozePublishRate']
-
-    currentPollRate = argumentValues['awakePublishRate']
+    #Build the list of Classics to poll, either the fleet or the single Classic
+    if argumentValues['fleet']:
+        classics = argumentValues['fleet']
+    else:
+        classics = [{'host':argumentValues['classicHost'], 'port':argumentValues['classicPort'], 'name':argumentValues['classicName']}]
+
+    devices = [ClassicDevice(classic['host'], classic['port'], classic['name'], \
+                    argumentValues['awakePublishRate'], argumentValues['snoozePublishRate'], argumentValues['awakePublishLimit']) \
+                    for classic in classics]
+    devicesByName = {device.classicName: device for device in devices}
+    if argumentValues['metricsInterval'] > 0:
+        for device in devices:
+            device.metrics = ClassicMetrics()
+    if argumentValues['readingsMode'] != "json":
+        for device in devices:
+            device.fieldPublisher = FieldPublisher(argumentValues['fieldDeadbands'], argumentValues['fieldRefresh'])
+    if argumentValues['batchReadings'] > 0 or argumentValues['batchSecs'] > 0:
+        for device in devices:
+            device.readingsBatch = ReadingsBatch(argumentValues['batchReadings'], argumentValues['batchSecs'], argumentValues['batchCompress'])
+    for device in devices:
+        device.influxSeries = readingsSeries(argumentValues['influxMeasurement'], \
+                    {"classic": device.classicName, "topic": device.topic(argumentValues['mqttRoot'], "stat/readings")})
+    if argumentValues['historyHours'] > 0:
+        for device in devices:
+            device.history = ReadingsHistory(argumentValues['historyHours'], MIN_WAKE_RATE)
+        log.info("Keeping {} readings of history per Classic, {}KB each".format(devices[0].history.capacity, devices[0].history.size()//1024))
+    if argumentValues['captureInterval'] > 0:
+        for device in devices:
+            device.capture = CaptureWindow()
+    if argumentValues['spoolDir']:
+        for device in devices:
+            device.spool = ReadingsSpool(os.path.join(argumentValues['spoolDir'], device.classicName), argumentValues['spoolMaxMB']*1024*1024)
+    log.debug("snoozeCycleLimit: {}".format(devices[0].snoozeCycleLimit))
+    log.info("Polling {} Classic(s)".format(len(devices)))
 
     homeassistantEnabled = argumentValues['homeassistant']
+    if homeassistantEnabled is True and argumentValues['readingsMode'] == "fields":
+        log.warning("Home Assistant reads the readings JSON, use --readings_mode both to keep it")
+    if homeassistantEnabled is True and devices[0].readingsBatch is not None:
+        log.warning("Home Assistant reads stat/readings, which is not published when batching the readings")
 
     #random seed from the OS
     seed(int.from_bytes( os.urandom(4), byteorder="big"))
@@ -476,17 +812,64 @@ def run(argv):
     mqttErrorCount = 0
 
     #setup the MQTT Client for publishing and subscribing
-    clientId = argumentValues['mqttUser'] + "_mqttclient_" + str(randint(100, 999))
-    log.info("Connecting with clientId=" + clientId)
-    mqttClient = mqttclient.Client(mqttclient.CallbackAPIVersion.VERSION1, clientId)
-    mqttClient.username_pw_set(argumentValues['mqttUser'], password=argumentValues['mqttPassword'])
-    mqttClient.on_connect = on_connect    
-    mqttClient.on_disconnect = on_disconnect  
-    mqttClient.on_message = on_message
-
-    #Set Last Will 
-    will_topic = "{}{}/tele/LWT".format(argumentValues['mqttRoot'], argumentValues['classicName'])
-    mqttClient.will_set(will_topic, payload="Offline", qos=0, retain=False)
+    mqttClientId = argumentValues['mqttUser'] + "_mqttclient_" + str(randint(100, 999))
+    log.info("Connecting with clientId=" + mqttClientId)
+    mqttClient = newMqttClient(mqttclient.MQTTv5 if argumentValues['mqttV5'] else mqttclient.MQTTv311)
+
+    try:
+        asyncio.run(runLoop())
+    except KeyboardInterrupt:
+        log.error("Got Keyboard Interuption, exiting...")
+
+    log.info("Exiting classic_mqtt")
+
+# --------------------------------------------------------------------------- # 
+# The MQTT client, in MQTT v5 mode with paho's version 2 callbacks also when
+# it has fallen back to v3.1.1
+# --------------------------------------------------------------------------- # 
+def newMqttClient(protocol):
+    if argumentValues['mqttV5']:
+        client = mqttclient.Client(mqttclient.CallbackAPIVersion.VERSION2, mqttClientId, protocol=protocol)
+        client.on_connect = on_connect_v5
+        client.on_disconnect = on_disconnect_v5
+    else:
+        client = mqttclient.Client(mqttclient.CallbackAPIVersion.VERSION1, mqttClientId)
+        client.on_connect = on_connect
+        client.on_disconnect = on_disconnect
+    client.username_pw_set(argumentValues['mqttUser'], password=argumentValues['mqttPassword'])
+    client.on_message = on_message
+
+    #Set Last Will, there can only be one per MQTT connection so a fleet gets a will of its own
+    if len(devices) == 1:
+        will_topic = devices[0].topic(argumentValues['mqttRoot'], "tele/LWT")
+    else:
+        will_topic = "{}tele/LWT".format(argumentValues['mqttRoot'])
+    client.will_set(will_topic, payload="Offline", qos=0, retain=False)
+    return client
+
+# --------------------------------------------------------------------------- # 
+# The event loop, the MQTT client and all the Classics run on it.
+# --------------------------------------------------------------------------- # 
+async def runLoop():
+
+    global doStop, mqttReconnectCount, mqttPublisher, mqttClient, mqttFallback, influxWriter, prometheusExporter, readingsArchive, sharedState
+
+    mqttHelper = AsyncioHelper(asyncio.get_running_loop(), mqttClient)
+    mqttPublisher = MqttPublisher(mqttClient, argumentValues['publishQueue']).start()
+    mqttPublisher.onFailure = publishFailed
+    if argumentValues['influxUrl']:
+        influxWriter = InfluxWriter(argumentValues['influxUrl'], argumentValues['influxToken'], \
+                    argumentValues['influxBatch'], argumentValues['influxFlush'], argumentValues['influxBuffer']).start()
+    if argumentValues['archiveDb']:
+        try:
+            readingsArchive = await ReadingsArchive(argumentValues['archiveDb'], argumentValues['archiveFlush'], argumentValues['archiveDays']).start()
+        except Exception as e:
+            log.error("Unable to open the archive {}: {}".format(argumentValues['archiveDb'], e))
+    if argumentValues['sharedState']:
+        try:
+            sharedState = SharedStateWriter(argumentValues['sharedState'], [device.classicName for device in devices]).open()
+        except Exception as e:
+            log.error("Unable to create the shared readings {}: {}".format(argumentValues['sharedState'], e))
 
     try:
         log.info("Connecting to MQTT {}:{}".format(argumentValues['mqttHost'], argumentValues['mqttPort']))
@@ -495,31 +878,64 @@ def run(argv):
         log.error("Unable to connect to MQTT, exiting...")
         sys.exit(2)
 
-    
-    mqttClient.loop_start()
-
-
-    #define the stop for the function
-    periodic_stop = threading.Event()
-    # start calling periodic now and every 
-    periodic(periodic_stop)
+    # start polling now and every 
+    pollTasks = [asyncio.create_task(pollClassic(device), name=device.classicName) for device in devices]
+    if argumentValues['metricsInterval'] > 0:
+        pollTasks.append(asyncio.create_task(publishMetrics(), name="metrics"))
+    if argumentValues['spoolDir']:
+        pollTasks.append(asyncio.create_task(replaySpool(), name="spool"))
+    if argumentValues['captureInterval'] > 0:
+        pollTasks += [asyncio.create_task(captureClassic(device), name="{}-capture".format(device.classicName)) for device in devices]
+
+    #The MODBUS proxies, one port per Classic starting at modbusProxyPort
+    proxies = []
+    if argumentValues['modbusProxyPort'] > 0:
+        for index, device in enumerate(devices):
+            try:
+                proxies.append(await ModbusProxy(device, MODBUS_PROXY_HOST, argumentValues['modbusProxyPort'] + index, argumentValues['modbusProxyMaxAge']).start())
+            except Exception as e:
+                log.error("Unable to start the MODBUS proxy for {}".format(device.classicName))
+                log.exception(e, exc_info=True)
+
+    if argumentValues['prometheusPort'] > 0:
+        try:
+            prometheusExporter = await PrometheusExporter(PROMETHEUS_HOST, argumentValues['prometheusPort']).start()
+        except Exception as e:
+            log.error("Unable to start the Prometheus endpoint")
+            log.exception(e, exc_info=True)
 
     log.debug("Starting main loop...")
     while not doStop:
         try:            
-            time.sleep(MAIN_LOOP_SLEEP_SECS)
-            #check to see if shutdown received
-            if modbusErrorCount > MODBUS_MAX_ERROR_COUNT:
+            await asyncio.sleep(MAIN_LOOP_SLEEP_SECS)
+            #check to see if shutdown received, a fleet keeps going as long as one Classic is answering
+            if all(device.modbusErrorCount > MODBUS_MAX_ERROR_COUNT for device in devices):
                 log.error("MODBUS error count exceeded, exiting...")
                 doStop = True
             
+            #Connect again with a v3.1.1 client, the broker refused MQTT v5
+            if mqttFallback:
+                mqttFallback = False
+                mqttHelper.stop()
+                mqttClient = newMqttClient(mqttclient.MQTTv311)
+                mqttHelper = AsyncioHelper(asyncio.get_running_loop(), mqttClient)
+                mqttPublisher.setClient(mqttClient)
+                try:
+                    mqttClient.connect(host=argumentValues['mqttHost'],port=int(argumentValues['mqttPort']))
+                except Exception as e:
+                    log.error("Unable to connect to MQTT with v3.1.1: {}".format(e))
+                continue
+
             if not mqttConnected:
                 if (mqttErrorCount > MQTT_MAX_ERROR_COUNT):
                     log.error("MQTT Error count exceeded, disconnected, exiting...")
                     doStop = True
+                elif not mqttClient.is_connected():
+                    mqttReconnectCount += 1
+                    mqttHelper.reconnect()
 
-        except KeyboardInterrupt:
-            log.error("Got Keyboard Interuption, exiting...")
+        except asyncio.CancelledError:
+            log.error("Got cancelled, exiting...")
             doStop = True
         except Exception as e:
             log.error("Caught other exception...")
@@ -527,12 +943,36 @@ def run(argv):
     
     log.info("Exited the main loop, stopping other loops")
     log.info("Stopping periodic async...")
-    periodic_stop.set()
+    for task in pollTasks:
+        task.cancel()
+    await asyncio.gather(*pollTasks, return_exceptions=True)
+    for proxy in proxies:
+        await proxy.stop()
+    if prometheusExporter is not None:
+        await prometheusExporter.stop()
+    #What is left in the batches goes out with the rest of the queue
+    for device in devices:
+        if device.readingsBatch is not None and len(device.readingsBatch):
+            mqttPublish(mqttClient, device, device.readingsBatch.take(), device.readingsBatch.subtopic)
+    for device in devices:
+        device.connection.close()
+        if device.spool is not None:
+            device.spool.close()
+    await mqttPublisher.stop()
+    if influxWriter is not None:
+        await influxWriter.stop()
+    if readingsArchive is not None:
+        await readingsArchive.stop()
+    if sharedState is not None:
+        sharedState.close()
+
+    if len(devices) > 1 and mqttConnected:
+        for device in devices:
+            mqttClient.publish(device.topic(argumentValues['mqttRoot'], "tele/LWT"), "Offline",  qos=0, retain=False)
 
     log.info("Stopping MQTT loop...")
-    mqttClient.loop_stop()
-
-    log.info("Exiting classic_mqtt")
+    mqttClient.disconnect()
+    mqttHelper.stop()
 
 if __name__ == '__main__':
     run(sys.argv[1:])
\ No newline at end of file
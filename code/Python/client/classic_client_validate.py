@@ -45,7 +45,9 @@ def handleClientArgs(argv,argVals):
                      "mqtt_root=",
                      "mqtt_user=",
                      "mqtt_pass=",
-                     "file="])
+                     "file=",
+                     "binary",
+                     "shared_state="])
     except getopt.GetoptError:
         print("Error parsing command line parameters, please use: py --classic_name <{}> --mqtt <{}> --mqtt_port <{}> --mqtt_root <{}> --mqtt_user <username> --mqtt_pass <password> --file <filename>".format( \
                 argVals['classicName'], argVals['mqttHost'], argVals['mqttPort'], argVals['mqttRoot'] ))
@@ -69,6 +71,10 @@ def handleClientArgs(argv,argVals):
             argVals['mqttPassword'] = validateStrParameter(arg,"mqtt_pass", argVals['mqttPassword'])
         elif opt in ("--file"):
             argVals['file'] = validateStrParameter(arg,"file", argVals['file'])
+        elif opt in ("--binary"):
+            argVals['binary'] = True
+        elif opt in ("--shared_state"):
+            argVals['sharedState'] = validateStrParameter(arg,"shared_state", argVals['sharedState']).strip()
 
     argVals['classicName'] = argVals['classicName'].strip()
     argVals['mqttHost'] = argVals['mqttHost'].strip()
@@ -78,6 +84,8 @@ def handleClientArgs(argv,argVals):
     log.info("classicName = {}".format(argVals['classicName']))
     log.info("mqttHost = {}".format(argVals['mqttHost']))
     log.info("mqttPort = {}".format(argVals['mqttPort']))
+    log.info("binary = {}".format(argVals['binary']))
+    log.info("sharedState = {}".format(argVals['sharedState']))
     log.info("mqttRoot = {}".format(argVals['mqttRoot']))
     log.info("mqttUser = {}".format(argVals['mqttUser']))
     #log.info("mqttPassword = **********")
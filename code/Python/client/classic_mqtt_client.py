@@ -3,6 +3,7 @@
 from paho.mqtt import client as mqttclient
 from collections import OrderedDict
 import json
+import struct
 import time
 import socket
 import threading
@@ -15,6 +16,9 @@ from time import time_ns
 from datetime import datetime, timedelta
 from classic_client_validate import handleClientArgs
 
+# classic_mqtt's support folder, for the binary and shared readings
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
 
 # --------------------------------------------------------------------------- # 
 # GLOBALS
@@ -33,7 +37,9 @@ argumentValues = { \
     'mqttRoot':os.getenv('MQTT_ROOT', "ClassicMQTT"), \
     'mqttUser':os.getenv('MQTT_USER', "ClassicClient"), \
     'mqttPassword':os.getenv('MQTT_PASS', "ClassicClient123"), \
-    'file':os.getenv('FILE',"./classic_client_data.txt")}
+    'file':os.getenv('FILE',"./classic_client_data.txt"), \
+    'binary':os.getenv('BINARY', "False").lower() in ("true", "1", "yes"), \
+    'sharedState':os.getenv('SHARED_STATE', "")}
 
 chargeStateDict = {0: 'Resting',
                    3: 'Absorb',
@@ -55,6 +61,8 @@ mqttErrorCount              = 0
 mqttClient                  = None
 
 newMsg = None
+readingsSchema = None   #The schema of the binary readings, from stat/readingsbin/schema
+sharedState = None      #The classic_mqtt shared readings, read instead of MQTT with --shared_state
 
 # --------------------------------------------------------------------------- # 
 # configure the logging
@@ -76,7 +84,10 @@ def on_connect(client, userdata, flags, rc):
         log.debug("MQTT connected OK Returned code={}".format(rc))
         #subscribe to the commands
         try:
-            topic = "{}{}/stat/readings/#".format(argumentValues['mqttRoot'], argumentValues['classicName'])
+            if argumentValues['binary']:
+                topic = "{}{}/stat/readingsbin/#".format(argumentValues['mqttRoot'], argumentValues['classicName'])
+            else:
+                topic = "{}{}/stat/readings".format(argumentValues['mqttRoot'], argumentValues['classicName'])
             client.subscribe(topic)
             log.debug("Subscribed to {}".format(topic))
 
@@ -111,13 +122,25 @@ def on_message(client, userdata, message):
         #print("Received message '" + str(message.payload) + "' on topic '"
         #+ message.topic + "' with QoS " + str(message.qos))
 
-        global mqttConnected, mqttErrorCount, newMsg
+        global mqttConnected, mqttErrorCount, newMsg, readingsSchema
 
         mqttConnected = True #got a message so we must be up again...
         mqttErrorCount = 0
 
-        #Convert the JSON message to a Python object
-        theMessage = json.loads(message.payload.decode(encoding='UTF-8'))
+        if message.topic.endswith("/readingsbin/schema"):
+            readingsSchema = json.loads(message.payload.decode(encoding='UTF-8'))
+            log.debug("Got the binary readings schema version {} id {}".format(readingsSchema['version'], readingsSchema['id']))
+            return
+        elif message.topic.endswith("/readingsbin"):
+            if readingsSchema is None:
+                log.debug("No schema for the binary readings yet, skipping them")
+                return
+            theMessage = decodeReadingsBinary(message.payload, readingsSchema)
+            if theMessage is None:
+                return
+        else:
+            #Convert the JSON message to a Python object
+            theMessage = json.loads(message.payload.decode(encoding='UTF-8'))
         #log.debug(theMessage)
 
         #The message should be a "readings" packet, 
@@ -154,6 +177,82 @@ def on_message(client, userdata, message):
 
         newMsg = theMessage
 
+# --------------------------------------------------------------------------- # 
+# Decode the binary readings with their schema into the same dict as the
+# readings JSON, with classic_mqtt's decoder in support/classic_readingsschema.py.
+# The support folder is only needed with --binary and --shared_state, the
+# JSON readings only need paho-mqtt
+# --------------------------------------------------------------------------- # 
+def decodeReadingsBinary(payload, schema):
+    from support.classic_readingsschema import decodeReadings
+
+    version, schemaId = struct.unpack_from("<BH", payload)
+    if version != schema['version'] or schemaId != schema['id']:
+        log.error("Binary readings are for schema {} id {}, have {} id {}".format(version, schemaId, schema['version'], schema['id']))
+        return None
+    return decodeReadings(payload, schema, struct.Struct(schema['format']))
+
+# --------------------------------------------------------------------------- # 
+# The latest readings classic_mqtt --shared_state keeps in a memory mapped
+# file, read with classic_mqtt's SharedStateReader. classic_mqtt marks the
+# file stopped when it exits and moves a new one in place when it starts
+# again, so the file is opened again once it has been replaced
+# --------------------------------------------------------------------------- # 
+class SharedState:
+
+    def __init__(self, path, classicName):
+        self.path = path
+        self.classicName = classicName
+        self.inode = os.stat(path).st_ino
+        self.reader = self.open()
+        self.lastSequence = 0
+        self.stopped = False
+
+    def open(self):
+        from support.classic_sharedstate import SharedStateReader
+
+        reader = SharedStateReader(self.path)
+        if self.classicName not in reader.classics:
+            reader.close()
+            raise ValueError("{} has no readings for {}".format(self.path, self.classicName))
+        return reader
+
+    def followRestart(self):
+        try:
+            inode = os.stat(self.path).st_ino
+        except OSError:
+            return
+        if inode == self.inode:
+            if not self.stopped and not self.reader.running():
+                self.stopped = True
+                log.info("classic_mqtt stopped, waiting for it to start again")
+            return
+        try:
+            reader = self.open()
+        except (OSError, ValueError) as e:
+            log.debug("Unable to open the new shared readings yet: {}".format(e))
+            return
+        self.reader.close()
+        self.reader = reader
+        self.inode = inode
+        self.lastSequence = 0
+        self.stopped = False
+        log.info("classic_mqtt started again, reading the new shared readings")
+
+    # The readings if there are new ones since the last call, else None
+    def newReadings(self):
+        from support.classic_readingsschema import decodeReadings
+
+        self.followRestart()
+        try:
+            sequence, taken, payload = self.reader.slot(self.classicName)
+        except TimeoutError:
+            return None
+        if sequence == self.lastSequence or not payload:
+            return None
+        self.lastSequence = sequence
+        return decodeReadings(payload, self.reader.schema, self.reader.layout)
+
 # --------------------------------------------------------------------------- # 
 # File age check
 # --------------------------------------------------------------------------- # 
@@ -178,7 +277,7 @@ def is_file_older_than (file, delta):
 # --------------------------------------------------------------------------- # 
 def run(argv):
 
-    global doStop, mqttClient, mqttConnected, mqttErrorCount, newMsg
+    global doStop, mqttClient, mqttConnected, mqttErrorCount, newMsg, sharedState
 
     log.info("classic_mqtt_client starting up...")
 
@@ -197,34 +296,46 @@ def run(argv):
         wr.write("No data received as of {}\n".format(datetime.now().strftime("%c")))
         wr.close()
 
-    #setup the MQTT Client for publishing and subscribing
-    clientId = argumentValues['mqttUser'] + "_mqttclient_" + str(randint(100, 999))
-    log.info("Connecting with clientId=" + clientId)
-    mqttClient = mqttclient.Client(clientId) 
-    mqttClient.username_pw_set(argumentValues['mqttUser'], password=argumentValues['mqttPassword'])
-    mqttClient.on_connect = on_connect    
-    mqttClient.on_disconnect = on_disconnect  
-    mqttClient.on_message = on_message
-
-    #Set Last Will 
-    #will_topic = "{}{}/tele/LWT".format(argumentValues['mqttRoot'], argumentValues['classicName'])
-    #mqttClient.will_set(will_topic, payload="Offline", qos=0, retain=False)
+    #Read the readings classic_mqtt shares on this host, no MQTT needed
+    if argumentValues['sharedState']:
+        try:
+            sharedState = SharedState(argumentValues['sharedState'], argumentValues['classicName'])
+        except Exception as e:
+            log.error("Unable to read the shared readings {}: {}, exiting...".format(argumentValues['sharedState'], e))
+            sys.exit(2)
+        mqttConnected = True
+    else:
+        #setup the MQTT Client for publishing and subscribing
+        clientId = argumentValues['mqttUser'] + "_mqttclient_" + str(randint(100, 999))
+        log.info("Connecting with clientId=" + clientId)
+        mqttClient = mqttclient.Client(clientId) 
+        mqttClient.username_pw_set(argumentValues['mqttUser'], password=argumentValues['mqttPassword'])
+        mqttClient.on_connect = on_connect    
+        mqttClient.on_disconnect = on_disconnect  
+        mqttClient.on_message = on_message
+
+        #Set Last Will 
+        #will_topic = "{}{}/tele/LWT".format(argumentValues['mqttRoot'], argumentValues['classicName'])
+        #mqttClient.will_set(will_topic, payload="Offline", qos=0, retain=False)
 
-    try:
-        log.info("Connecting to MQTT {}:{}".format(argumentValues['mqttHost'], argumentValues['mqttPort']))
-        mqttClient.connect(host=argumentValues['mqttHost'],port=int(argumentValues['mqttPort'])) 
-    except Exception as e:
-        log.error("Unable to connect to MQTT, exiting...")
-        sys.exit(2)
+        try:
+            log.info("Connecting to MQTT {}:{}".format(argumentValues['mqttHost'], argumentValues['mqttPort']))
+            mqttClient.connect(host=argumentValues['mqttHost'],port=int(argumentValues['mqttPort'])) 
+        except Exception as e:
+            log.error("Unable to connect to MQTT, exiting...")
+            sys.exit(2)
 
 
-    mqttClient.loop_start()
+        mqttClient.loop_start()
 
     log.debug("Starting main loop...")
     while not doStop:
         try:
             time.sleep(MAIN_LOOP_SLEEP_SECS)
 
+            if sharedState is not None:
+                newMsg = sharedState.newReadings()
+
             if not mqttConnected:
                 if (mqttErrorCount > MQTT_MAX_ERROR_COUNT):
                     log.error("MQTT Error count exceeded, disconnected, exiting...")
@@ -283,8 +394,9 @@ def run(argv):
     
     log.info("Exited the main loop, stopping other loops")
 
-    log.info("Stopping MQTT loop...")
-    mqttClient.loop_stop()
+    if mqttClient is not None:
+        log.info("Stopping MQTT loop...")
+        mqttClient.loop_stop()
 
     log.info("Exiting classic_mqtt_client")
 
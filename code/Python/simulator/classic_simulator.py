@@ -0,0 +1,259 @@
+#!/usr/bin/python3
+
+# --------------------------------------------------------------------------- #
+# Classic simulator.
+# A MODBUS TCP server that answers read holding registers (function 3) like a
+# Classic does, so classic_mqtt can be run, benchmarked and soak tested without
+# a Classic on the network.
+#
+# The registers are seeded from a MODBUS export such as
+# ModbusExport_4100_Decimal_202010030844.csv. When the file has more than one
+# line, each line is a snapshot and the simulator steps through them. The
+# registers missing from the export get plausible defaults and the Classic's
+# clock follows the host clock.
+#
+# Latency, jitter, dropped connections, exception responses and the limit on
+# simultaneous connections can be set, and many simulated Classics can be run
+# on consecutive ports from one process to load test a fleet.
+#
+#    python3 simulator/classic_simulator.py --port 5020 --units 10 --latency 40
+# --------------------------------------------------------------------------- #
+
+import argparse
+import asyncio
+import datetime
+import logging
+import os
+import random
+import struct
+import sys
+
+log = logging.getLogger('classic_simulator')
+
+DEFAULT_EXPORT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "ModbusExport_4100_Decimal_202010030844.csv")
+
+MODBUS_MAX_READ_COUNT       = 125
+READ_HOLDING_REGISTERS      = 3
+ILLEGAL_FUNCTION            = 1
+ILLEGAL_DATA_ADDRESS        = 2
+ILLEGAL_DATA_VALUE          = 3
+SERVER_DEVICE_FAILURE       = 4
+
+# The register ranges that exist in the simulated Classic (address, count)
+REGISTER_RANGES = [(4100, 300), (16386, 4)]
+
+
+# --------------------------------------------------------------------------- #
+# Load a MODBUS export, one snapshot per line: "4100:1224,4101:2018,..."
+# --------------------------------------------------------------------------- #
+def loadSnapshots(path):
+    snapshots = []
+    with open(path) as export:
+        for line in export:
+            line = line.strip()
+            if line:
+                snapshots.append({int(addr): int(value) for addr, value in (pair.split(":") for pair in line.split(",") if pair)})
+    if not snapshots:
+        raise ValueError("No snapshots in {}".format(path))
+    return snapshots
+
+
+# --------------------------------------------------------------------------- #
+# Registers the export does not have, enough to make a believable Classic
+# --------------------------------------------------------------------------- #
+def defaultRegisters(unit):
+    registers = {}
+    for addr, cnt in REGISTER_RANGES:
+        for offset in range(cnt):
+            registers[addr + offset] = 0
+
+    registers[4163] = 11                                    # MPPT mode SOLAR
+    registers[4164] = (18 << 8) | 9                         # Aux2 WB Jr, Aux1 manual
+    name = "SIM{:04d}".format(unit)[:8].ljust(8, "\0")
+    for i in range(4):
+        registers[4209 + i] = (ord(name[2*i + 1]) << 8) | ord(name[2*i])
+    registers[4243] = 288                                   # VbattRegSetPTmpComp 28.8
+    registers[4244] = 24                                    # nominal battery voltage
+    registers[4245] = 30                                    # ending amps 3.0
+    registers[4274] = 111                                   # reason for resting, power up
+    registers[4370] = 25                                    # Whizbang current 2.5
+    registers[4371] = 50 + 20                               # Shunt temperature 20C
+    registers[4372] = 87                                    # SOC
+    registers[4376] = 350                                   # remaining Ah
+    registers[4380] = 400                                   # total Ah
+    registers[16386] = 1849                                 # app rev
+    registers[16388] = 1839                                 # net rev
+    return registers
+
+
+def setClock(registers, now):
+    ctime0 = now.second | (now.minute << 8) | (now.hour << 16) | (now.isoweekday() % 7 << 24)
+    ctime1 = now.day | (now.month << 8) | (now.year << 16)
+    ctime2 = now.timetuple().tm_yday
+    for i, value in enumerate((ctime0, ctime1, ctime2)):
+        registers[4213 + 2*i] = value & 0xFFFF
+        registers[4214 + 2*i] = value >> 16
+
+
+# --------------------------------------------------------------------------- #
+# One simulated Classic
+# --------------------------------------------------------------------------- #
+class ClassicSimulator:
+
+    def __init__(self, port, unit=0, snapshots=None, snapshotSecs=5.0, latency=0.0, jitter=0.0,
+                 dropRate=0.0, exceptionRate=0.0, maxConnections=2, noise=False, host="127.0.0.1"):
+        self.host = host
+        self.port = port
+        self.unit = unit
+        self.snapshots = snapshots or [{}]
+        self.snapshotSecs = snapshotSecs
+        self.latency = latency              #seconds added to every answer
+        self.jitter = jitter                #up to this many seconds more
+        self.dropRate = dropRate            #chance of dropping the connection on a request
+        self.exceptionRate = exceptionRate  #chance of answering with an exception
+        self.maxConnections = maxConnections
+        self.noise = noise                  #make the readings move
+        self.random = random.Random(port)
+
+        self.connections = 0
+        self.requests = 0
+        self.refused = 0
+        self.dropped = 0
+        self.exceptions = 0
+        self.server = None
+        self.started = None
+        self.writers = set()
+
+        self.base = defaultRegisters(unit)
+
+    # --------------------------------------------------------------------------- #
+    # The registers as they are right now
+    # --------------------------------------------------------------------------- #
+    def registers(self):
+        loop = asyncio.get_running_loop()
+        index = int((loop.time() - self.started) / self.snapshotSecs) % len(self.snapshots)
+        registers = dict(self.base)
+        registers.update(self.snapshots[index])
+        setClock(registers, datetime.datetime.now())
+        if self.noise:
+            for addr, spread in ((4114, 2), (4115, 20), (4116, 5), (4118, 40), (4120, 5), (4370, 5)):
+                registers[addr] = max(0, registers[addr] + self.random.randint(-spread, spread)) & 0xFFFF
+        return registers
+
+    def answer(self, pdu):
+        function = pdu[0]
+        if function != READ_HOLDING_REGISTERS:
+            return bytes([function | 0x80, ILLEGAL_FUNCTION])
+        if len(pdu) < 5:
+            return bytes([function | 0x80, ILLEGAL_DATA_VALUE])
+        addr, cnt = struct.unpack(">HH", pdu[1:5])
+        if cnt < 1 or cnt > MODBUS_MAX_READ_COUNT:
+            return bytes([function | 0x80, ILLEGAL_DATA_VALUE])
+        if self.exceptionRate and self.random.random() < self.exceptionRate:
+            self.exceptions += 1
+            return bytes([function | 0x80, SERVER_DEVICE_FAILURE])
+        registers = self.registers()
+        values = [registers.get(a) for a in range(addr, addr + cnt)]
+        if None in values:
+            return bytes([function | 0x80, ILLEGAL_DATA_ADDRESS])
+        return struct.pack(">BB{}H".format(cnt), function, cnt * 2, *values)
+
+    async def handle(self, reader, writer):
+        if self.connections >= self.maxConnections:
+            # The Classic only takes a few connections, the rest get closed
+            self.refused += 1
+            writer.close()
+            return
+        self.connections += 1
+        self.writers.add(writer)
+        try:
+            while True:
+                header = await reader.readexactly(7)
+                transaction, protocol, length, unitId = struct.unpack(">HHHB", header)
+                pdu = await reader.readexactly(length - 1)
+                self.requests += 1
+
+                if self.dropRate and self.random.random() < self.dropRate:
+                    self.dropped += 1
+                    break
+
+                delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+                if delay:
+                    await asyncio.sleep(delay)
+
+                response = self.answer(pdu)
+                writer.write(struct.pack(">HHHB", transaction, protocol, len(response) + 1, unitId) + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.connections -= 1
+            self.writers.discard(writer)
+            writer.close()
+
+    async def start(self):
+        self.started = asyncio.get_running_loop().time()
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        log.info("Simulated Classic {} listening on {}:{}".format(self.unit, self.host, self.port))
+        return self
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            for writer in list(self.writers):
+                writer.close()
+            await self.server.wait_closed()
+
+    def stats(self):
+        return {'port': self.port, 'requests': self.requests, 'refused': self.refused,
+                'dropped': self.dropped, 'exceptions': self.exceptions}
+
+
+# --------------------------------------------------------------------------- #
+# Start count simulated Classics on consecutive ports
+# --------------------------------------------------------------------------- #
+async def startSimulators(count, basePort, **kwargs):
+    return [await ClassicSimulator(basePort + unit, unit, **kwargs).start() for unit in range(count)]
+
+
+def run(argv):
+    parser = argparse.ArgumentParser(description="Simulate Classics on MODBUS TCP")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=5020, help="port of the first simulated Classic")
+    parser.add_argument("--units", type=int, default=1, help="number of simulated Classics, on consecutive ports")
+    parser.add_argument("--export", default=DEFAULT_EXPORT, help="MODBUS export or capture to seed the registers from")
+    parser.add_argument("--snapshot_secs", type=float, default=5.0, help="seconds per snapshot when the capture has several")
+    parser.add_argument("--latency", type=float, default=0.0, help="milliseconds added to every answer")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many milliseconds more")
+    parser.add_argument("--drop_rate", type=float, default=0.0, help="chance of dropping the connection on a request")
+    parser.add_argument("--exception_rate", type=float, default=0.0, help="chance of answering with an exception")
+    parser.add_argument("--max_connections", type=int, default=2, help="simultaneous connections per Classic")
+    parser.add_argument("--noise", action="store_true", help="make the PV and battery readings move")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=os.getenv("LOGLEVEL", "INFO"), format='%(asctime)s:%(levelname)s:%(name)s:%(message)s')
+
+    snapshots = loadSnapshots(args.export) if args.export else None
+
+    async def main():
+        simulators = await startSimulators(args.units, args.port, snapshots=snapshots, snapshotSecs=args.snapshot_secs,
+                                           latency=args.latency / 1000.0, jitter=args.jitter / 1000.0,
+                                           dropRate=args.drop_rate, exceptionRate=args.exception_rate,
+                                           maxConnections=args.max_connections, noise=args.noise, host=args.host)
+        try:
+            while True:
+                await asyncio.sleep(60)
+                log.info("Requests: {}".format(sum(s.requests for s in simulators)))
+        finally:
+            for simulator in simulators:
+                log.info(simulator.stats())
+                await simulator.stop()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    run(sys.argv[1:])
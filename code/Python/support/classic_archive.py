@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------------------------- #
+# Local archive of the readings in SQLite.
+# Every reading of every Classic goes in one row of the readings table, the
+# time it was taken (ts, milliseconds since the epoch), the Classic's name
+# and a column per field with the field's type (INTEGER for the counts and
+# the true/false fields, REAL for the scaled ones, TEXT for the texts), so
+# the history of a site survives broker and network outages and can be
+# read back without MQTT:
+#
+#    python3 -m support.classic_archive classic_archive.db --hours 24 > day.csv
+#
+# The database is in WAL mode with synchronous=NORMAL, the readings wait in
+# a buffer and are inserted together in one transaction every flushSecs
+# (or once BATCH_ROWS are waiting), which keeps the writes to an SD card few
+# and large. The inserts run on a worker thread, polling never waits on the
+# disk; when the disk is slower than the readings come in the buffer holds
+# at most MAX_BUFFER_ROWS, the oldest are dropped past that. Rows older than
+# retentionDays are deleted once an hour, ts is indexed for that and for the
+# queries.
+# --------------------------------------------------------------------------- #
+
+import argparse
+import asyncio
+import csv
+import logging
+import sqlite3
+import sys
+import time
+from collections import deque
+from datetime import datetime
+from operator import itemgetter
+
+from support.classic_binaryencoder import READINGS_LAYOUT
+from support.classic_jsonencoder import READINGS_KEYS
+
+log = logging.getLogger('classic_mqtt')
+
+ARCHIVE_SKIPPED = ("currentTime", "ChargeStateIcon", "SOCicon")    #the Classic's clock and the icons are not kept
+BATCH_ROWS = 500            #rows that start a write before flushSecs is up
+MAX_BUFFER_ROWS = 10000     #rows kept while the disk can't keep up
+PRUNE_SECS = 3600           #how often the rows past the retention are deleted
+
+
+# --------------------------------------------------------------------------- #
+# (name, SQLite type) of the field columns
+# --------------------------------------------------------------------------- #
+def archiveColumns():
+    columns = []
+    for name, kind, scale in READINGS_LAYOUT:
+        if name in ARCHIVE_SKIPPED:
+            continue
+        if kind == "text":
+            columns.append((name, "TEXT"))
+        elif scale is not None:
+            columns.append((name, "REAL"))
+        else:
+            columns.append((name, "INTEGER"))
+    return columns
+
+
+ARCHIVE_COLUMNS = archiveColumns()
+getArchived = itemgetter(*[READINGS_KEYS.index(name) for name, columnType in ARCHIVE_COLUMNS])
+
+INSERT_SQL = "INSERT INTO readings (ts, classic, {}) VALUES (?, ?, {})".format(
+    ", ".join(name for name, columnType in ARCHIVE_COLUMNS), ", ".join("?" for column in ARCHIVE_COLUMNS))
+
+
+# --------------------------------------------------------------------------- #
+# Open the database, creating the table and index, and adding the columns of
+# fields that are new since it was created
+# --------------------------------------------------------------------------- #
+def openArchive(path):
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    with connection:
+        connection.execute("CREATE TABLE IF NOT EXISTS readings (ts INTEGER NOT NULL, classic TEXT NOT NULL, {})".format(
+            ", ".join("{} {}".format(name, columnType) for name, columnType in ARCHIVE_COLUMNS)))
+        connection.execute("CREATE INDEX IF NOT EXISTS readings_ts ON readings (ts)")
+        existing = [row[1] for row in connection.execute("PRAGMA table_info(readings)")]
+        for name, columnType in ARCHIVE_COLUMNS:
+            if name not in existing:
+                connection.execute("ALTER TABLE readings ADD COLUMN {} {}".format(name, columnType))
+    return connection
+
+
+class ReadingsArchive:
+
+    def __init__(self, path, flushSecs, retentionDays):
+        self.path = path
+        self.flushSecs = flushSecs
+        self.retentionDays = retentionDays  #0 keeps everything
+        self.connection = None
+        self.rows = deque()
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.stopping = False
+        self.lastPrune = None   #monotonic time of the last prune
+
+        self.written = 0        #rows inserted
+        self.failed = 0         #writes that failed, the rows are tried again
+        self.dropped = 0        #rows dropped from the full buffer
+        self.pruned = 0         #rows deleted past the retention
+
+    def buffered(self):
+        return len(self.rows)
+
+    # --------------------------------------------------------------------------- #
+    # Queue the readings (readingsValues) of a Classic taken at taken (seconds
+    # since the epoch), the oldest row is dropped when the buffer is full
+    # --------------------------------------------------------------------------- #
+    def add(self, classicName, values, taken):
+        if len(self.rows) >= MAX_BUFFER_ROWS:
+            self.rows.popleft()
+            self.dropped += 1
+        self.rows.append((int(taken * 1000), classicName) + getArchived(values))
+        if len(self.rows) >= BATCH_ROWS:
+            self.wakeup.set()
+
+    # --------------------------------------------------------------------------- #
+    # Run on a worker thread: insert the rows in one transaction, and delete
+    # the ones past the retention in another
+    # --------------------------------------------------------------------------- #
+    def write(self, rows):
+        with self.connection:
+            self.connection.executemany(INSERT_SQL, rows)
+
+    def prune(self):
+        with self.connection:
+            cursor = self.connection.execute("DELETE FROM readings WHERE ts < ?", (int((time.time() - self.retentionDays * 86400) * 1000),))
+        self.pruned += cursor.rowcount
+
+    def pruneDue(self):
+        return self.retentionDays and (self.lastPrune is None or time.monotonic() - self.lastPrune >= PRUNE_SECS)
+
+    # --------------------------------------------------------------------------- #
+    # The rows are put back only when their insert failed, a failed prune is
+    # tried again at the next PRUNE_SECS
+    # --------------------------------------------------------------------------- #
+    async def flush(self):
+        if not self.rows:
+            return
+        rows = list(self.rows)
+        self.rows.clear()
+        try:
+            await asyncio.to_thread(self.write, rows)
+            self.written += len(rows)
+        except sqlite3.Error as e:
+            log.error("Unable to write {} readings to the archive: {}".format(len(rows), e))
+            self.failed += 1
+            self.rows.extendleft(reversed(rows))
+            while len(self.rows) > MAX_BUFFER_ROWS:
+                self.rows.popleft()
+                self.dropped += 1
+            return
+
+        if self.pruneDue():
+            self.lastPrune = time.monotonic()
+            try:
+                await asyncio.to_thread(self.prune)
+            except sqlite3.Error as e:
+                log.error("Unable to prune the archive: {}".format(e))
+
+    # --------------------------------------------------------------------------- #
+    # The write task. It is not cancelled, a write cancelled half way could be
+    # in the database and still put back; it is woken up to stop instead
+    # --------------------------------------------------------------------------- #
+    async def run(self):
+        while not self.stopping:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flushSecs)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+
+    async def start(self):
+        self.connection = await asyncio.to_thread(openArchive, self.path)
+        self.task = asyncio.get_running_loop().create_task(self.run(), name="archive")
+        log.info("Archiving the readings in {}".format(self.path))
+        return self
+
+    # --------------------------------------------------------------------------- #
+    # Write what is left and close the database
+    # --------------------------------------------------------------------------- #
+    async def stop(self):
+        if self.task is not None:
+            self.stopping = True
+            self.wakeup.set()
+            await asyncio.gather(self.task, return_exceptions=True)
+        if self.connection is not None:
+            await self.flush()
+            await asyncio.to_thread(self.connection.close)
+            log.info("Archive has {} readings written, {} dropped, {} pruned, {} left unwritten".format(self.written, self.dropped, self.pruned, len(self.rows)))
+
+
+# --------------------------------------------------------------------------- #
+# The query CLI, the readings of a time range as CSV on stdout
+# --------------------------------------------------------------------------- #
+def parseTime(text):
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(text, fmt).timestamp()
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("{} is not a time, use seconds since the epoch or YYYY-MM-DD[ HH:MM[:SS]]".format(text))
+
+
+def run(argv):
+    parser = argparse.ArgumentParser(description="Export archived Classic readings as CSV")
+    parser.add_argument("database", help="the --archive_db database")
+    parser.add_argument("--start", type=parseTime, help="from this local time (YYYY-MM-DD[ HH:MM[:SS]]) or seconds since the epoch")
+    parser.add_argument("--end", type=parseTime, help="up to this time, default now")
+    parser.add_argument("--hours", type=float, help="the last hours, instead of --start")
+    parser.add_argument("--classic", help="only this Classic")
+    parser.add_argument("--fields", help="comma separated fields, default all")
+    args = parser.parse_args(argv)
+
+    end = args.end if args.end is not None else time.time()
+    start = end - args.hours * 3600 if args.hours is not None else (args.start if args.start is not None else 0)
+    fields = [name for name, columnType in ARCHIVE_COLUMNS]
+    if args.fields:
+        unknown = [name for name in args.fields.split(",") if name not in fields]
+        if unknown:
+            print("No field {} in the archive".format(", ".join(unknown)), file=sys.stderr)
+            sys.exit(2)
+        fields = args.fields.split(",")
+
+    sql = "SELECT ts, classic, {} FROM readings WHERE ts >= ? AND ts <= ?".format(", ".join(fields))
+    parameters = [int(start * 1000), int(end * 1000)]
+    if args.classic:
+        sql += " AND classic = ?"
+        parameters.append(args.classic)
+    sql += " ORDER BY ts"
+
+    connection = sqlite3.connect("file:{}?mode=ro".format(args.database), uri=True)
+    writer = csv.writer(sys.stdout, lineterminator="\n")
+    writer.writerow(["time", "ts", "classic"] + fields)
+    for row in connection.execute(sql, parameters):
+        writer.writerow([datetime.fromtimestamp(row[0] / 1000).strftime("%Y-%m-%d %H:%M:%S")] + list(row))
+    connection.close()
+
+
+if __name__ == "__main__":
+    run(sys.argv[1:])
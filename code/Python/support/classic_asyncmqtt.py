@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------------------------- #
+# Drive the paho MQTT client from an asyncio event loop instead of the paho
+# network thread. The client socket is watched by the event loop and paho's
+# loop_read/loop_write/loop_misc are called from it, so the MQTT callbacks run
+# on the same thread as the MODBUS polling.
+# --------------------------------------------------------------------------- #
+
+import asyncio
+import logging
+
+from paho.mqtt import client as mqttclient
+
+log = logging.getLogger('classic_mqtt')
+
+MISC_LOOP_SECS = 1      #How often paho gets to handle keep alives and retries
+
+
+class AsyncioHelper:
+
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.misc = None
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        if self.misc is None or self.misc.done():
+            self.misc = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def misc_loop(self):
+        while self.client.loop_misc() == mqttclient.MQTT_ERR_SUCCESS:
+            try:
+                await asyncio.sleep(MISC_LOOP_SECS)
+            except asyncio.CancelledError:
+                break
+
+    # --------------------------------------------------------------------------- #
+    # Without the paho thread nobody reconnects for us, the main loop calls this
+    # --------------------------------------------------------------------------- #
+    def reconnect(self):
+        try:
+            log.debug("Reconnecting to MQTT")
+            self.client.reconnect()
+            return True
+        except Exception as e:
+            log.error("MQTT reconnect failed: {}".format(e))
+            return False
+
+    def stop(self):
+        if self.misc is not None:
+            self.misc.cancel()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------------------------- #
+# Bulk decoding of recorded register snapshots with NumPy.
+# Each block is given as an N x count array of uint16 registers (one row per
+# snapshot) and decoded into one column per field of doDecode, using the same
+# byte/word order, signedness and scaling as REGISTER_MAP. Needs numpy:
+#    pip install numpy
+#
+# Snapshots can be loaded from a MODBUS export (ModbusExport_4100_Decimal_*.csv,
+# one line of address:value pairs per snapshot) or from a binary dump of
+# consecutive snapshots of uint16 registers.
+#
+#    python3 -m support.classic_batchdecoder <export.csv|dump.bin> [--addr 4100]
+# writes the decoded columns as CSV to stdout.
+# --------------------------------------------------------------------------- #
+
+from collections import OrderedDict
+import argparse
+import sys
+
+import numpy as np
+
+from support.classic_registermap import (
+    REGISTER_MAP,
+    COMPILED_MAP,
+    U8_MSB,
+    U8_LSB,
+    I8_MSB,
+    I8_LSB,
+    U16,
+    I16,
+    U32,
+    I32,
+    WORD_BIG,
+)
+
+
+# --------------------------------------------------------------------------- #
+# Decode one column out of the registers
+# --------------------------------------------------------------------------- #
+def decodeColumn(registers, index, kind, wordorder):
+    column = registers[:, index]
+    if kind is U8_MSB:
+        return (column >> 8).astype(np.uint8)
+    if kind is U8_LSB:
+        return (column & 0xFF).astype(np.uint8)
+    if kind is I8_MSB:
+        return (column >> 8).astype(np.uint8).view(np.int8)
+    if kind is I8_LSB:
+        return (column & 0xFF).astype(np.uint8).view(np.int8)
+    if kind is U16:
+        return column.copy()
+    if kind is I16:
+        return column.view(np.int16).copy()
+    if kind is U32 or kind is I32:
+        low, high = column, registers[:, index + 1]
+        if wordorder == WORD_BIG:
+            low, high = high, low
+        value = low.astype(np.uint32) | (high.astype(np.uint32) << 16)
+        return value.view(np.int32) if kind is I32 else value
+    raise ValueError("Unknown field type {}".format(kind))
+
+
+# --------------------------------------------------------------------------- #
+# Decode an N x count array of the block at addr into columns
+# --------------------------------------------------------------------------- #
+def decodeBatch(addr, registers):
+    registers = np.ascontiguousarray(registers, dtype=np.uint16)
+    if registers.ndim != 2 or registers.shape[1] < COMPILED_MAP[addr].count:
+        raise ValueError(
+            "Block {} needs N x {} registers, got {}".format(
+                addr, COMPILED_MAP[addr].count, registers.shape
+            )
+        )
+
+    columns = OrderedDict()
+    for name, fieldAddr, kind, scale, offset, wordorder in REGISTER_MAP[addr]:
+        if kind is None:  # skipped registers are not data
+            continue
+        value = decodeColumn(registers, fieldAddr - addr, kind, wordorder)
+        if scale is not None:
+            value = value / scale
+        if offset is not None:
+            value = value + offset
+        columns[name] = value
+    return columns
+
+
+# --------------------------------------------------------------------------- #
+# Decode all the blocks found in {addr: N x count array}
+# --------------------------------------------------------------------------- #
+def decodeSnapshots(blocks):
+    columns = OrderedDict()
+    for addr in blocks:
+        columns.update(decodeBatch(addr, blocks[addr]))
+    return columns
+
+
+# --------------------------------------------------------------------------- #
+# Cut the blocks of REGISTER_MAP out of snapshots that start at firstAddr
+# --------------------------------------------------------------------------- #
+def blocksFromSnapshots(firstAddr, registers):
+    blocks = OrderedDict()
+    for addr, block in COMPILED_MAP.items():
+        start = addr - firstAddr
+        if start >= 0 and start + block.count <= registers.shape[1]:
+            blocks[addr] = registers[:, start : start + block.count]
+    return blocks
+
+
+# --------------------------------------------------------------------------- #
+# Load a MODBUS export, one snapshot per line: "4100:1224,4101:2018,..."
+# Returns the first address and an N x count uint16 array
+# --------------------------------------------------------------------------- #
+def loadModbusExport(path):
+    rows = []
+    addresses = None
+    with open(path) as export:
+        for line in export:
+            line = line.strip()
+            if not line:
+                continue
+            pairs = [pair.split(":") for pair in line.split(",") if pair]
+            lineAddresses = [int(addr) for addr, value in pairs]
+            if addresses is None:
+                addresses = lineAddresses
+                if addresses != list(range(addresses[0], addresses[0] + len(addresses))):
+                    raise ValueError("The registers in {} are not consecutive".format(path))
+            elif lineAddresses != addresses:
+                raise ValueError("The snapshots in {} have different registers".format(path))
+            rows.append([int(value) for addr, value in pairs])
+    if addresses is None:
+        raise ValueError("No snapshots in {}".format(path))
+    return addresses[0], np.array(rows, dtype=np.uint16)
+
+
+# --------------------------------------------------------------------------- #
+# Load a binary dump of consecutive snapshots of count uint16 registers
+# byteorder is "<" (little endian) or ">" (big endian, as on the wire)
+# --------------------------------------------------------------------------- #
+def loadBinaryDump(path, count, byteorder="<"):
+    registers = np.fromfile(path, dtype=np.dtype(byteorder + "u2"))
+    if registers.size % count:
+        raise ValueError("{} is not a whole number of {} register snapshots".format(path, count))
+    return registers.reshape(-1, count).astype(np.uint16)
+
+
+def run(argv):
+    parser = argparse.ArgumentParser(description="Decode recorded Classic register snapshots")
+    parser.add_argument("file", help="MODBUS export (.csv) or binary dump")
+    parser.add_argument("--addr", type=int, default=4100, help="address of the first register in a binary dump")
+    parser.add_argument("--count", type=int, default=64, help="registers per snapshot in a binary dump")
+    parser.add_argument("--big_endian", action="store_true", help="the binary dump is big endian")
+    args = parser.parse_args(argv)
+
+    if args.file.lower().endswith(".csv"):
+        firstAddr, registers = loadModbusExport(args.file)
+    else:
+        firstAddr = args.addr
+        registers = loadBinaryDump(args.file, args.count, ">" if args.big_endian else "<")
+
+    columns = decodeSnapshots(blocksFromSnapshots(firstAddr, registers))
+    if not columns:
+        print("No complete register block in {}".format(args.file), file=sys.stderr)
+        sys.exit(2)
+
+    print(",".join(columns))
+    for row in zip(*(column.tolist() for column in columns.values())):
+        print(",".join(str(value) for value in row))
+
+
+if __name__ == "__main__":
+    run(sys.argv[1:])
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------------------------- #
+# Compact binary readings.
+# The readings JSON is mostly key names and text that hardly ever changes.
+# The binary readings are the same values packed in a fixed little endian
+# struct layout, described by a schema that is published retained once:
+#
+#    header      B version, H schema id (the low 16 bits of the CRC32 of the
+#                schema), so a consumer knows the schema it needs
+#    fields      in the order of the readings JSON, numbers as the integer
+#                they were decoded from (divided by scale gives the value),
+#                texts as an index in the schema's strings
+#    tail        texts that are not in the strings (index 255), each as a
+#                B length and UTF-8 bytes, in field order
+#
+# Decoding with the schema gives the same values as the readings JSON, the
+# decoder is decodeReadings in classic_readingsschema.py.
+# --------------------------------------------------------------------------- #
+
+import logging
+
+from support.classic_readingsschema import (
+    SCHEMA_VERSION,
+    INLINE_TEXT,
+    READINGS_LAYOUT,
+    STRINGS,
+    STRING_INDEX,
+    READINGS_STRUCT,
+    SCHEMA,
+    SCHEMA_JSON,
+)
+
+log = logging.getLogger('classic_mqtt')
+
+
+# --------------------------------------------------------------------------- #
+# Pack the readings (classicData_readings) into the binary readings
+# --------------------------------------------------------------------------- #
+def encodeClassicData_readingsBinary(readings):
+    values = [SCHEMA_VERSION, SCHEMA["id"]]
+    tail = b''
+    for name, kind, scale in READINGS_LAYOUT:
+        value = readings[name]
+        if kind == "datetime":
+            # "YYYY-MM-DD HH:MM:SS"
+            values += (int(value[0:4]), int(value[5:7]), int(value[8:10]), int(value[11:13]), int(value[14:16]), int(value[17:19]))
+        elif kind == "text":
+            index = STRING_INDEX.get(value, INLINE_TEXT)
+            if index == INLINE_TEXT:
+                # at most 255 bytes, cut between characters
+                text = value.encode("utf-8")[:255].decode("utf-8", "ignore").encode("utf-8")
+                tail += bytes([len(text)]) + text
+            values.append(index)
+        elif scale is not None:
+            values.append(int(round(value * scale)))
+        else:
+            values.append(value)
+    return READINGS_STRUCT.pack(*values) + tail
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------------------------- #
+# High frequency capture.
+# To see the MPPT sweeps, the capture reads the registers of the fast moving
+# readings (Power, PVVoltage, PVCurrent and BatCurrent) every 100 to 500ms
+# in a single MODBUS request, over the connection classic_mqtt already has
+# open. Rather than publishing every sample, the samples of a window are
+# summed up into the count, min, max, mean and last value of each field and
+# one message is published per window on stat/capture:
+#
+#    {"start": "2024-06-01 12:00:00", "end": "2024-06-01 12:00:10",
+#     "samples": 50, "Power": {"min": 210.0, "max": 238.0, "mean": 226.4,
+#     "last": 233.0, "count": 50}, ...}
+#
+# The window keeps its figures in one array('d') that is reused for every
+# window, adding a sample does not allocate anything but the values.
+# --------------------------------------------------------------------------- #
+
+import logging
+from array import array
+from datetime import datetime
+
+from support.classic_registermap import REGISTER_MAP, U16, I16
+
+log = logging.getLogger('classic_mqtt')
+
+CAPTURE_FIELDS = ("Power", "PVVoltage", "PVCurrent", "BatCurrent")
+
+SUM, MIN, MAX, LAST = range(4)    #the figures kept for each field
+FIGURES = 4
+
+
+# --------------------------------------------------------------------------- #
+# The register range covering the fields, and each field's (offset in it,
+# signed, scale) taken from the register map
+# --------------------------------------------------------------------------- #
+def captureLayout(fields=CAPTURE_FIELDS):
+    mapped = {}
+    for block in REGISTER_MAP.values():
+        for name, addr, kind, scale, offset, wordorder in block:
+            if name in fields and kind in (U16, I16):
+                mapped[name] = (addr, kind is I16, scale or 1.0)
+    missing = [name for name in fields if name not in mapped]
+    if missing:
+        raise ValueError("No single register field {} in the register map".format(", ".join(missing)))
+    first = min(addr for addr, signed, scale in mapped.values())
+    last = max(addr for addr, signed, scale in mapped.values())
+    return first, last - first + 1, [(mapped[name][0] - first, mapped[name][1], mapped[name][2]) for name in fields]
+
+
+class CaptureWindow:
+
+    def __init__(self, fields=CAPTURE_FIELDS):
+        self.fields = tuple(fields)
+        self.addr, self.count, self.layout = captureLayout(self.fields)
+        self.layout = [(index * FIGURES, offset, signed, scale) for index, (offset, signed, scale) in enumerate(self.layout)]
+        self.figures = array('d', bytes(8 * FIGURES * len(self.fields)))
+        self.samples = 0
+        self.start = None
+
+    # --------------------------------------------------------------------------- #
+    # Add the registers read from addr for count
+    # --------------------------------------------------------------------------- #
+    def add(self, registers):
+        figures = self.figures
+        first = self.samples == 0
+        for base, offset, signed, scale in self.layout:
+            raw = registers[offset]
+            if signed and raw >= 0x8000:
+                raw -= 0x10000
+            value = raw / scale
+            figures[base + SUM] += value
+            figures[base + LAST] = value
+            if first or value < figures[base + MIN]:
+                figures[base + MIN] = value
+            if first or value > figures[base + MAX]:
+                figures[base + MAX] = value
+        self.samples += 1
+
+    # --------------------------------------------------------------------------- #
+    # The figures of the window as a dict, and start a new window
+    # --------------------------------------------------------------------------- #
+    def close(self, end):
+        figures = self.figures
+        summary = {"start": self.start.strftime("%Y-%m-%d %H:%M:%S") if self.start else None,
+                   "end": end.strftime("%Y-%m-%d %H:%M:%S"),
+                   "samples": self.samples}
+        for name, (base, offset, signed, scale) in zip(self.fields, self.layout):
+            if self.samples:
+                summary[name] = {"min": figures[base + MIN], "max": figures[base + MAX],
+                                 "mean": round(figures[base + SUM] / self.samples, 3),
+                                 "last": figures[base + LAST], "count": self.samples}
+        for index in range(len(figures)):
+            figures[index] = 0.0
+        self.samples = 0
+        self.start = end
+        return summary
+
+    def open(self, start=None):
+        self.start = start or datetime.now()
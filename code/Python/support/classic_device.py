@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------------------------- #
+# The state kept for each Classic being polled.
+# A single classic_mqtt process can poll a fleet of Classics, each one has its
+# own MODBUS connection, awake/snooze state machine and MQTT topics.
+# --------------------------------------------------------------------------- #
+
+import logging
+
+from support.classic_modbusdecoder import ModbusConnection
+
+log = logging.getLogger('classic_mqtt')
+
+
+class ClassicDevice:
+
+    def __init__(self, classicHost, classicPort, classicName, awakePublishRate, snoozePublishRate, awakePublishLimit):
+        self.classicHost = classicHost
+        self.classicPort = classicPort
+        self.classicName = classicName
+        self.connection = ModbusConnection(classicHost, classicPort)
+
+        self.awakePublishRate = awakePublishRate
+        self.snoozePublishRate = snoozePublishRate
+        self.awakePublishLimit = awakePublishLimit
+
+        # Counters and status variables
+        self.infoPublished = False
+        self.stayAwake = False
+        self.modeAwake = False
+
+        self.modbusErrorCount = 0
+        self.awakePublishCount = 0      #How many publishes have I done?
+        self.awakePublishCycles = awakePublishRate      #Make it publish right away
+        self.snoozePublishCycles = snoozePublishRate    #How many cycles have gone by?
+        self.snoozeCycleLimit = round(snoozePublishRate/awakePublishRate)    #How many cycles before I publish in snooze mode (changes with wake rate)
+        self.currentPollRate = awakePublishRate
+
+        # Per stage timings and counters, a ClassicMetrics when they are turned on
+        self.metrics = None
+
+        # The last readings published and when, for change detection
+        self.lastReadings = None
+        self.lastReadingsTime = 0
+
+        # Publishes the readings one topic per field, a FieldPublisher in the
+        # fields and both readings modes
+        self.fieldPublisher = None
+
+        # Keeps the readings while MQTT is down, a ReadingsSpool when --spool_dir is given
+        self.spool = None
+
+        # Gathers the readings to publish them together, a ReadingsBatch when batching
+        self.readingsBatch = None
+
+        # The recent readings for history requests, a ReadingsHistory when --history_hours is given
+        self.history = None
+
+        # "measurement,tag=value,..." of the readings written to InfluxDB
+        self.influxSeries = None
+
+        # The high frequency capture's window, a CaptureWindow when --capture_interval is given
+        self.capture = None
+
+        # Home Assistant
+        self.mqttDeviceModel = 'Classic'
+        self.mqttDeviceFirmware = ''
+        self.haDiscoveryPublished = None    #fingerprint of the discovery last published
+        self.haDiscoveryAck = None          #future of its publish, the state waits for it
+
+    # --------------------------------------------------------------------------- #
+    # Build the topic for this Classic
+    # --------------------------------------------------------------------------- #
+    def topic(self, mqttRoot, subtopic):
+        return "{}{}/{}".format(mqttRoot, self.classicName, subtopic)
+
+    # --------------------------------------------------------------------------- #
+    # Change the wake rate and the number of wake cycles per snooze publish
+    # --------------------------------------------------------------------------- #
+    def setAwakePublishRate(self, newRate):
+        self.awakePublishRate = newRate
+        self.currentPollRate = newRate
+        self.snoozeCycleLimit = round(self.snoozePublishRate/self.awakePublishRate)
+
+    # --------------------------------------------------------------------------- #
+    # Test to see if it is time to gather data and publish.
+    # This is called every cycle, so this method figures out if it is time to
+    # publish based on the mode (awake or snoozing) and the frequency rates
+    # --------------------------------------------------------------------------- #
+    def timeToPublish(self):
+        if (self.modeAwake):
+            #We remain awake for a number of publishes
+            if self.awakePublishCount >= self.awakePublishLimit:
+                self.awakePublishCount = 0
+                if self.stayAwake:
+                    log.debug("{}: StayAwake enabled, so not going into snooze mode".format(self.classicName))
+                    return True
+                else:
+                    self.modeAwake = False
+                    self.snoozePublishCycles = 0
+                    return False
+            else:
+                self.awakePublishCount += 1
+                return True
+        else: #Snoozing
+            # We passively publish every snoozePublishCycles while snoozing
+            if (self.snoozePublishCycles >= self.snoozeCycleLimit):
+                self.infoPublished = False #Makes #info# get published
+                self.snoozePublishCycles = 0 #Reset the cycles to start again
+                return True
+            else:
+                self.snoozePublishCycles += 1
+                return False
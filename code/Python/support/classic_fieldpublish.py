@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------------------------- #
+# Per field readings.
+# In the "fields" readings mode every reading is published on a topic of its
+# own, stat/readings/<Field>, retained, and only when it has moved further
+# than its deadband from the value last published. Every refresh period all
+# the fields are published again whether they changed or not.
+#
+# A deadband is an absolute and/or a relative (fraction of the last value
+# published) amount the value has to change by, both default to 0 (any
+# change). Text and true/false fields are published whenever they change.
+# Fields with the deadband "refresh" are only published with the refresh.
+# --------------------------------------------------------------------------- #
+
+import json
+
+REFRESH_ONLY = "refresh"
+
+# The time changes on every read, it is only sent with the refreshes
+DEFAULT_DEADBANDS = {"currentTime": REFRESH_ONLY}
+
+MISSING = object()
+
+
+class FieldPublisher:
+
+    # deadbands: {field: {"absolute": a, "relative": r} or "refresh"}, the
+    # "default" entry is used for the fields not listed
+    def __init__(self, deadbands, refreshSecs):
+        merged = dict(DEFAULT_DEADBANDS)
+        merged.update(deadbands or {})
+        self.default = self.toDeadband(merged.pop("default", {}))
+        self.deadbands = {field: self.toDeadband(deadband) for field, deadband in merged.items()}
+        self.refreshSecs = refreshSecs
+        self.lastValues = {}
+        self.lastRefresh = None
+
+    @staticmethod
+    def toDeadband(deadband):
+        if deadband == REFRESH_ONLY:
+            return REFRESH_ONLY
+        return (float(deadband.get("absolute", 0)), float(deadband.get("relative", 0)))
+
+    def refreshDue(self, now):
+        return self.lastRefresh is None or now - self.lastRefresh >= self.refreshSecs
+
+    def exceeds(self, field, last, value):
+        if last is MISSING:
+            return True
+        deadband = self.deadbands.get(field, self.default)
+        if deadband is REFRESH_ONLY:
+            return False
+        if isinstance(value, (str, bool)) or isinstance(last, (str, bool)):
+            return value != last
+        change = abs(value - last)
+        if not change:
+            return False
+        absolute, relative = deadband
+        return change > absolute and change > relative * abs(last)
+
+    # --------------------------------------------------------------------------- #
+    # The (field, value, payload) to publish out of the readings given. Nothing
+    # is remembered here, the caller commits each field once it is published
+    # and the refresh once all of them are, so a failed publish leaves the
+    # rest to go out with the next readings
+    # --------------------------------------------------------------------------- #
+    def changes(self, values, now):
+        refresh = self.refreshDue(now)
+        changed = []
+        for field, value in values.items():
+            if refresh or self.exceeds(field, self.lastValues.get(field, MISSING), value):
+                changed.append((field, value, value if isinstance(value, str) else json.dumps(value)))
+        return changed
+
+    def commit(self, field, value):
+        self.lastValues[field] = value
+
+    def refreshed(self, now):
+        self.lastRefresh = now
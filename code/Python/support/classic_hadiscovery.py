@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------------------------- #
+# Home Assistant MQTT discovery.
+# The discovery payloads of a Classic only depend on its name, model and
+# firmware (and the MQTT root), so they are built once for that fingerprint
+# and published retained. classic_mqtt only publishes them again when the
+# fingerprint changes or after it reconnects to the broker.
+#
+# In the "entity" mode, the default, each sensor gets its own message on
+# homeassistant/sensor/<name>/<sensor>/config. In the "device" mode (Home
+# Assistant 2024.11 and newer) all the sensors go in one device discovery
+# message on homeassistant/device/<name>/config.
+#
+# MQTT discovery has no icon templates, so the icons are fixed: SOC is a
+# battery sensor, Home Assistant shows its level in the icon. The icons for
+# the charge state and SOC are still in the readings (ChargeStateIcon and
+# SOCicon) for dashboards and template sensors. Changes in them no longer
+# need the discovery to be published again.
+# --------------------------------------------------------------------------- #
+
+import json
+import logging
+from functools import lru_cache
+
+log = logging.getLogger('classic_mqtt')
+
+HA_DISCOVERY_PREFIX = "homeassistant"
+HA_MANUFACTURER = "MidNite-Solar"
+
+# The config of each kind of unit
+HA_UNITS = {
+    'C':   {"unit_of_measurement": "°C", "icon": "mdi:thermometer", "device_class": "temperature", "state_class": "measurement"},
+    'A':   {"unit_of_measurement": "A", "device_class": "current", "state_class": "measurement"},
+    'V':   {"unit_of_measurement": "V", "device_class": "voltage", "state_class": "measurement"},
+    'W':   {"unit_of_measurement": "W", "device_class": "power", "state_class": "measurement"},
+    'kWh': {"unit_of_measurement": "kWh", "device_class": "energy", "state_class": "total_increasing"},
+    'Ah':  {"unit_of_measurement": "Ah", "state_class": "measurement"},
+    '%':   {"unit_of_measurement": "%", "device_class": "battery", "state_class": "measurement"},
+    's':   {"unit_of_measurement": "s", "icon": "mdi:clock", "device_class": "duration", "state_class": "measurement"},
+    '':    {},
+}
+
+DIAGNOSTIC = {"entity_category": "diagnostic"}
+
+# (sensor, name, units, topic, extra config), the sensor is the key in the
+# info or readings JSON published on stat/<topic>
+HA_SENSORS = [
+    # Device info
+    ('model', 'device Model', '', 'info', dict(DIAGNOSTIC, icon="mdi:teddy-bear")),
+    ('deviceName', 'device Name', '', 'info', dict(DIAGNOSTIC, icon="mdi:home-analytics")),
+    ('deviceType', 'device Type', '', 'info', dict(DIAGNOSTIC, icon="mdi:format-list-bulleted-type")),
+    ('macAddress', 'MAC Address', '', 'info', dict(DIAGNOSTIC, icon="mdi:console-network")),
+    ('IP', 'IP Address', '', 'info', dict(DIAGNOSTIC, icon="mdi:ip-network")),
+    ('nominalBatteryVoltage', 'nominal Battery Voltage', '', 'info', dict(DIAGNOSTIC, unit_of_measurement="V", icon="mdi:battery-charging")),
+    # Measurements
+    ('BatTemperature', 'Temperature Battery', 'C', 'readings', {}),
+    ('PCBTemperature', 'Temperature PCB', 'C', 'readings', {}),
+    ('FETTemperature', 'Temperature FET', 'C', 'readings', {}),
+    ('ShuntTemperature', 'Temperature Shunt', 'C', 'readings', {}),
+    ('PVCurrent', 'PV Current', 'A', 'readings', {"icon": "mdi:solar-panel"}),
+    ('Power', 'PV Power', 'W', 'readings', {"icon": "mdi:solar-panel"}),
+    ('PVVoltage', 'PV Voltage', 'V', 'readings', {"icon": "mdi:solar-panel"}),
+    ('BatVoltage', 'Battery Voltage', 'V', 'readings', {}),
+    ('BatCurrent', 'Battery Current', 'A', 'readings', {}),
+    ('WhizbangBatCurrent', 'Battery Current Whizbang', 'A', 'readings', {}),
+    ('SOC', 'Charge SOC', '%', 'readings', {}),
+    ('RemainingAmpHours', 'Amp Hours Remaining', 'Ah', 'readings', {}),
+    ('TotalAmpHours', 'Amp Hours Total', 'Ah', 'readings', {}),
+    ('NetAmpHours', 'Amp Hours Netto', 'Ah', 'readings', {}),
+    ('EnergyToday', 'Energy Today', 'kWh', 'readings', {"icon": "mdi:calendar-today"}),
+    ('TotalEnergy', 'Energy Total', 'kWh', 'readings', {"icon": "mdi:home-lightning-bolt-outline"}),
+    ('currentTime', 'Current Time', '', 'readings', {"icon": "mdi:calendar-clock"}),
+    ('ChargeState', 'Charge State', '', 'readings', {"icon": "mdi:battery-charging", "state_class": "measurement"}),
+    ('ChargeStateText', 'Charge State Text', '', 'readings', {"icon": "mdi:battery-charging"}),
+    ('FloatTimeTodaySeconds', 'Today Float Time', 's', 'readings', {}),
+    ('AbsorbTime', 'Today Absorb Time', 's', 'readings', {}),
+    ('EqualizeTime', 'Today Equalize Time', 's', 'readings', {}),
+    ('ReasonForResting', 'Reason For Resting', '', 'readings', {"state_class": "measurement"}),
+    ('ReasonForRestingText', 'Reason Text', '', 'readings', {}),
+]
+
+
+# --------------------------------------------------------------------------- #
+# The model and firmware Home Assistant shows for the Classic
+# --------------------------------------------------------------------------- #
+def haDeviceInfo(data):
+    model = "Classic {}V (rev {})".format(data["Type"],data["PCB"])
+    firmware = "{:04n}{:02n}{:02n}.app.{}.net.{}".format(data["Year"],data["Month"],data["Day"],data['app_rev'],data['net_rev'])
+    return model, firmware
+
+
+def sensorConfig(mqttRoot, classicName, sensor, name, units, topic, extra):
+    config = {
+        "unique_id": "{}-{}".format(classicName, sensor),
+        "object_id": "{}-{}".format(classicName, sensor),
+        "name": name,
+        "state_topic": "{}{}/stat/{}".format(mqttRoot, classicName, topic),
+        "value_template": "{{{{value_json.{}}}}}".format(sensor),
+        "force_update": True,
+    }
+    config.update(HA_UNITS[units])
+    config.update(extra)
+    return config
+
+
+# --------------------------------------------------------------------------- #
+# The (topic, payload) discovery messages for a Classic, built once for each
+# fingerprint
+# --------------------------------------------------------------------------- #
+@lru_cache(maxsize=64)
+def haDiscoveryMessages(mode, mqttRoot, classicName, model, firmware):
+    device = {"identifiers": [classicName], "name": classicName, "manufacturer": HA_MANUFACTURER, "model": model, "sw_version": firmware}
+
+    if mode == "device":
+        components = {}
+        for sensor, name, units, topic, extra in HA_SENSORS:
+            config = sensorConfig(mqttRoot, classicName, sensor, name, units, topic, extra)
+            config["platform"] = "sensor"
+            components[config["unique_id"]] = config
+        payload = {"device": device, "origin": {"name": "ClassicMQTT"}, "components": components}
+        return (("{}/device/{}/config".format(HA_DISCOVERY_PREFIX, classicName), json.dumps(payload, separators=(',', ':'))),)
+
+    messages = []
+    for sensor, name, units, topic, extra in HA_SENSORS:
+        config = sensorConfig(mqttRoot, classicName, sensor, name, units, topic, extra)
+        config["device"] = device
+        messages.append(("{}/sensor/{}/{}/config".format(HA_DISCOVERY_PREFIX, classicName, sensor), json.dumps(config, separators=(',', ':'))))
+    return tuple(messages)
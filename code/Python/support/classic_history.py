@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------------------------- #
+# The recent readings of a Classic, kept in memory for history queries.
+# A dashboard that connects, or classic_mqtt_client.py after a restart, can
+# ask for the last hours of readings with the command
+#
+#    {"history": {"fields": ["Power", "BatVoltage"], "seconds": 3600, "step": 60}}
+#
+# and gets them on stat/history, one mean per step:
+#
+#    {"fields": ["Power", "BatVoltage"], "seconds": 3600, "step": 60,
+#     "ts": [1717243200000, ...], "Power": [226.4, ...], "BatVoltage": [27.2, ...]}
+#
+# ts is the start of each step in milliseconds since the epoch, the steps are
+# counted from the epoch so they stay put from one query to the next. Steps
+# without readings are left out. True/false fields give the share of the readings
+# they were true in.
+#
+# The readings are kept in a ring of fixed size, one array per field with the
+# field's type from READINGS_LAYOUT (scaled fields are kept as the integers
+# read from the Classic, like the binary readings), plus an array of the
+# times. The ring is sized for the hours asked for at the fastest rate the
+# readings can come at (the least wake rate a wakePublishRate command can
+# set), so it covers them whatever the rate is, and allocated once, so the
+# memory it takes is known up front and does not grow. At slower rates it
+# holds more than the hours, queries are cut to them.
+# --------------------------------------------------------------------------- #
+
+import logging
+from array import array
+from math import ceil
+
+from support.classic_binaryencoder import READINGS_LAYOUT
+from support.classic_jsonencoder import READINGS_KEYS
+
+log = logging.getLogger('classic_mqtt')
+
+DEFAULT_QUERY_SECONDS = 3600
+DEFAULT_QUERY_STEP = 60
+
+
+class ReadingsHistory:
+
+    def __init__(self, hours, rate):
+        self.capacity = max(1, int(ceil(hours * 3600 / rate)))
+        self.seconds = hours * 3600
+        self.head = 0           #where the next reading goes
+        self.count = 0
+        self.times = array('d', bytes(8 * self.capacity))
+
+        # (name, index in readingsValues, column, scale) of the fields kept,
+        # the texts and the time are not
+        self.columns = []
+        for name, kind, scale in READINGS_LAYOUT:
+            if kind in ("text", "datetime"):
+                continue
+            typecode = "b" if kind == "bool" else kind
+            column = array(typecode, bytes(array(typecode).itemsize * self.capacity))
+            self.columns.append((name, READINGS_KEYS.index(name), column, scale))
+        self.byName = {column[0]: column for column in self.columns}
+
+    def fields(self):
+        return [name for name, index, column, scale in self.columns]
+
+    # The memory the ring takes, in bytes
+    def size(self):
+        return self.times.itemsize * self.capacity + sum(column.itemsize * self.capacity for name, index, column, scale in self.columns)
+
+    # --------------------------------------------------------------------------- #
+    # Add the readings (readingsValues) taken at taken (seconds since the epoch),
+    # over the oldest once the ring is full
+    # --------------------------------------------------------------------------- #
+    def append(self, taken, values):
+        head = self.head
+        self.times[head] = taken
+        for name, index, column, scale in self.columns:
+            value = values[index]
+            column[head] = int(round(value * scale)) if scale is not None else value
+        self.head = (head + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    # --------------------------------------------------------------------------- #
+    # The readings of the last seconds, one mean per step, as on stat/history
+    # --------------------------------------------------------------------------- #
+    def query(self, fields, seconds, step, now):
+        if not fields:
+            fields = self.fields()
+        unknown = [name for name in fields if name not in self.byName]
+        if unknown:
+            raise ValueError("No history of {}".format(", ".join(unknown)))
+        seconds = min(int(seconds), self.seconds)
+        step = max(int(step), 1)
+        start = now - seconds
+
+        # The rows in the ring from the oldest, the ones in the window
+        first = (self.head - self.count) % self.capacity
+        rows = [row % self.capacity for row in range(first, first + self.count) if self.times[row % self.capacity] >= start]
+
+        buckets = []    #(bucket, first row, end row) in rows
+        for position, row in enumerate(rows):
+            bucket = int(self.times[row] // step)
+            if buckets and buckets[-1][0] == bucket:
+                buckets[-1][2] = position + 1
+            else:
+                buckets.append([bucket, position, position + 1])
+        answer = {"fields": fields, "seconds": seconds, "step": step,
+                  "ts": [bucket * step * 1000 for bucket, begin, end in buckets]}
+        for name in fields:
+            name, index, column, scale = self.byName[name]
+            means = []
+            for bucket, begin, end in buckets:
+                mean = sum(column[row] for row in rows[begin:end]) / (end - begin)
+                means.append(round(mean / scale if scale is not None else mean, 3))
+            answer[name] = means
+        return answer
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------------------------- #
+# Write the readings straight to InfluxDB.
+# Instead of going through the broker and Telegraf, each reading is turned
+# into a line of InfluxDB line protocol and the lines are written in batches
+# over HTTP, gzipped:
+#
+#    mqtt_consumer,classic=MyWorkshop,topic=ClassicMQTT/MyWorkshop/stat/readings
+#        BatVoltage=27.2,Power=233.0,Aux1=true,ChargeStateText="BulkMppt",... 1717243200000
+#
+# The numbers are written as floats (a number without the "i" suffix is a
+# float in line protocol), as Telegraf's JSON parser did, so the
+# lines can go into a measurement Telegraf has been filling (the default is
+# Telegraf's "mqtt_consumer"). Aux1 and Aux2 are booleans and the texts are
+# strings, no json_string_fields needed.
+#
+# The lines wait in a buffer of at most maxBuffer lines, the oldest are
+# dropped when it is full. A batch is written when batchSize lines are
+# waiting or every flushSecs. A batch that could not be written is put back
+# and tried again after 1, 2, 4... up to RETRY_MAX_SECS seconds; one the
+# server refuses as bad (a 4xx other than 429) is dropped. The HTTP requests
+# run on a worker thread, the event loop goes on polling.
+#
+# The url is the write endpoint with its parameters:
+#    InfluxDB 1.x:  http://influxdb:8086/write?db=mqtt_solar
+#    InfluxDB 2.x:  http://influxdb:8086/api/v2/write?org=home&bucket=solar
+# token is sent as "Authorization: Token <token>", for 1.8 that can be
+# <username>:<password>.
+# --------------------------------------------------------------------------- #
+
+import asyncio
+import gzip
+import logging
+from operator import itemgetter
+import urllib.request
+import urllib.error
+from collections import deque
+
+from support.classic_binaryencoder import READINGS_LAYOUT
+from support.classic_jsonencoder import READINGS_KEYS
+
+log = logging.getLogger('classic_mqtt')
+
+INFLUX_SKIPPED = ("currentTime", "ChargeStateIcon", "SOCicon")  #the Classic's clock and the icons are not written
+RETRY_MAX_SECS = 60
+HTTP_TIMEOUT_SECS = 10
+
+
+# --------------------------------------------------------------------------- #
+# Line protocol escaping
+# --------------------------------------------------------------------------- #
+def escapeKey(text):
+    return text.replace("\\", "\\\\").replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+
+
+def escapeString(text):
+    return '"{}"'.format(text.replace("\\", "\\\\").replace('"', '\\"'))
+
+
+# --------------------------------------------------------------------------- #
+# The fields of a line are filled in a template, the numbers first, then the
+# texts and the true/false fields, each kind taken out of readingsValues
+# with one itemgetter
+# --------------------------------------------------------------------------- #
+WRITTEN_LAYOUT = [(name, kind) for name, kind, scale in READINGS_LAYOUT if name not in INFLUX_SKIPPED]
+TEXT_FIELDS = [name for name, kind in WRITTEN_LAYOUT if kind == "text"]
+BOOL_FIELDS = [name for name, kind in WRITTEN_LAYOUT if kind == "bool"]
+NUMBER_FIELDS = [name for name, kind in WRITTEN_LAYOUT if kind not in ("text", "bool")]
+
+getNumbers = itemgetter(*[READINGS_KEYS.index(name) for name in NUMBER_FIELDS])
+getTexts = itemgetter(*[READINGS_KEYS.index(name) for name in TEXT_FIELDS])
+getBools = itemgetter(*[READINGS_KEYS.index(name) for name in BOOL_FIELDS])
+
+LINE_TEMPLATE = " " + ",".join(escapeKey(name) + "=%s" for name in NUMBER_FIELDS + TEXT_FIELDS + BOOL_FIELDS) + " %d"
+LINE_BOOLS = {True: "true", False: "false"}
+
+
+# --------------------------------------------------------------------------- #
+# The line of the readings (readingsValues) taken at taken (seconds since the
+# epoch), series is "measurement,tag=value,..."
+# --------------------------------------------------------------------------- #
+def readingsLine(series, values, taken):
+    return series + LINE_TEMPLATE % (getNumbers(values)
+                                     + tuple([escapeString(text) for text in getTexts(values)])
+                                     + tuple([LINE_BOOLS[bool(value)] for value in getBools(values)])
+                                     + (taken * 1000,))
+
+
+def readingsSeries(measurement, tags):
+    return ",".join([escapeKey(measurement)] + ["{}={}".format(escapeKey(key), escapeKey(value)) for key, value in sorted(tags.items())])
+
+
+class InfluxWriter:
+
+    def __init__(self, url, token, batchSize, flushSecs, maxBuffer):
+        if "precision=" not in url:
+            url += ("&" if "?" in url else "?") + "precision=ms"
+        self.url = url
+        self.token = token
+        self.batchSize = batchSize
+        self.flushSecs = flushSecs
+        self.maxBuffer = maxBuffer
+        self.lines = deque()
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+        self.written = 0        #lines written
+        self.failed = 0         #writes that failed, each is tried again
+        self.dropped = 0        #lines dropped, from a full buffer or refused by the server
+
+    def buffered(self):
+        return len(self.lines)
+
+    # --------------------------------------------------------------------------- #
+    # Queue a line, the oldest is dropped when the buffer is full
+    # --------------------------------------------------------------------------- #
+    def add(self, line):
+        if len(self.lines) >= self.maxBuffer:
+            self.lines.popleft()
+            self.dropped += 1
+        self.lines.append(line)
+        if len(self.lines) >= self.batchSize:
+            self.wakeup.set()
+
+    # --------------------------------------------------------------------------- #
+    # POST a batch, runs on a worker thread. Returns the HTTP status, or None
+    # when the server could not be reached
+    # --------------------------------------------------------------------------- #
+    def post(self, body):
+        request = urllib.request.Request(self.url, data=gzip.compress(body), method="POST")
+        request.add_header("Content-Type", "text/plain; charset=utf-8")
+        request.add_header("Content-Encoding", "gzip")
+        if self.token:
+            request.add_header("Authorization", "Token {}".format(self.token))
+        try:
+            with urllib.request.urlopen(request, timeout=HTTP_TIMEOUT_SECS) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            log.error("InfluxDB write failed, HTTP {}: {}".format(e.code, e.read(200).decode("utf-8", "replace")))
+            return e.code
+        except (urllib.error.URLError, OSError) as e:
+            log.error("InfluxDB write failed: {}".format(e))
+            return None
+
+    # --------------------------------------------------------------------------- #
+    # Write one batch, returns False when it is to be tried again
+    # --------------------------------------------------------------------------- #
+    async def writeBatch(self):
+        batch = [self.lines.popleft() for _ in range(min(self.batchSize, len(self.lines)))]
+        try:
+            status = await asyncio.to_thread(self.post, "\n".join(batch).encode("utf-8"))
+        except asyncio.CancelledError:
+            # stopping, stop() tries them again (InfluxDB overwrites the same points)
+            self.lines.extendleft(reversed(batch))
+            raise
+        if status is not None and 200 <= status < 300:
+            self.written += len(batch)
+            return True
+        if status is not None and 400 <= status < 500 and status != 429:
+            # trying again will not help
+            self.dropped += len(batch)
+            return True
+        self.failed += 1
+        # back in front of what came in meanwhile, the oldest go when it does not fit
+        self.lines.extendleft(reversed(batch))
+        while len(self.lines) > self.maxBuffer:
+            self.lines.popleft()
+            self.dropped += 1
+        return False
+
+    # --------------------------------------------------------------------------- #
+    # The write task
+    # --------------------------------------------------------------------------- #
+    async def run(self):
+        retrySecs = 0
+        while True:
+            if retrySecs:
+                await asyncio.sleep(retrySecs)
+            else:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.flushSecs)
+                except asyncio.TimeoutError:
+                    pass
+            self.wakeup.clear()
+            while self.lines:
+                if not await self.writeBatch():
+                    retrySecs = min(RETRY_MAX_SECS, retrySecs * 2 or 1)
+                    break
+                retrySecs = 0
+                if len(self.lines) < self.batchSize:
+                    break
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run(), name="influx")
+        return self
+
+    # --------------------------------------------------------------------------- #
+    # Write what is left, one try, then stop
+    # --------------------------------------------------------------------------- #
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        while self.lines and await self.writeBatch():
+            pass
+        if self.lines or self.dropped:
+            log.info("InfluxDB writer dropped {} lines, {} left unwritten".format(self.dropped, len(self.lines)))
@@ -9,128 +9,220 @@
 import json
 import logging
 import datetime
+from functools import lru_cache
 
 log = logging.getLogger('classic_mqtt')
 
 
+# --------------------------------------------------------------------------- # 
+# Templated JSON encoding.
+# The readings and info always have the same keys in the same order, so the
+# keys and punctuation are compiled once into a format string with a %s for
+# each value, and encoding only has to fill it in. Numbers go in as they are
+# (str of an int or float is what json.dumps writes), strings are escaped
+# with json's own escaping and true/false spelled out, so the output is byte
+# for byte what json.dumps(..., separators=(',', ':')) gives.
+#
+# A format string is compiled for each combination of value types seen,
+# normally there is just one. Values json.dumps writes differently (NaN and
+# Infinity, None, other types) go through json.dumps instead.
+# --------------------------------------------------------------------------- # 
+encodeString = json.encoder.encode_basestring_ascii
+JSON_BOOLS = ("false", "true")
+
+
+class JsonTemplate:
+
+    def __init__(self, keys):
+        self.keys = tuple(keys)
+        self.compiled = {}
+
+    def compile(self, kinds):
+        segments = []
+        strings = []
+        bools = []
+        floats = []
+        for index, (key, kind) in enumerate(zip(self.keys, kinds)):
+            segments.append(('{' if index == 0 else ',') + encodeString(key).replace('%', '%%') + ':%s')
+            if kind is str:
+                strings.append(index)
+            elif kind is bool:
+                bools.append(index)
+            elif kind is float:
+                floats.append(index)
+            elif kind is not int:
+                return None
+        compiled = ("".join(segments) + '}', tuple(strings), tuple(bools), tuple(floats))
+        self.compiled[kinds] = compiled
+        return compiled
+
+    def encode(self, values):
+        kinds = tuple(map(type, values))
+        compiled = self.compiled.get(kinds)
+        if compiled is None:
+            compiled = self.compile(kinds)
+            if compiled is None:
+                return self.dumps(values)
+        template, strings, bools, floats = compiled
+
+        # NaN and Infinity make the sum NaN or Infinity too
+        total = sum([values[index] for index in floats])
+        if total - total != 0:
+            return self.dumps(values)
+
+        values = list(values)
+        for index in strings:
+            values[index] = encodeString(values[index])
+        for index in bools:
+            values[index] = JSON_BOOLS[values[index]]
+        return template % tuple(values)
+
+    def dumps(self, values):
+        return json.dumps(dict(zip(self.keys, values)), sort_keys=False, separators=(',', ':'))
+
+
 # --------------------------------------------------------------------------- # 
 # Handle creating the Json for Readings
 # --------------------------------------------------------------------------- # 
+READINGS_KEYS = (
+    "currentTime", "BatTemperature", "NetAmpHours", "ChargeState", "ChargeStateIcon", "ChargeStateText",
+    "Aux1FunctionText", "Aux2FunctionText", "MPPTModeText", "InfoFlagsBits", "ReasonForResting",
+    "ReasonForRestingText", "NegativeAmpHours", "BatVoltage", "PVVoltage", "VbattRegSetPTmpComp",
+    "TotalAmpHours", "WhizbangBatCurrent", "BatCurrent", "PVCurrent", "ConnectionState", "EnergyToday",
+    "EqualizeTime", "SOC", "SOCicon", "Aux1", "Aux2", "Power", "FETTemperature", "PositiveAmpHours",
+    "TotalEnergy", "FloatTimeTodaySeconds", "RemainingAmpHours", "AbsorbTime", "ShuntTemperature",
+    "PCBTemperature")
+
+READINGS_TEMPLATE = JsonTemplate(READINGS_KEYS)
+
 def encodeClassicData_readings(decoded):
     #log.debug("Enter encodeClassicData_readings")
 
-    classicData = {}
-    
-    classicData["currentTime"] = decodeCTIME( decoded["CTIME0"],decoded["CTIME1"], decoded["CTIME2"] )
-    
-    # "BatTemperature":-1.99,
-    classicData["BatTemperature"] = decoded["BatTemperature"]
-    # "NetAmpHours":0,
-    classicData["NetAmpHours"] = decoded["WbJrAmpHourNET"]
-    # "ChargeState":0,
-    classicData["ChargeState"] = decoded["ChargeStage"] #it is mis-labeled in the ESP32 code
-    classicData["ChargeStateIcon"] = decoded["ChargeStateIcon"]
-    classicData["ChargeStateText"] = decoded["ChargeStateText"]
-    classicData["Aux1FunctionText"] = decoded["Aux1FunctionText"]
-    classicData["Aux2FunctionText"] = decoded["Aux2FunctionText"]
-    classicData["MPPTModeText"] = decoded["MPPTModeText"]
-    # "InfoFlagsBits":-1308610300,
-    classicData["InfoFlagsBits"] = decoded["InfoFlagsBits"]
-    # "ReasonForResting":104,
-    classicData["ReasonForResting"] = decoded["ReasonForResting"]
-    classicData["ReasonForRestingText"] = decoded["ReasonForRestingText"]
-    # "NegativeAmpHours":-9170,
-    classicData["NegativeAmpHours"] = decoded["WbJrAmpHourNEGative"]
-    # "BatVoltage":25.21,
-    classicData["BatVoltage"] = decoded["BatVoltage"]
-    # "PVVoltage":10.21,
-    classicData["PVVoltage"] = decoded["PVVoltage"]
-    # "VbattRegSetPTmpComp":30.6,
-    classicData["VbattRegSetPTmpComp"] = decoded["VbattRegSetPTmpComp"]
-    # "TotalAmpHours":676,
-    classicData["TotalAmpHours"] = decoded["TotalAmpHours"]
-    # "WhizbangBatCurrent":-0.59,
-    classicData["WhizbangBatCurrent"] = decoded["WhizbangBatCurrent"]
-    # "BatCurrent":0.01,
-    classicData["BatCurrent"] = decoded["BatCurrent"]
-    # "PVCurrent":0.01,
-    classicData["PVCurrent"] = decoded["PVCurrent"]
-    # "ConnectionState":0,
-    classicData["ConnectionState"] = 0
-    # "EnergyToday":0.01,
-    classicData["EnergyToday"] = decoded["EnergyToday"]
-    # "EqualizeTime":10800,
-    classicData["EqualizeTime"] = decoded["EqualizeTime"]
-    # "SOC":99,
-    classicData["SOC"] = decoded["SOC"]
-    classicData["SOCicon"] = decoded["SOCicon"]
-   # "Aux1":false,
-    classicData["Aux1"] = ((decoded["InfoFlagsBits"] & 0x00004000) != 0)
-    # "Aux2":false,
-    classicData["Aux2"] = ((decoded["InfoFlagsBits"] & 0x00008000) != 0)
-    # "Power":0.01,
-    classicData["Power"] = decoded["Power"]
-    # "FETTemperature":4.31,
-    classicData["FETTemperature"] = decoded["FETTemperature"]
-    # "PositiveAmpHours":16797,
-    classicData["PositiveAmpHours"] = decoded["WbJrAmpHourPOSitive"]
-    # "TotalEnergy":603.41,
-    classicData["TotalEnergy"] = decoded["TotalEnergy"]
-    # "FloatTimeTodaySeconds":0,
-    classicData["FloatTimeTodaySeconds"] = decoded["FloatTimeTodaySeconds"]
-    # "RemainingAmpHours":673,
-    classicData["RemainingAmpHours"] = decoded["RemainingAmpHours"]
-    # "AbsorbTime":18000,
-    classicData["AbsorbTime"] = decoded["AbsorbTime"]
-    # "ShuntTemperature":0.01,
-    classicData["ShuntTemperature"] = decoded["ShuntTemperature"]
-    # "PCBTemperature":12.71
-    classicData["PCBTemperature"] = decoded["PCBTemperature"]
-
-    return json.dumps(classicData, sort_keys=False, separators=(',', ':'))
+    return READINGS_TEMPLATE.encode(readingsValues(decoded))
+
+# --------------------------------------------------------------------------- # 
+# The readings as a dict, in the order they are published
+# --------------------------------------------------------------------------- # 
+def classicData_readings(decoded):
+    return dict(zip(READINGS_KEYS, readingsValues(decoded)))
+
+# --------------------------------------------------------------------------- # 
+# The values of the readings, in the order of READINGS_KEYS
+# --------------------------------------------------------------------------- # 
+def readingsValues(decoded):
+    infoFlagsBits = decoded["InfoFlagsBits"]
+    return (
+        decodeCTIME( decoded["CTIME0"],decoded["CTIME1"], decoded["CTIME2"] ),  # "currentTime":"2020-10-03 08:44:00"
+        decoded["BatTemperature"],          # "BatTemperature":-1.99
+        decoded["WbJrAmpHourNET"],          # "NetAmpHours":0
+        decoded["ChargeStage"],             # "ChargeState":0, it is mis-labeled in the ESP32 code
+        decoded["ChargeStateIcon"],
+        decoded["ChargeStateText"],
+        decoded["Aux1FunctionText"],
+        decoded["Aux2FunctionText"],
+        decoded["MPPTModeText"],
+        infoFlagsBits,                      # "InfoFlagsBits":-1308610300
+        decoded["ReasonForResting"],        # "ReasonForResting":104
+        decoded["ReasonForRestingText"],
+        decoded["WbJrAmpHourNEGative"],     # "NegativeAmpHours":-9170
+        decoded["BatVoltage"],              # "BatVoltage":25.21
+        decoded["PVVoltage"],               # "PVVoltage":10.21
+        decoded["VbattRegSetPTmpComp"],     # "VbattRegSetPTmpComp":30.6
+        decoded["TotalAmpHours"],           # "TotalAmpHours":676
+        decoded["WhizbangBatCurrent"],      # "WhizbangBatCurrent":-0.59
+        decoded["BatCurrent"],              # "BatCurrent":0.01
+        decoded["PVCurrent"],               # "PVCurrent":0.01
+        0,                                  # "ConnectionState":0
+        decoded["EnergyToday"],             # "EnergyToday":0.01
+        decoded["EqualizeTime"],            # "EqualizeTime":10800
+        decoded["SOC"],                     # "SOC":99
+        decoded["SOCicon"],
+        (infoFlagsBits & 0x00004000) != 0,  # "Aux1":false
+        (infoFlagsBits & 0x00008000) != 0,  # "Aux2":false
+        decoded["Power"],                   # "Power":0.01
+        decoded["FETTemperature"],          # "FETTemperature":4.31
+        decoded["WbJrAmpHourPOSitive"],     # "PositiveAmpHours":16797
+        decoded["TotalEnergy"],             # "TotalEnergy":603.41
+        decoded["FloatTimeTodaySeconds"],   # "FloatTimeTodaySeconds":0
+        decoded["RemainingAmpHours"],       # "RemainingAmpHours":673
+        decoded["AbsorbTime"],              # "AbsorbTime":18000
+        decoded["ShuntTemperature"],        # "ShuntTemperature":0.01
+        decoded["PCBTemperature"],          # "PCBTemperature":12.71
+    )
     
+# --------------------------------------------------------------------------- # 
+# The readings again with only the time changed. When nothing but the clock
+# has changed since readings were encoded, splice the new time into them
+# instead of encoding them all over.
+# --------------------------------------------------------------------------- # 
+READINGS_TIME_PREFIX = '{"currentTime":"'
+READINGS_TIME_LENGTH = len("2020-10-03 08:44:00")
+
+def updateClassicData_readingsTime(readings, decoded):
+    currentTime = decodeCTIME( decoded["CTIME0"],decoded["CTIME1"], decoded["CTIME2"] )
+    end = len(READINGS_TIME_PREFIX) + READINGS_TIME_LENGTH
+    if len(currentTime) == READINGS_TIME_LENGTH and readings.startswith(READINGS_TIME_PREFIX) and readings[end:end+1] == '"':
+        return READINGS_TIME_PREFIX + currentTime + readings[end:]
+    return encodeClassicData_readings(decoded)
+
 # --------------------------------------------------------------------------- # 
 # Handle creating the Json for Info
 # --------------------------------------------------------------------------- # 
+INFO_KEYS = (
+    "appVersion", "deviceName", "buildDate", "deviceType", "endingAmps", "hasWhizbang", "lastVOC",
+    "model", "mpptMode", "netVersion", "nominalBatteryVoltage", "unitID", "macAddress", "IP")
+
+INFO_TEMPLATE = JsonTemplate(INFO_KEYS)
+
 def encodeClassicData_info(decoded):
 
     #log.debug("Enter encodeClassicData_info")
-    classicData = {}
-    # "appVersion":"",
-    classicData["appVersion"] = decoded["app_rev"]
-    #Assemble the string
-    uint_array = [decoded["Name1"],decoded["Name0"],decoded["Name3"],decoded["Name2"],decoded["Name5"],decoded["Name4"],decoded["Name7"],decoded["Name6"]]
-    # "deviceName":"CLASSIC",
-    classicData["deviceName"] = "".join(chr(x) for x in uint_array).strip(chr(0))
-    # "buildDate":"Tuesday, February 6, 2018",
-    bdate = datetime.date(decoded["Year"],decoded["Month"],decoded["Day"])
-    classicData["buildDate"] = bdate.strftime("%A, %B %d, %Y").replace(' 0', ' ') # get rid of the stupid leading 0 in date.
-    # "deviceType":"Classic",
-    classicData["deviceType"] = "Classic"
-    # "endingAmps":13.01,
-    classicData["endingAmps"] = decoded["endingAmps"]
-    # "hasWhizbang":true,
-    classicData["hasWhizbang"] = (decoded["Aux2Function"] & 0x3f) == 18
-    # "lastVOC":10.21,
-    classicData["lastVOC"] = decoded["lastVOC"]
-    # "model":"Classic 150 (rev 4)",
-    #print("Classic {} (rev {})".format(decoded["Type"],decoded["PCB"]))
-    classicData["model"] = "Classic {}V (rev {})".format(decoded["Type"],decoded["PCB"])
-    # "mpptMode":11,
-    classicData["mpptMode"] = decoded["MPPTMode"]
-    # "netVersion":"",
-    classicData["netVersion"] = decoded["net_rev"]
-    # "nominalBatteryVoltage":24,
-    classicData["nominalBatteryVoltage"] = decoded["nominalBatteryVoltage"]
-    # "unitID":-791134691
-    classicData["unitID"] = decoded["unitID"]
-
-    mac = "{:02x}:{:02x}:{:02x}:{:02x}:{:02x}:{:02x}".format(decoded["mac_5"],decoded["mac_4"],decoded["mac_3"],decoded["mac_2"],decoded["mac_1"],decoded["mac_0"])
-    classicData["macAddress"] = mac.upper()
-
-    classicData["IP"] = decoded["IP"]
-
-    return json.dumps(classicData, sort_keys=False, separators=(',', ':'))
+    return INFO_TEMPLATE.encode(infoValues(decoded))
+
+# --------------------------------------------------------------------------- # 
+# The info as a dict, in the order they are published
+# --------------------------------------------------------------------------- # 
+def classicData_info(decoded):
+    return dict(zip(INFO_KEYS, infoValues(decoded)))
+
+# --------------------------------------------------------------------------- # 
+# The values of the info, in the order of INFO_KEYS. The texts only change
+# with the firmware, so they are formatted once and remembered.
+# --------------------------------------------------------------------------- # 
+def infoValues(decoded):
+    return (
+        decoded["app_rev"],                 # "appVersion":""
+        deviceName(decoded["Name1"],decoded["Name0"],decoded["Name3"],decoded["Name2"],decoded["Name5"],decoded["Name4"],decoded["Name7"],decoded["Name6"]),  # "deviceName":"CLASSIC"
+        buildDate(decoded["Year"],decoded["Month"],decoded["Day"]),   # "buildDate":"Tuesday, February 6, 2018"
+        "Classic",                          # "deviceType":"Classic"
+        decoded["endingAmps"],              # "endingAmps":13.01
+        (decoded["Aux2Function"] & 0x3f) == 18,   # "hasWhizbang":true
+        decoded["lastVOC"],                 # "lastVOC":10.21
+        model(decoded["Type"],decoded["PCB"]),    # "model":"Classic 150V (rev 4)"
+        decoded["MPPTMode"],                # "mpptMode":11
+        decoded["net_rev"],                 # "netVersion":""
+        decoded["nominalBatteryVoltage"],   # "nominalBatteryVoltage":24
+        decoded["unitID"],                  # "unitID":-791134691
+        macAddress(decoded["mac_5"],decoded["mac_4"],decoded["mac_3"],decoded["mac_2"],decoded["mac_1"],decoded["mac_0"]),
+        decoded["IP"],
+    )
+
+@lru_cache(maxsize=64)
+def deviceName(*uint_array):
+    return "".join(chr(x) for x in uint_array).strip(chr(0))
+
+@lru_cache(maxsize=64)
+def buildDate(year, month, day):
+    bdate = datetime.date(year, month, day)
+    return bdate.strftime("%A, %B %d, %Y").replace(' 0', ' ') # get rid of the stupid leading 0 in date.
+
+@lru_cache(maxsize=64)
+def model(classicType, pcb):
+    return "Classic {}V (rev {})".format(classicType, pcb)
+
+@lru_cache(maxsize=64)
+def macAddress(*mac):
+    return "{:02x}:{:02x}:{:02x}:{:02x}:{:02x}:{:02x}".format(*mac).upper()
 
 def decodeCTIME( CTIME0, CTIME1, CTIME2):
     
@@ -146,4 +238,5 @@ def decodeCTIME( CTIME0, CTIME1, CTIME2):
     # CTIME2 - BITS 11:0 day of year
     tdyoy = (CTIME2 & 0x000007FF)    #  1FF
     #
-    return "{:04n}-{:02n}-{:02n} {:02n}:{:02n}:{:02n}".format(tyear,tmnth,tdyom,thour,tmins,tsecs)
+    # %d writes what {:n} did, classic_mqtt never sets a locale that groups digits
+    return "%04d-%02d-%02d %02d:%02d:%02d" % (tyear,tmnth,tdyom,thour,tmins,tsecs)
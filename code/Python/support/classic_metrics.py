@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------------------------- #
+# Runtime metrics for the polling cycle.
+# Each Classic gets a ClassicMetrics with a latency histogram per stage of the
+# cycle (MODBUS connect, each MODBUS request, the whole read, decode, encode,
+# HA discovery, queueing the publishes, the whole cycle and from queueing a
+# message to its acknowledgement) and counters for the cycles, the overruns,
+# the MODBUS (re)connects, the errors, the messages dropped from the full
+# publish queue, the readings spooled and replayed, the MODBUS proxy hits and misses and the cycles with
+# unchanged or suppressed readings. The numbers are totals
+# since startup, a snapshot of them is published on tele/STATE and can be
+# taken in process with snapshot().
+#
+# When metrics are off the devices have no ClassicMetrics (metrics is None)
+# and the code being measured skips the timing altogether.
+# --------------------------------------------------------------------------- #
+
+from bisect import bisect_left
+from time import perf_counter
+
+# Upper bounds of the histogram buckets in seconds, the last bucket is +Inf
+HISTOGRAM_BOUNDS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+STAGES = ("connect", "modbusRtt", "read", "decode", "encode", "discovery", "publish", "cycle", "ack")
+COUNTERS = ("cycles", "overruns", "modbusConnects", "modbusErrors", "publishErrors", "publishDropped", "spooled", "spoolReplayed", "proxyHits", "proxyMisses", "unchanged", "suppressed", "captureSamples", "captureErrors")
+
+
+# --------------------------------------------------------------------------- #
+# A fixed bucket histogram of durations in seconds
+# --------------------------------------------------------------------------- #
+class Histogram:
+
+    def __init__(self, bounds=HISTOGRAM_BOUNDS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.buckets[bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    # The upper bound of the bucket holding the fraction of the samples
+    def quantile(self, fraction):
+        if not self.count:
+            return 0.0
+        target = fraction * self.count
+        seen = 0
+        for index, bucketCount in enumerate(self.buckets):
+            seen += bucketCount
+            if seen >= target:
+                return self.bounds[index] if index < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "meanMs": round(self.sum / self.count * 1000, 3) if self.count else 0.0,
+            "maxMs": round(self.max * 1000, 3),
+            "p50Ms": round(min(self.quantile(0.50), self.max) * 1000, 3),
+            "p99Ms": round(min(self.quantile(0.99), self.max) * 1000, 3),
+            "buckets": list(self.buckets),
+        }
+
+
+# --------------------------------------------------------------------------- #
+# The metrics of one Classic
+# --------------------------------------------------------------------------- #
+class ClassicMetrics:
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.histograms = {stage: Histogram() for stage in STAGES}
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.gauges = {}
+
+    def record(self, stage, seconds):
+        self.histograms[stage].record(seconds)
+
+    # Record the time since start (a perf_counter()) and return now
+    def since(self, stage, start):
+        now = perf_counter()
+        self.histograms[stage].record(now - start)
+        return now
+
+    def count(self, counter, increment=1):
+        self.counters[counter] += increment
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def snapshot(self):
+        return {
+            "uptime": round(perf_counter() - self.started, 1),
+            "counters": dict(self.counters),
+            "gauges": dict(self.gauges),
+            "latency": {stage: histogram.snapshot() for stage, histogram in self.histograms.items()},
+        }
+
+
+# The histogram layout, published with the snapshots so they can be read
+def histogramLayout():
+    return {"boundsMs": [bound * 1000 for bound in HISTOGRAM_BOUNDS] + ["+Inf"]}
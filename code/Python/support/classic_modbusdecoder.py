@@ -2,7 +2,7 @@
 
 # --------------------------------------------------------------------------- #
 # Handle the modbus data from the Classic.
-# The only method called out of this is getModbusData
+# The only methods called out of this are getModbusData and getModbusDataAsync
 # This opens the client to the Classic, gets the data and closes it. It does not
 # keep the link open to the Classic.
 #
@@ -18,8 +18,12 @@
 
 from pymodbus.constants import Endian
 from pymodbus.client import ModbusTcpClient as ModbusClient
+from pymodbus.client import AsyncModbusTcpClient as AsyncModbusClient
 from support.Payload import BinaryPayloadDecoder
+from support.classic_registermap import decodeBlock
+from support.classic_readingsschema import CHARGE_STATE_TEXT, AUX1_FUNCTION_TEXT, AUX2_FUNCTION_TEXT, MPPT_MODE_TEXT, REST_REASON_TEXT
 from collections import OrderedDict
+from time import perf_counter, monotonic
 import logging
 import sys
 
@@ -40,7 +44,7 @@ def getRegisters(theClient, addr, cnt):
             )
             return {}
     except Exception as ex:
-        log.error("Error getting {} for {} bytes, exeption:{}".format(addr, count, ex))
+        log.error("Error getting {} for {} bytes, exeption:{}".format(addr, cnt, ex))
         return {}
 
     return result.registers
@@ -57,6 +61,8 @@ def getDataDecoder(registers):
 
 # --------------------------------------------------------------------------- #
 # Based on the address, return the decoded OrderedDict
+# This is the field by field reference for REGISTER_MAP in classic_registermap,
+# which is what decodeModbusData uses.
 # --------------------------------------------------------------------------- #
 
 
@@ -180,88 +186,471 @@ def doDecode(addr, decoder):
 
 
 # --------------------------------------------------------------------------- #
-# Get the data from the Classic.
-# Open the cleint, read in the register, close the client, decode the data,
-# combine it and return it
+# Read planner.
+# The blocks that doDecode knows about are merged into as few read requests as
+# possible. Blocks are merged when the gap between them is no more than maxGap
+# registers and the merged request stays within the Modbus limit of 125
+# registers. Each planned request is (address, count, [(blockAddr, blockCnt)]).
+# --------------------------------------------------------------------------- #
+
+MODBUS_MAX_READ_COUNT = 125  # Protocol limit for read_holding_registers
+DEFAULT_MAX_READ_GAP = 32  # Registers we are willing to read and throw away
+
+# The register blocks decoded by doDecode (address, count)
+REGISTER_BLOCKS = [
+    (4100, 44),
+    (4163, 2),
+    (4209, 4),
+    (4213, 6),
+    (4243, 32),
+    (4360, 22),
+    (16386, 4),
+]
+
+readPlans = {}
+
+
+def planReads(blocks, maxGap=DEFAULT_MAX_READ_GAP, maxCount=MODBUS_MAX_READ_COUNT):
+    plan = []
+    for blockAddr, blockCnt in sorted(blocks):
+        if plan:
+            addr, cnt, members = plan[-1]
+            gap = blockAddr - (addr + cnt)
+            end = max(addr + cnt, blockAddr + blockCnt)
+            if gap <= maxGap and (end - addr) <= maxCount:
+                plan[-1] = (addr, end - addr, members + [(blockAddr, blockCnt)])
+                continue
+        plan.append((blockAddr, blockCnt, [(blockAddr, blockCnt)]))
+    return plan
+
+
+def getReadPlan(maxGap, blocks=REGISTER_BLOCKS):
+    key = (maxGap, tuple(blocks))
+    if key not in readPlans:
+        readPlans[key] = planReads(blocks, maxGap)
+        log.debug(
+            "Read plan for gap {}: {}".format(
+                maxGap, [(addr, cnt) for addr, cnt, members in readPlans[key]]
+            )
+        )
+    return readPlans[key]
+
+
 # --------------------------------------------------------------------------- #
+# Read the planned requests and slice the decoded blocks back out of them
+# --------------------------------------------------------------------------- #
+def readPlannedRegisters(theClient, plan, metrics=None):
+    theData = {}
+    for addr, cnt, members in plan:
+        if metrics is not None:
+            start = perf_counter()
+        registers = getRegisters(theClient=theClient, addr=addr, cnt=cnt)
+        if metrics is not None:
+            metrics.since("modbusRtt", start)
+        for blockAddr, blockCnt in members:
+            if not registers:
+                theData[blockAddr] = registers
+            else:
+                offset = blockAddr - addr
+                theData[blockAddr] = registers[offset : offset + blockCnt]
+    return theData
+
+
+# --------------------------------------------------------------------------- #
+# Register cache.
+# Most of what is in REGISTER_BLOCKS (PCB/Type/date/MAC/unitID, MPPT/Aux
+# config, name, nominal battery V, firmware) only changes when the Classic is
+# set up or updated. All of REGISTER_BLOCKS is read once per connection, or
+# when asked for a refresh (the info cycle), and kept in the connection. The
+# other cycles only read the volatile registers and patch them into the
+# cached blocks.
+# --------------------------------------------------------------------------- #
+
+# Readings, clock, temperature compensated set point, reason for resting, WBjr
+VOLATILE_REGISTERS = [
+    (4112, 32),
+    (4213, 6),
+    (4243, 1),
+    (4274, 1),
+    (4360, 22),
+]
+
+
+def selectReadPlan(connection, refreshStatic, maxGap):
+    if refreshStatic or not connection.registerCache:
+        return getReadPlan(maxGap), True
+    return getReadPlan(maxGap, VOLATILE_REGISTERS), False
+
+
+def updateRegisterCache(connection, theData, fullRead):
+    if fullRead:
+        connection.registerCache = {}
+        for addr, registers in theData.items():
+            if not registers:
+                raise Exception("Failed reading registers at {}".format(addr))
+        connection.registerCache = {addr: list(regs) for addr, regs in theData.items()}
+        connection.snapshot = connection.registerCache
+        connection.snapshotTime = monotonic()
+        return theData
+
+    # Patch the volatile registers into the cached blocks
+    for addr, registers in theData.items():
+        if not registers:
+            raise Exception("Failed reading volatile registers at {}".format(addr))
+        for blockAddr, blockCnt in REGISTER_BLOCKS:
+            start = max(addr, blockAddr)
+            end = min(addr + len(registers), blockAddr + blockCnt)
+            if start < end:
+                connection.registerCache[blockAddr][
+                    start - blockAddr : end - blockAddr
+                ] = registers[start - addr : end - addr]
+    connection.snapshot = connection.registerCache
+    connection.snapshotTime = monotonic()
+    return connection.registerCache
+
+
+# The round-trips saved are against reading the blocks the plan covers one
+# request each
+def logReadPlan(plan, fullRead):
+    log.debug(
+        "Read {} registers ({}) in {} requests, saved {} round-trips".format(
+            sum(cnt for addr, cnt, members in plan),
+            "all" if fullRead else "volatile",
+            len(plan),
+            len(REGISTER_BLOCKS if fullRead else VOLATILE_REGISTERS) - len(plan),
+        )
+    )
+
+
+# --------------------------------------------------------------------------- #
+# The connection state for one Classic. Each Classic being polled has its own
+# so that several of them can be read from the same process.
+# --------------------------------------------------------------------------- #
+class ModbusConnection:
+    def __init__(self, classicHost, classicPort):
+        self.classicHost = classicHost
+        self.classicPort = classicPort
+        self.modbusClient = None
+        self.isConnected = False
+        self.registerCache = {}  # The last full read of REGISTER_BLOCKS
+        # The latest registers and when they were read, kept across closes
+        # for the MODBUS proxy (see classic_modbusproxy)
+        self.snapshot = {}
+        self.snapshotTime = 0.0
+        # Change detection (see decodeModbusData), also kept across closes
+        self.fingerprint = None
+        self.rawBlocks = {}
+        self.decoded = None
+        self.changed = True
+
+    def close(self):
+        try:
+            if self.modbusClient is not None:
+                self.modbusClient.close()
+        finally:
+            self.isConnected = False
+            self.modbusClient = None  # Ajouté par Daniel Côté
+            self.registerCache = {}
+
 
-modbusClient = None
-isConnected = False
+# Connections used when the caller does not pass one in, keyed by (host, port)
+modbusConnections = {}
 
 
-def getModbusData(modeAwake, classicHost, classicPort):
+def getConnection(classicHost, classicPort):
+    key = (classicHost, classicPort)
+    if key not in modbusConnections:
+        modbusConnections[key] = ModbusConnection(classicHost, classicPort)
+    return modbusConnections[key]
 
-    global isConnected, modbusClient
+
+# --------------------------------------------------------------------------- #
+# Get the data from the Classic.
+# Open the cleint, read in the register, close the client, decode the data,
+# combine it and return it
+# --------------------------------------------------------------------------- #
+def getModbusData(
+    modeAwake,
+    classicHost,
+    classicPort,
+    maxGap=DEFAULT_MAX_READ_GAP,
+    connection=None,
+    refreshStatic=True,
+    metrics=None,
+):
+
+    if connection is None:
+        connection = getConnection(classicHost, classicPort)
 
     try:
-        if not isConnected:
+        if not connection.isConnected:
             log.debug("Opening the modbus Connection")
-            if modbusClient is None:
-                modbusClient = ModbusClient(host=classicHost, port=classicPort)
+            if connection.modbusClient is None:
+                connection.modbusClient = ModbusClient(host=classicHost, port=classicPort)
 
             # Test for successful connect, if not, log error and mark modbusConnected = False
-            modbusClient.connect()
-
-            result = modbusClient.read_holding_registers(4163, count=2, slave=10)
-
-            if result.isError():
-                # close the client
-                log.error("MODBUS isError H:{} P:{}".format(classicHost, classicPort))
-                modbusClient.close()
-                isConnected = False
-                modbusClient = None  # Ajouté par Daniel Côté
+            if metrics is not None:
+                metrics.count("modbusConnects")
+                start = perf_counter()
+            connection.modbusClient.connect()
+            if metrics is not None:
+                metrics.since("connect", start)
+
+            result = connection.modbusClient.read_holding_registers(4163, count=2, slave=10)
+            if not connectionChecked(connection, result):
                 return {}
 
-            isConnected = True
-
-        theData = {}
-        # Read in all the registers at one time
-        log.debug("Read in all the registers at one time")
-        theData[4100] = getRegisters(theClient=modbusClient, addr=4100, cnt=44)
-        theData[4360] = getRegisters(theClient=modbusClient, addr=4360, cnt=22)
-        theData[4163] = getRegisters(theClient=modbusClient, addr=4163, cnt=2)
-        theData[4209] = getRegisters(theClient=modbusClient, addr=4209, cnt=4)
-        theData[4213] = getRegisters(theClient=modbusClient, addr=4213, cnt=6)
-        theData[4243] = getRegisters(theClient=modbusClient, addr=4243, cnt=32)
-        theData[16386] = getRegisters(theClient=modbusClient, addr=16386, cnt=4)
-
-        # If we are snoozing, then give up the connection
-        log.debug("modeAwake:{}".format(modeAwake))
-        if not modeAwake:
-            log.debug("Closing the modbus Connection, we are in Snooze mode")
-            modbusClient.close()
-            isConnected = False
-            modbusClient = None  # Ajouté par Daniel Côté
+        # Read in the registers using as few requests as possible, the static
+        # ones come from the cache unless a refresh is asked for
+        plan, fullRead = selectReadPlan(connection, refreshStatic, maxGap)
+        if metrics is not None:
+            start = perf_counter()
+        theData = readPlannedRegisters(connection.modbusClient, plan, metrics)
+        if metrics is not None:
+            metrics.since("read", start)
+        theData = finishRead(connection, theData, plan, fullRead, modeAwake)
 
     except Exception as ex:  # Catch all modbus excpetions
-        e = sys.exc_info()[0]
+        return failedRead(connection, ex)
+
+    return decodeRead(theData, connection, metrics)
+
+
+# --------------------------------------------------------------------------- #
+# What getModbusData and getModbusDataAsync share around the reads
+# --------------------------------------------------------------------------- #
+
+# The answer to the test read after connecting, False (and closed) when it failed
+def connectionChecked(connection, result):
+    if result.isError():
+        # close the client
+        log.error("MODBUS isError H:{} P:{}".format(connection.classicHost, connection.classicPort))
+        connection.close()
+        return False
+    connection.isConnected = True
+    return True
+
+
+# Cache what was read and give up the connection when snoozing, returns the
+# blocks to decode
+def finishRead(connection, theData, plan, fullRead, modeAwake):
+    theData = updateRegisterCache(connection, theData, fullRead)
+    logReadPlan(plan, fullRead)
+
+    # If we are snoozing, then give up the connection
+    log.debug("modeAwake:{}".format(modeAwake))
+    if not modeAwake:
+        log.debug("Closing the modbus Connection, we are in Snooze mode")
+        connection.close()
+    return theData
+
+
+# Log the exception and close the connection, returns the empty data
+def failedRead(connection, ex):
+    e = sys.exc_info()[0]
+    log.error(
+        "MODBUS ErrorH:{} P:{} e:{}, ex: {}".format(connection.classicHost, connection.classicPort, e, ex)
+    )
+    try:
+        connection.close()
+
+    except Exception as ex:
         log.error(
-            "MODBUS ErrorH:{} P:{} e:{}, ex: {}".format(classicHost, classicPort, e, ex)
+            "MODBUS Error on close H:{} P:{} ex: {}".format(
+                connection.classicHost, connection.classicPort, ex
+            )
         )
-        try:
-            modbusClient.close()
-            isConnected = False
-            modbusClient = None  # Ajouté par Daniel Côté
 
-        except Exception as ex:
+    return {}
+
+
+def decodeRead(theData, connection, metrics):
+    log.debug("Got data from Classic at {}:{}".format(connection.classicHost, connection.classicPort))
+
+    if metrics is not None:
+        start = perf_counter()
+        decoded = decodeModbusData(theData, connection.classicHost, connection)
+        metrics.since("decode", start)
+        return decoded
+    return decodeModbusData(theData, connection.classicHost, connection)
+
+
+# --------------------------------------------------------------------------- #
+# Async version of getModbusData for the asyncio runtime. The connection keeps
+# an AsyncModbusTcpClient so many Classics can be read at the same time on one
+# event loop.
+# --------------------------------------------------------------------------- #
+async def getRegistersAsync(theClient, addr, cnt):
+    try:
+        result = await theClient.read_holding_registers(addr, count=cnt, slave=10)
+        if result.function_code >= 0x80:
             log.error(
-                "MODBUS Error on close H:{} P:{} ex: {}".format(
-                    classicHost, classicPort
-                ),
-                ex,
+                "error getting {} for {} bytes, result.function_code >=0x80: {}".format(
+                    addr, cnt, result.function_code
+                )
             )
-
+            return {}
+    except Exception as ex:
+        log.error("Error getting {} for {} bytes, exeption:{}".format(addr, cnt, ex))
         return {}
 
-    log.debug("Got data from Classic at {}:{}".format(classicHost, classicPort))
+    return result.registers
+
+
+async def readPlannedRegistersAsync(theClient, plan, metrics=None):
+    theData = {}
+    for addr, cnt, members in plan:
+        if metrics is not None:
+            start = perf_counter()
+        registers = await getRegistersAsync(theClient=theClient, addr=addr, cnt=cnt)
+        if metrics is not None:
+            metrics.since("modbusRtt", start)
+        for blockAddr, blockCnt in members:
+            if not registers:
+                theData[blockAddr] = registers
+            else:
+                offset = blockAddr - addr
+                theData[blockAddr] = registers[offset : offset + blockCnt]
+    return theData
+
+
+async def getModbusDataAsync(
+    modeAwake,
+    classicHost,
+    classicPort,
+    maxGap=DEFAULT_MAX_READ_GAP,
+    connection=None,
+    refreshStatic=True,
+    metrics=None,
+):
+
+    if connection is None:
+        connection = getConnection(classicHost, classicPort)
+
+    try:
+        if not connection.isConnected:
+            log.debug("Opening the modbus Connection")
+            if connection.modbusClient is None:
+                # We handle reconnecting ourselves, so turn it off in the client
+                connection.modbusClient = AsyncModbusClient(
+                    host=classicHost, port=classicPort, reconnect_delay=0
+                )
+
+            # Test for successful connect, if not, log error and mark modbusConnected = False
+            if metrics is not None:
+                metrics.count("modbusConnects")
+                start = perf_counter()
+            await connection.modbusClient.connect()
+            if metrics is not None:
+                metrics.since("connect", start)
+
+            result = await connection.modbusClient.read_holding_registers(
+                4163, count=2, slave=10
+            )
+            if not connectionChecked(connection, result):
+                return {}
+
+        # Read in the registers using as few requests as possible, the static
+        # ones come from the cache unless a refresh is asked for
+        plan, fullRead = selectReadPlan(connection, refreshStatic, maxGap)
+        if metrics is not None:
+            start = perf_counter()
+        theData = await readPlannedRegistersAsync(connection.modbusClient, plan, metrics)
+        if metrics is not None:
+            metrics.since("read", start)
+        theData = finishRead(connection, theData, plan, fullRead, modeAwake)
+
+    except Exception as ex:  # Catch all modbus excpetions
+        return failedRead(connection, ex)
+
+    return decodeRead(theData, connection, metrics)
+
+
+# --------------------------------------------------------------------------- #
+# Change detection.
+# At night the registers are often the same from one poll to the next, apart
+# from the clock and the StatusRoll/RsetTmms counters. The fingerprint is all
+# the other registers, when it has not changed the derived fields are too and
+# only the blocks that changed are decoded again. connection.changed tells the
+# caller whether anything but the clock has changed.
+# --------------------------------------------------------------------------- #
+FINGERPRINT_IGNORED = [(4112, 2), (4213, 6)]
+
+fingerprintSlices = {}
+
+
+# The (start, end) slices of a block that go into the fingerprint
+def getFingerprintSlices(blockAddr, blockCnt):
+    key = (blockAddr, blockCnt)
+    if key not in fingerprintSlices:
+        slices = []
+        start = 0
+        for addr, cnt in FINGERPRINT_IGNORED:
+            first = max(addr - blockAddr, start)
+            last = min(addr + cnt - blockAddr, blockCnt)
+            if first < last:
+                if start < first:
+                    slices.append((start, first))
+                start = last
+        if start < blockCnt:
+            slices.append((start, blockCnt))
+        fingerprintSlices[key] = slices
+    return fingerprintSlices[key]
+
+
+def registerFingerprint(theData):
+    fingerprint = []
+    for addr, registers in theData.items():
+        for start, end in getFingerprintSlices(addr, len(registers)):
+            fingerprint += registers[start:end]
+    return tuple(fingerprint)
+
+
+# --------------------------------------------------------------------------- #
+# Decode the registers read from the Classic and add the derived fields.
+# Given the connection, what has not changed since the last call is not
+# decoded again.
+# --------------------------------------------------------------------------- #
+def decodeModbusData(theData, classicHost, connection=None):
+
+    if connection is not None:
+        fingerprint = registerFingerprint(theData)
+        connection.changed = fingerprint != connection.fingerprint
+        connection.fingerprint = fingerprint
+        if not connection.changed and connection.decoded is not None:
+            # Only the ignored registers can have changed, redo their blocks.
+            # A block decoded again has its raw values back (Type is 251 again),
+            # so the derived fields are added again too
+            decoded = dict(connection.decoded)
+            redecoded = False
+            for index in theData:
+                if theData[index] != connection.rawBlocks.get(index):
+                    decoded.update(decodeBlock(index, theData[index]))
+                    connection.rawBlocks[index] = list(theData[index])
+                    redecoded = True
+            if redecoded:
+                addDerivedFields(decoded, classicHost)
+            connection.decoded = decoded
+            return decoded
 
     # Iterate over them and get the decoded data all into one dict
+    # using the compiled register map (see classic_registermap)
     decoded = {}
     for index in theData:
-        decoded = {
-            **dict(decoded),
-            **dict(doDecode(index, getDataDecoder(theData[index]))),
-        }
+        decoded.update(decodeBlock(index, theData[index]))
+    addDerivedFields(decoded, classicHost)
+
+    if connection is not None:
+        connection.rawBlocks = {index: list(theData[index]) for index in theData}
+        connection.decoded = decoded
+
+    return decoded
+
+
+# --------------------------------------------------------------------------- #
+# Add the derived fields (texts, icons, MAC, name...) to the decoded registers
+# --------------------------------------------------------------------------- #
+def addDerivedFields(decoded, classicHost):
 
     # Device type 251 is different
     if decoded["Type"] == 251:
@@ -305,19 +694,8 @@ def getModbusData(modeAwake, classicHost, classicPort):
     elif decoded["ChargeStage"] >= 7:
         decoded["ChargeStateIcon"] = "mdi:approximately-equal"
     #
-    chrg_stt_txt_arr = {
-        0: "Resting",
-        3: "Absorb",
-        4: "Bulk MPPT",
-        5: "Float",
-        6: "Float MPPT",
-        7: "Equalize",
-        10: "HyperVOC",
-        18: "Equalize MPPT",
-    }
-
     try:
-        decoded["ChargeStateText"] = chrg_stt_txt_arr[decoded["ChargeStage"]]
+        decoded["ChargeStateText"] = CHARGE_STATE_TEXT[decoded["ChargeStage"]]
     except:
         log.error(
             "ChargeStateText error. Undefined value:{}".format(decoded["ChargeStage"])
@@ -327,54 +705,8 @@ def getModbusData(modeAwake, classicHost, classicPort):
         )
 
     # AUX configured function
-    AUX1_funct = {
-        1: "DIVERSION SLW+",
-        2: "DIVERSION SLW-",
-        3: "BAT DIV V REL+",
-        4: "BAT DIV V REL-",
-        5: "GEN STOP +",
-        6: "GEN STOP -",
-        7: "PV V TRIGGER +",
-        8: "PV V TRIGGER -",
-        9: "MANUAL ON-OFF",
-        10: "BULK +",
-        11: "RESTING +",
-        12: "ERRORS 1 +",
-        13: "TOGGLE TEST",
-        14: "NITE LITE HIGH",
-        15: "NITE LITE LOW",
-        16: "WIND CLIPPER +",
-        17: "FLOAT +",
-        18: "FLOAT -",
-        19: "VENT FAN +",
-        20: "VENT FAN -",
-        21: "GFP TRIP",
-    }
-
-    AUX2_funct = {
-        0: "DIVERSION HIGH PWM",
-        1: "DIVERSION LOW PWM",
-        2: "WASTE NOT HIGH",
-        3: "WASTE NOT LOW",
-        4: "RESERVED",
-        5: "RESERVED",
-        6: "TOGGLE TEST",
-        7: "PV V ON HIGH",
-        8: "PV V ON LOW",
-        9: "RESERVED",
-        10: "WIND CLIPPER CONTROL",
-        11: "NITE LIGHT HIGH",
-        12: "DAY LIGHT HIGH",
-        13: "FLOAT HIGH OUTPUT",
-        14: "FLOAT LOW OUTPUT",
-        15: "Active HIGH (input) turn off",
-        16: "Active LOW (input) turn off",
-        17: "Active HIGH (input) Float",
-        18: "Whizbang Junior (WB Jr.)",
-    }
-
     try:
-        decoded["Aux1FunctionText"] = AUX1_funct[decoded["Aux1Function"] & 0x3f] #Aux12Function bits 0-5
+        decoded["Aux1FunctionText"] = AUX1_FUNCTION_TEXT[decoded["Aux1Function"] & 0x3f] #Aux12Function bits 0-5
     except:
         log.error(
             "Aux1FunctionText error. Undefined value:{}".format(decoded["Aux1Function"])
@@ -383,7 +715,7 @@ def getModbusData(modeAwake, classicHost, classicPort):
             str(decoded["Aux1Function"])
         )
     try:
-        decoded["Aux2FunctionText"] = AUX2_funct[decoded["Aux2Function"]& 0x3f] #Aux12Function bits 8-13
+        decoded["Aux2FunctionText"] = AUX2_FUNCTION_TEXT[decoded["Aux2Function"]& 0x3f] #Aux12Function bits 8-13
     except:
         log.error(
             "Aux2FunctionText error. Undefined value:{}".format(decoded["Aux2Function"])
@@ -393,18 +725,8 @@ def getModbusData(modeAwake, classicHost, classicPort):
         )
 
     # MPPT Mode
-    mppt_mode = {
-        1: "PV_Uset",
-        3: "DYNAMIC",
-        5: "WIND TRACK",
-        7: "RESERVED",
-        9: "Legacy P&O",
-        11: "SOLAR",
-        13: "HYDRO",
-        15: "RESERVED",
-    }
     try:
-        decoded["MPPTModeText"] = mppt_mode[decoded["MPPTMode"]]
+        decoded["MPPTModeText"] = MPPT_MODE_TEXT[decoded["MPPTMode"]]
     except:
         log.error("MPPTModeText error. Undefined value:{}".format(decoded["MPPTMode"]))
         decoded["MPPTModeText"] = "No text defined for this value...{}".format(
@@ -419,47 +741,9 @@ def getModbusData(modeAwake, classicHost, classicPort):
         SOCicon = "mdi:battery"
     decoded["SOCicon"] = SOCicon
     # Rest reason
-    rest_reason_arr = {
-        1: "Anti-Click. Not enough power available (Wake Up)",
-        2: " Insane Ibatt Measurement (Wake Up)",
-        3: " Negative Current (load on PV input ?) (Wake Up)",
-        4: " PV Input Voltage lower than Battery V (Vreg state)",
-        5: " Too low of power out and Vbatt below set point for > 90 seconds",
-        6: " FET temperature too high (Cover is on maybe?)",
-        7: " Ground Fault Detected",
-        8: " Arc Fault Detected",
-        9: " Too much negative current while operating (backfeed from battery out of PV input)",
-        10: "Battery is less than 8.0 Volts",
-        11: "PV input is available but V is rising too slowly. Low Light or bad connection(Solar mode)",
-        12: "Voc has gone down from last Voc or low light. Re-check (Solar mode)",
-        13: "Voc has gone up from last Voc enough to be suspicious. Re-check (Solar mode)",
-        14: "PV input is available but V is rising too slowly. Low Light or bad connection(Solar mode)",
-        15: "Voc has gone down from last Voc or low light. Re-check (Solar mode)",
-        16: "Mppt MODE is OFF (Usually because user turned it off)",
-        17: "PV input is higher than operation range (too high for 150V Classic)",
-        18: "PV input is higher than operation range (too high for 200V Classic)",
-        19: "PV input is higher than operation range (too high for 250V or 250KS)",
-        22: "Average Battery Voltage is too high above set point",
-        25: "Battery Voltage too high of Overshoot (small battery or bad cable ?)",
-        26: "Mode changed while running OR Vabsorb raised more than 10.0 Volts at once OR Nominal Vbatt changed by modbus command AND MpptMode was ON when changed",
-        27: "bridge center == 1023 (R132 might have been stuffed) This turns MPPT Mode to OFF",
-        28: "NOT Resting but RELAY is not engaged for some reason",
-        29: "ON/OFF stays off because WIND GRAPH is illegal (current step is set for > 100 amps)",
-        30: "PkAmpsOverLimit… Software detected too high of PEAK output current",
-        31: "AD1CH.IbattMinus > 900 Peak negative battery current > 90.0 amps (Classic 250)",
-        32: "Aux 2 input commanded Classic off. for HI or LO (Aux2Function == 15 or 16)",
-        33: "OCP in a mode other than Solar or PV-Uset",
-        34: "AD1CH.IbattMinus > 900 Peak negative battery current > 90.0 amps (Classic 150, 200)",
-        35: "Battery voltage is less than Low Battery Disconnect (LBD) Typically Vbatt is less than 8.5 volts",
-        38: "Raison non définie dans classic_modbusdecoder.py...",
-        104: "104?=14?: PV input is available but V is rising too slowly. Low Light or bad connection(Solar mode)",
-        111: "Normal Power up boot.",
-    }
     try:
         idx = decoded["ReasonForResting"]
-        decoded["ReasonForRestingText"] = rest_reason_arr[idx]
+        decoded["ReasonForRestingText"] = REST_REASON_TEXT[idx]
     except:
         log.error("ReasonForRestingText Error index:{}".format(idx))
         decoded["ReasonForRestingText"] = "Unknown code: {}".format(idx)
-
-    return decoded
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------------------------- #
+# MODBUS TCP proxy for a Classic.
+# The Classic only takes a couple of MODBUS TCP connections at a time, so
+# other readers (like the Home Assistant MODBUS integration) fight with
+# classic_mqtt for them. The proxy is a MODBUS TCP server on the classic_mqtt
+# event loop that answers read holding registers (function 3) from the
+# registers classic_mqtt last read, as long as they are no older than maxAge
+# seconds. Anything else that is read is forwarded to the Classic over the
+# connection classic_mqtt already has open.
+#
+# When the Classic is snoozing classic_mqtt closes its connection between
+# reads; requests the snapshot cannot answer then get exception 11 (gateway
+# target failed to respond) rather than opening another connection.
+# Writes are not passed on, they get exception 1 (illegal function).
+# --------------------------------------------------------------------------- #
+
+import asyncio
+import logging
+import struct
+from time import monotonic
+
+log = logging.getLogger('classic_mqtt')
+
+READ_HOLDING_REGISTERS      = 3
+MODBUS_MAX_READ_COUNT       = 125
+ILLEGAL_FUNCTION            = 1
+ILLEGAL_DATA_VALUE          = 3
+SERVER_DEVICE_FAILURE       = 4
+GATEWAY_TARGET_FAILED       = 11
+MIN_MBAP_LENGTH             = 2         #the unit id and a function code
+MAX_MBAP_LENGTH             = 254       #the unit id and the longest (253 byte) PDU
+
+
+class ModbusProxy:
+
+    def __init__(self, device, host, port, maxAge):
+        self.device = device
+        self.host = host
+        self.port = port
+        self.maxAge = maxAge            #seconds a snapshot can be used for
+        self.server = None
+        self.writers = set()
+
+        self.hits = 0
+        self.misses = 0
+
+    # --------------------------------------------------------------------------- #
+    # The registers from the snapshot, or None if it does not have all of them
+    # or is too old
+    # --------------------------------------------------------------------------- #
+    def fromSnapshot(self, addr, cnt):
+        connection = self.device.connection
+        if monotonic() - connection.snapshotTime > self.maxAge:
+            return None
+        values = [None] * cnt
+        found = 0
+        for blockAddr, registers in connection.snapshot.items():
+            start = max(addr, blockAddr)
+            end = min(addr + cnt, blockAddr + len(registers))
+            if start < end:
+                values[start - addr : end - addr] = registers[start - blockAddr : end - blockAddr]
+                found += end - start
+        return values if found == cnt else None
+
+    async def fromClassic(self, addr, cnt):
+        connection = self.device.connection
+        if not connection.isConnected or connection.modbusClient is None:
+            return None
+        try:
+            result = await connection.modbusClient.read_holding_registers(addr, count=cnt, slave=10)
+        except Exception as ex:
+            log.error("MODBUS proxy error reading {} for {} from {}: {}".format(addr, cnt, self.device.classicName, ex))
+            return SERVER_DEVICE_FAILURE
+        if result.isError():
+            return SERVER_DEVICE_FAILURE
+        return result.registers
+
+    async def answer(self, pdu):
+        function = pdu[0]
+        if function != READ_HOLDING_REGISTERS:
+            return bytes([function | 0x80, ILLEGAL_FUNCTION])
+        if len(pdu) < 5:
+            return bytes([function | 0x80, ILLEGAL_DATA_VALUE])
+        addr, cnt = struct.unpack_from(">HH", pdu, 1)
+        if cnt < 1 or cnt > MODBUS_MAX_READ_COUNT:
+            return bytes([function | 0x80, ILLEGAL_DATA_VALUE])
+
+        metrics = self.device.metrics
+        values = self.fromSnapshot(addr, cnt)
+        if values is not None:
+            self.hits += 1
+            if metrics is not None:
+                metrics.count("proxyHits")
+        else:
+            self.misses += 1
+            if metrics is not None:
+                metrics.count("proxyMisses")
+            values = await self.fromClassic(addr, cnt)
+            if values is None:
+                return bytes([function | 0x80, GATEWAY_TARGET_FAILED])
+            if values == SERVER_DEVICE_FAILURE:
+                return bytes([function | 0x80, SERVER_DEVICE_FAILURE])
+        return struct.pack(">BB{}H".format(cnt), function, cnt * 2, *values)
+
+    async def handle(self, reader, writer):
+        self.writers.add(writer)
+        try:
+            while True:
+                header = await reader.readexactly(7)
+                transaction, protocol, length, unitId = struct.unpack(">HHHB", header)
+                if length < MIN_MBAP_LENGTH or length > MAX_MBAP_LENGTH:
+                    log.warning("MODBUS proxy for {} got a request of length {}, closing the connection".format(self.device.classicName, length))
+                    break
+                pdu = await reader.readexactly(length - 1)
+                response = await self.answer(pdu)
+                writer.write(struct.pack(">HHHB", transaction, protocol, len(response) + 1, unitId) + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        log.info("MODBUS proxy for {} listening on {}:{}".format(self.device.classicName, self.host, self.port))
+        return self
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            for writer in list(self.writers):
+                writer.close()
+            await self.server.wait_closed()
+            log.info("MODBUS proxy for {} answered {} from the snapshot, {} from the Classic".format(self.device.classicName, self.hits, self.misses))
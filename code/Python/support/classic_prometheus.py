@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------------------------- #
+# Prometheus metrics endpoint.
+# An HTTP server on the classic_mqtt event loop that answers GET /metrics
+# with the latest readings of every Classic in the Prometheus text format,
+# so a Prometheus server can scrape classic_mqtt without an MQTT exporter:
+#
+#    # HELP classic_bat_voltage The Classic's BatVoltage reading
+#    # TYPE classic_bat_voltage gauge
+#    classic_bat_voltage{classic="MyWorkshop"} 27.2
+#    ...
+#    # TYPE classic_total_energy_total counter
+#    classic_total_energy_total{classic="MyWorkshop"} 1234.5
+#    # TYPE classic_state_info gauge
+#    classic_state_info{classic="MyWorkshop",charge_state="BulkMppt",...} 1
+#
+# Each reading is a gauge named after its field in snake case, Aux1 and Aux2
+# are 1 or 0, TotalEnergy (kWh since the Classic was made) is a counter and
+# the texts are the labels of classic_state_info. When the metrics are on,
+# the counters of the polling cycle go along as classic_mqtt_<counter>_total.
+#
+# A scrape never reads from the Classic. periodic hands over each new
+# reading with update(), the text is rendered at the first scrape after it
+# and kept, the scrapes until the next reading get the same bytes (gzipped
+# when asked for, also kept).
+# --------------------------------------------------------------------------- #
+
+import asyncio
+import gzip
+import logging
+import re
+
+from support.classic_binaryencoder import READINGS_LAYOUT
+from support.classic_jsonencoder import READINGS_KEYS
+
+log = logging.getLogger('classic_mqtt')
+
+METRICS_PATH = "/metrics"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+PROMETHEUS_SKIPPED = ("currentTime", "ChargeStateIcon", "SOCicon")   #the Classic's clock and the icons
+COUNTER_READINGS = ("TotalEnergy",)     #only ever goes up
+MAX_REQUEST_BYTES = 8192
+REQUEST_TIMEOUT_SECS = 10
+
+
+# --------------------------------------------------------------------------- #
+# BatVoltage -> bat_voltage, PVVoltage -> pv_voltage
+# --------------------------------------------------------------------------- #
+def snakeCase(name):
+    return re.sub(r"(?<=[a-z0-9])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])", "_", name).lower()
+
+
+def escapeLabel(text):
+    return str(text).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# --------------------------------------------------------------------------- #
+# (name, type, help, index in readingsValues, kind) of the reading metrics,
+# and (label, index in readingsValues) of the classic_state_info labels
+# --------------------------------------------------------------------------- #
+def buildFamilies():
+    families = []
+    labels = []
+    for name, kind, scale in READINGS_LAYOUT:
+        if name in PROMETHEUS_SKIPPED:
+            continue
+        index = READINGS_KEYS.index(name)
+        if kind == "text":
+            labels.append((snakeCase(name[:-len("Text")] if name.endswith("Text") else name), index))
+        elif name in COUNTER_READINGS:
+            families.append(("classic_{}_total".format(snakeCase(name)), "counter", "The Classic's {} reading".format(name), index, kind))
+        else:
+            families.append(("classic_{}".format(snakeCase(name)), "gauge", "The Classic's {} reading".format(name), index, kind))
+    return families, labels
+
+
+READINGS_FAMILIES, STATE_LABELS = buildFamilies()
+
+
+class PrometheusExporter:
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.server = None
+        self.writers = set()
+
+        self.latest = {}        #{classicName: (taken, readingsValues, counters or None)}
+        self.body = None        #the rendered text, None when a new reading came in
+        self.gzipped = None
+
+        self.scrapes = 0
+        self.renders = 0
+
+    # --------------------------------------------------------------------------- #
+    # A new reading of a Classic (readingsValues) taken at taken (seconds since
+    # the epoch), with a copy of its cycle counters when the metrics are on
+    # --------------------------------------------------------------------------- #
+    def update(self, classicName, values, taken, counters=None):
+        self.latest[classicName] = (taken, values, counters)
+        self.body = None
+        self.gzipped = None
+
+    # --------------------------------------------------------------------------- #
+    # The text of the latest readings, grouped by metric as the format wants
+    # --------------------------------------------------------------------------- #
+    def render(self):
+        classics = [(escapeLabel(classicName), self.latest[classicName]) for classicName in sorted(self.latest)]
+        lines = []
+        for name, kind, help, index, valueKind in READINGS_FAMILIES:
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for classic, (taken, values, counters) in classics:
+                value = values[index]
+                lines.append('{}{{classic="{}"}} {}'.format(name, classic, int(value) if valueKind == "bool" else value))
+
+        lines.append("# HELP classic_state_info The Classic's state texts")
+        lines.append("# TYPE classic_state_info gauge")
+        for classic, (taken, values, counters) in classics:
+            texts = "".join(',{}="{}"'.format(label, escapeLabel(values[index])) for label, index in STATE_LABELS)
+            lines.append('classic_state_info{{classic="{}"{}}} 1'.format(classic, texts))
+
+        lines.append("# HELP classic_last_reading_timestamp_seconds When the latest reading was taken")
+        lines.append("# TYPE classic_last_reading_timestamp_seconds gauge")
+        for classic, (taken, values, counters) in classics:
+            lines.append('classic_last_reading_timestamp_seconds{{classic="{}"}} {:.3f}'.format(classic, taken))
+
+        withCounters = [(classic, counters) for classic, (taken, values, counters) in classics if counters is not None]
+        if withCounters:
+            for counter in withCounters[0][1]:
+                name = "classic_mqtt_{}_total".format(snakeCase(counter))
+                lines.append("# HELP {} The {} counter of the polling cycle".format(name, counter))
+                lines.append("# TYPE {} counter".format(name))
+                for classic, counters in withCounters:
+                    lines.append('{}{{classic="{}"}} {}'.format(name, classic, counters[counter]))
+
+        self.renders += 1
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+    # --------------------------------------------------------------------------- #
+    # The body to send, rendered once per reading
+    # --------------------------------------------------------------------------- #
+    def metrics(self, gzipped):
+        if self.body is None:
+            self.body = self.render()
+        if not gzipped:
+            return self.body
+        if self.gzipped is None:
+            self.gzipped = gzip.compress(self.body)
+        return self.gzipped
+
+    def response(self, status, reason, body=b"", headers=()):
+        head = ["HTTP/1.1 {} {}".format(status, reason), "Content-Length: {}".format(len(body)), "Connection: close"]
+        head += list(headers)
+        return ("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body
+
+    # --------------------------------------------------------------------------- #
+    # Answer one request and close the connection
+    # --------------------------------------------------------------------------- #
+    async def handle(self, reader, writer):
+        self.writers.add(writer)
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), REQUEST_TIMEOUT_SECS)
+            lines = request.decode("latin-1").split("\r\n")
+            parts = lines[0].split(" ")
+            method, path = (parts[0], parts[1].split("?")[0]) if len(parts) == 3 else (None, None)
+            headers = {}
+            for line in lines[1:]:
+                key, sep, value = line.partition(":")
+                if sep:
+                    headers[key.strip().lower()] = value.strip()
+
+            if method not in ("GET", "HEAD"):
+                answer = self.response(405, "Method Not Allowed", headers=("Allow: GET, HEAD",))
+            elif path != METRICS_PATH:
+                answer = self.response(404, "Not Found")
+            else:
+                self.scrapes += 1
+                gzipped = "gzip" in headers.get("accept-encoding", "")
+                body = self.metrics(gzipped)
+                headers = ["Content-Type: {}".format(CONTENT_TYPE)] + (["Content-Encoding: gzip"] if gzipped else [])
+                answer = self.response(200, "OK", body, headers)
+                if method == "HEAD":
+                    answer = answer[:len(answer) - len(body)]
+            writer.write(answer)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError, asyncio.CancelledError):
+            pass
+        except Exception as e:
+            log.error("Caught Error answering a metrics scrape: {}".format(e))
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port, limit=MAX_REQUEST_BYTES)
+        log.info("Prometheus metrics on http://{}:{}{}".format(self.host, self.port, METRICS_PATH))
+        return self
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            for writer in list(self.writers):
+                writer.close()
+            await self.server.wait_closed()
+            log.info("Prometheus endpoint answered {} scrapes with {} renders".format(self.scrapes, self.renders))
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------------------------- #
+# The publish stage.
+# The Classics' polling tasks hand their messages to an MqttPublisher and go
+# back to polling, a task of its own publishes them. The polling cadence does
+# not depend on the broker then: a slow or lost broker fills the queue, it
+# does not hold up the MODBUS reads.
+#
+# The queue is bounded, when it is full the oldest message is dropped. The
+# messages are only passed to paho while MQTT is connected, and no more
+# than maxInflight at a time. paho's message ids are tracked through
+# on_publish, each submit returns a future that is done with True when the
+# message was sent (QoS 0) or acknowledged by the broker (QoS 1 and 2), or
+# with False when it was dropped or failed. A message can be held back
+# until such a future is done (after=), so "discovery before state" is
+# ensured by the broker's acknowledgement rather than by waiting a while.
+#
+# Over MQTT v5 a message can carry properties=(expiry, userProperties,
+# alias): the message expiry in seconds (less the time it waited in the
+# queue), a list of (name, value) user properties and whether its topic gets
+# a topic alias. The aliases are handed out per connection, up to the
+# broker's Topic Alias Maximum, only to QoS 0 messages as paho would send
+# the others again with just the alias after a reconnect. A PUBACK with a
+# failure reason code fails the message.
+# --------------------------------------------------------------------------- #
+
+import asyncio
+import logging
+from collections import deque
+from time import perf_counter
+
+from paho.mqtt import client as mqttclient
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
+
+log = logging.getLogger('classic_mqtt')
+
+DEFAULT_MAX_INFLIGHT = 20       #paho's own default for QoS>0
+AFTER_TIMEOUT_SECS = 10         #longest a message waits for the one it has to come after
+
+
+class PublishRequest:
+
+    __slots__ = ("topic", "payload", "qos", "retain", "after", "future", "metrics", "properties", "submitted")
+
+    def __init__(self, topic, payload, qos, retain, after, future, metrics, properties=None):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.after = after
+        self.future = future
+        self.metrics = metrics
+        self.properties = properties
+        self.submitted = perf_counter()
+
+
+class MqttPublisher:
+
+    def __init__(self, client, maxQueue, maxInflight=DEFAULT_MAX_INFLIGHT):
+        self.maxQueue = maxQueue
+        self.maxInflight = maxInflight
+        self.queue = deque()
+        self.pending = {}               #mid: PublishRequest waiting for on_publish
+        self.wakeup = asyncio.Event()   #something was queued, MQTT connected or a message was acknowledged
+        self.connected = False
+        self.task = None
+
+        self.protocol5 = False          #connected with MQTT v5
+        self.aliasMaximum = 0           #the broker's Topic Alias Maximum
+        self.aliases = {}               #topic: alias on this connection
+
+        self.dropped = 0
+        self.failed = 0
+        self.onFailure = None           #called with the request of each failed publish
+
+        self.setClient(client)
+
+    # A new client, when falling back from MQTT v5
+    def setClient(self, client):
+        self.client = client
+        client.on_publish = self.on_publish
+
+    def depth(self):
+        return len(self.queue)
+
+    def inflight(self):
+        return len(self.pending)
+
+    # --------------------------------------------------------------------------- #
+    # Queue a message, returns the future of its publish
+    # --------------------------------------------------------------------------- #
+    def submit(self, topic, payload, qos=0, retain=False, after=None, metrics=None, properties=None):
+        future = asyncio.get_running_loop().create_future()
+        if len(self.queue) >= self.maxQueue:
+            oldest = self.queue.popleft()
+            self.dropped += 1
+            if oldest.metrics is not None:
+                oldest.metrics.count("publishDropped")
+            oldest.future.set_result(False)
+            log.debug("Publish queue full, dropped {}".format(oldest.topic))
+        self.queue.append(PublishRequest(topic, payload, qos, retain, after, future, metrics, properties))
+        self.wakeup.set()
+        return future
+
+    def finish(self, request, published):
+        if not request.future.done():
+            request.future.set_result(published)
+        if published:
+            if request.metrics is not None:
+                request.metrics.since("ack", request.submitted)
+        else:
+            self.failed += 1
+            if self.onFailure is not None:
+                self.onFailure(request)
+
+    # --------------------------------------------------------------------------- #
+    # paho callbacks, they run on the event loop (see AsyncioHelper). paho's
+    # version 2 callbacks (the MQTT v5 mode) also pass the reason code
+    # --------------------------------------------------------------------------- #
+    def on_publish(self, client, userdata, mid, reasonCode=None, properties=None):
+        request = self.pending.pop(mid, None)
+        if request is not None:
+            if reasonCode is not None and reasonCode.is_failure:
+                log.error("MQTT Publish Error Topic:{} reason:{}".format(request.topic, reasonCode))
+                self.finish(request, False)
+            else:
+                self.finish(request, True)
+            self.wakeup.set()
+
+    def setConnected(self, connected, protocol5=False, aliasMaximum=0):
+        self.connected = connected
+        self.protocol5 = protocol5
+        self.aliasMaximum = aliasMaximum
+        self.aliases = {}
+        if not connected:
+            # paho drops the QoS 0 messages it had not sent, it sends the others again when reconnected
+            for mid, request in list(self.pending.items()):
+                if request.qos == 0:
+                    del self.pending[mid]
+                    self.finish(request, False)
+        self.wakeup.set()
+
+    # --------------------------------------------------------------------------- #
+    # The publish task
+    # --------------------------------------------------------------------------- #
+    async def run(self):
+        while True:
+            if not self.queue or not self.connected or len(self.pending) >= self.maxInflight:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            request = self.queue[0]
+            if request.after is not None and not request.after.done():
+                try:
+                    await asyncio.wait_for(asyncio.shield(request.after), AFTER_TIMEOUT_SECS)
+                except asyncio.TimeoutError:
+                    log.warning("Publishing {} without the acknowledgement it waits for".format(request.topic))
+                    request.after = None
+                continue    #the queue may have changed while waiting
+            self.queue.popleft()
+            self.publish(request)
+
+    def publish(self, request):
+        topic, properties = request.topic, None
+        if self.protocol5 and request.properties is not None:
+            topic, properties = self.publishProperties(request)
+        try:
+            info = self.client.publish(topic, request.payload, qos=request.qos, retain=request.retain, properties=properties)
+        except Exception as e:
+            log.error("MQTT Publish Error Topic:{}".format(request.topic))
+            log.exception(e, exc_info=True)
+            self.dropAlias(request, topic)
+            self.finish(request, False)
+            return
+        if info.rc != mqttclient.MQTT_ERR_SUCCESS:
+            log.error("MQTT Publish Error Topic:{} rc:{}".format(request.topic, info.rc))
+            self.dropAlias(request, topic)
+            self.finish(request, False)
+        elif info.is_published():
+            self.finish(request, True)
+        else:
+            self.pending[info.mid] = request
+
+    # --------------------------------------------------------------------------- #
+    # The topic and the MQTT v5 properties to publish a message with
+    # --------------------------------------------------------------------------- #
+    def publishProperties(self, request):
+        expiry, userProperties, alias = request.properties
+        properties = Properties(PacketTypes.PUBLISH)
+        if expiry:
+            properties.MessageExpiryInterval = max(1, expiry - int(perf_counter() - request.submitted))
+        if userProperties:
+            properties.UserProperty = userProperties
+        topic = request.topic
+        if alias and request.qos == 0:
+            number = self.aliases.get(topic)
+            if number is not None:
+                topic = ""      #the broker has it from the first one
+            elif len(self.aliases) < self.aliasMaximum:
+                number = self.aliases[topic] = len(self.aliases) + 1
+            if number is not None:
+                properties.TopicAlias = number
+        return topic, properties
+
+    # The message that was to set up an alias did not go, the next one sets it up
+    def dropAlias(self, request, topic):
+        if topic and self.aliases.get(topic) == len(self.aliases):
+            del self.aliases[topic]
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run(), name="publisher")
+        return self
+
+    # --------------------------------------------------------------------------- #
+    # Give what is queued up to drainSecs to go out, then stop
+    # --------------------------------------------------------------------------- #
+    async def stop(self, drainSecs=2):
+        deadline = perf_counter() + drainSecs
+        while (self.queue or self.pending) and self.connected and perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        for request in list(self.queue) + list(self.pending.values()):
+            if not request.future.done():
+                request.future.set_result(False)
+        self.queue.clear()
+        self.pending.clear()
+        if self.dropped or self.failed:
+            log.info("Publisher dropped {} and failed {} messages".format(self.dropped, self.failed))
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------------------------- #
+# Batched readings.
+# At a 2 to 5 second wake rate each readings JSON is a message of its own,
+# with its topic and MQTT header. A ReadingsBatch gathers the readings of a
+# Classic until it holds maxCount of them or the oldest is maxSecs old, and
+# they are published as one message on stat/readingsbatch:
+#
+#    {"count": 3, "readings": [{"ts": 1717243200000, "BatVoltage": 27.2, ...},
+#                              {"ts": 1717243205000, ...}, ...]}
+#
+# ts is when the reading was taken, in milliseconds since the epoch. The
+# readings are the same JSON as on stat/readings, they are not encoded again,
+# ts is put in front of each. When compressed the message is the same JSON
+# compressed with zlib and goes on stat/readingsbatch/zlib.
+# --------------------------------------------------------------------------- #
+
+import logging
+import zlib
+
+log = logging.getLogger('classic_mqtt')
+
+BATCH_SUBTOPIC = "readingsbatch"
+BATCH_ZLIB_SUBTOPIC = "readingsbatch/zlib"
+ZLIB_LEVEL = 6
+
+
+class ReadingsBatch:
+
+    def __init__(self, maxCount, maxSecs, compress=False):
+        self.maxCount = maxCount    #0 for no limit on the count
+        self.maxSecs = maxSecs      #0 for no limit on the age
+        self.compress = compress
+        self.subtopic = BATCH_ZLIB_SUBTOPIC if compress else BATCH_SUBTOPIC
+        self.readings = []
+        self.started = None         #monotonic time of the oldest reading in the batch
+
+    def __len__(self):
+        return len(self.readings)
+
+    # --------------------------------------------------------------------------- #
+    # Add a readings JSON taken at taken (seconds since the epoch) and when
+    # (monotonic), returns True when the batch is due to be published
+    # --------------------------------------------------------------------------- #
+    def add(self, readings, taken, now):
+        if not self.readings:
+            self.started = now
+        self.readings.append('{"ts":%d,%s' % (taken * 1000, readings[1:]))
+        return self.due(now)
+
+    def due(self, now):
+        if not self.readings:
+            return False
+        if self.maxCount and len(self.readings) >= self.maxCount:
+            return True
+        return bool(self.maxSecs) and now - self.started >= self.maxSecs
+
+    # --------------------------------------------------------------------------- #
+    # The message of the readings gathered, and start a new batch
+    # --------------------------------------------------------------------------- #
+    def take(self):
+        payload = '{"count":%d,"readings":[%s]}' % (len(self.readings), ",".join(self.readings))
+        self.readings = []
+        self.started = None
+        if self.compress:
+            return zlib.compress(payload.encode("utf-8"), ZLIB_LEVEL)
+        return payload
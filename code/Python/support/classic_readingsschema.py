@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------------------------- #
+# The readings schema.
+# The text of the codes the Classic reports, the icons the readings can
+# have, the layout of the binary readings (see classic_binaryencoder.py)
+# with the schema that describes it, and their decoder. It only needs the standard library, so
+# readers of the binary and shared readings (client/classic_mqtt_client.py,
+# classic_sharedstate.py) do not need pymodbus.
+# --------------------------------------------------------------------------- #
+
+import json
+import struct
+import zlib
+
+
+# --------------------------------------------------------------------------- #
+# The text of the codes in the readings
+# --------------------------------------------------------------------------- #
+CHARGE_STATE_TEXT = {
+    0: "Resting",
+    3: "Absorb",
+    4: "Bulk MPPT",
+    5: "Float",
+    6: "Float MPPT",
+    7: "Equalize",
+    10: "HyperVOC",
+    18: "Equalize MPPT",
+}
+
+AUX1_FUNCTION_TEXT = {
+    1: "DIVERSION SLW+",
+    2: "DIVERSION SLW-",
+    3: "BAT DIV V REL+",
+    4: "BAT DIV V REL-",
+    5: "GEN STOP +",
+    6: "GEN STOP -",
+    7: "PV V TRIGGER +",
+    8: "PV V TRIGGER -",
+    9: "MANUAL ON-OFF",
+    10: "BULK +",
+    11: "RESTING +",
+    12: "ERRORS 1 +",
+    13: "TOGGLE TEST",
+    14: "NITE LITE HIGH",
+    15: "NITE LITE LOW",
+    16: "WIND CLIPPER +",
+    17: "FLOAT +",
+    18: "FLOAT -",
+    19: "VENT FAN +",
+    20: "VENT FAN -",
+    21: "GFP TRIP",
+}
+
+AUX2_FUNCTION_TEXT = {
+    0: "DIVERSION HIGH PWM",
+    1: "DIVERSION LOW PWM",
+    2: "WASTE NOT HIGH",
+    3: "WASTE NOT LOW",
+    4: "RESERVED",
+    5: "RESERVED",
+    6: "TOGGLE TEST",
+    7: "PV V ON HIGH",
+    8: "PV V ON LOW",
+    9: "RESERVED",
+    10: "WIND CLIPPER CONTROL",
+    11: "NITE LIGHT HIGH",
+    12: "DAY LIGHT HIGH",
+    13: "FLOAT HIGH OUTPUT",
+    14: "FLOAT LOW OUTPUT",
+    15: "Active HIGH (input) turn off",
+    16: "Active LOW (input) turn off",
+    17: "Active HIGH (input) Float",
+    18: "Whizbang Junior (WB Jr.)",
+}
+
+MPPT_MODE_TEXT = {
+    1: "PV_Uset",
+    3: "DYNAMIC",
+    5: "WIND TRACK",
+    7: "RESERVED",
+    9: "Legacy P&O",
+    11: "SOLAR",
+    13: "HYDRO",
+    15: "RESERVED",
+}
+
+REST_REASON_TEXT = {
+    1: "Anti-Click. Not enough power available (Wake Up)",
+    2: " Insane Ibatt Measurement (Wake Up)",
+    3: " Negative Current (load on PV input ?) (Wake Up)",
+    4: " PV Input Voltage lower than Battery V (Vreg state)",
+    5: " Too low of power out and Vbatt below set point for > 90 seconds",
+    6: " FET temperature too high (Cover is on maybe?)",
+    7: " Ground Fault Detected",
+    8: " Arc Fault Detected",
+    9: " Too much negative current while operating (backfeed from battery out of PV input)",
+    10: "Battery is less than 8.0 Volts",
+    11: "PV input is available but V is rising too slowly. Low Light or bad connection(Solar mode)",
+    12: "Voc has gone down from last Voc or low light. Re-check (Solar mode)",
+    13: "Voc has gone up from last Voc enough to be suspicious. Re-check (Solar mode)",
+    14: "PV input is available but V is rising too slowly. Low Light or bad connection(Solar mode)",
+    15: "Voc has gone down from last Voc or low light. Re-check (Solar mode)",
+    16: "Mppt MODE is OFF (Usually because user turned it off)",
+    17: "PV input is higher than operation range (too high for 150V Classic)",
+    18: "PV input is higher than operation range (too high for 200V Classic)",
+    19: "PV input is higher than operation range (too high for 250V or 250KS)",
+    22: "Average Battery Voltage is too high above set point",
+    25: "Battery Voltage too high of Overshoot (small battery or bad cable ?)",
+    26: "Mode changed while running OR Vabsorb raised more than 10.0 Volts at once OR Nominal Vbatt changed by modbus command AND MpptMode was ON when changed",
+    27: "bridge center == 1023 (R132 might have been stuffed) This turns MPPT Mode to OFF",
+    28: "NOT Resting but RELAY is not engaged for some reason",
+    29: "ON/OFF stays off because WIND GRAPH is illegal (current step is set for > 100 amps)",
+    30: "PkAmpsOverLimit… Software detected too high of PEAK output current",
+    31: "AD1CH.IbattMinus > 900 Peak negative battery current > 90.0 amps (Classic 250)",
+    32: "Aux 2 input commanded Classic off. for HI or LO (Aux2Function == 15 or 16)",
+    33: "OCP in a mode other than Solar or PV-Uset",
+    34: "AD1CH.IbattMinus > 900 Peak negative battery current > 90.0 amps (Classic 150, 200)",
+    35: "Battery voltage is less than Low Battery Disconnect (LBD) Typically Vbatt is less than 8.5 volts",
+    38: "Raison non définie dans classic_modbusdecoder.py...",
+    104: "104?=14?: PV input is available but V is rising too slowly. Low Light or bad connection(Solar mode)",
+    111: "Normal Power up boot.",
+}
+
+
+# --------------------------------------------------------------------------- #
+# The binary readings layout
+# --------------------------------------------------------------------------- #
+SCHEMA_VERSION = 1
+INLINE_TEXT = 255
+
+# (name, type, scale), type is a struct code, "text", "bool" or "datetime"
+READINGS_LAYOUT = [
+    ("currentTime", "datetime", None),
+    ("BatTemperature", "h", 10.0),
+    ("NetAmpHours", "i", None),
+    ("ChargeState", "B", None),
+    ("ChargeStateIcon", "text", None),
+    ("ChargeStateText", "text", None),
+    ("Aux1FunctionText", "text", None),
+    ("Aux2FunctionText", "text", None),
+    ("MPPTModeText", "text", None),
+    ("InfoFlagsBits", "I", None),
+    ("ReasonForResting", "H", None),
+    ("ReasonForRestingText", "text", None),
+    ("NegativeAmpHours", "i", None),
+    ("BatVoltage", "h", 10.0),
+    ("PVVoltage", "H", 10.0),
+    ("VbattRegSetPTmpComp", "h", 10.0),
+    ("TotalAmpHours", "H", None),
+    ("WhizbangBatCurrent", "h", 10.0),
+    ("BatCurrent", "H", 10.0),
+    ("PVCurrent", "H", 10.0),
+    ("ConnectionState", "B", None),
+    ("EnergyToday", "H", 10.0),
+    ("EqualizeTime", "H", None),
+    ("SOC", "H", None),
+    ("SOCicon", "text", None),
+    ("Aux1", "bool", None),
+    ("Aux2", "bool", None),
+    ("Power", "H", 1.0),
+    ("FETTemperature", "h", 10.0),
+    ("PositiveAmpHours", "I", None),
+    ("TotalEnergy", "I", 10.0),
+    ("FloatTimeTodaySeconds", "H", None),
+    ("RemainingAmpHours", "H", None),
+    ("AbsorbTime", "H", None),
+    ("ShuntTemperature", "h", 1.0),
+    ("PCBTemperature", "h", 10.0),
+]
+
+# The icons decodeModbusData can give
+CHARGE_STATE_ICONS = ["mdi:music-rest-whole", "mdi:battery-charging", "mdi:format-float-center", "mdi:approximately-equal"]
+SOC_ICONS = ["mdi:battery-{}0".format(tens) for tens in range(10)] + ["mdi:battery"] + \
+            ["mdi:battery-charging-{}0".format(tens) for tens in range(11)]
+
+
+def buildStrings():
+    strings = []
+    for texts in (CHARGE_STATE_ICONS, SOC_ICONS, CHARGE_STATE_TEXT.values(), AUX1_FUNCTION_TEXT.values(),
+                  AUX2_FUNCTION_TEXT.values(), MPPT_MODE_TEXT.values(), REST_REASON_TEXT.values()):
+        for text in texts:
+            if text not in strings:
+                strings.append(text)
+    assert len(strings) < INLINE_TEXT
+    return strings
+
+
+def buildFormat():
+    fmt = "<BH"
+    for name, kind, scale in READINGS_LAYOUT:
+        if kind == "datetime":
+            fmt += "H5B"
+        elif kind == "text":
+            fmt += "B"
+        elif kind == "bool":
+            fmt += "?"
+        else:
+            fmt += kind
+    return fmt
+
+
+STRINGS = buildStrings()
+STRING_INDEX = {text: index for index, text in enumerate(STRINGS)}
+READINGS_STRUCT = struct.Struct(buildFormat())
+
+
+# --------------------------------------------------------------------------- #
+# The schema published on stat/readingsbin/schema
+# --------------------------------------------------------------------------- #
+def buildSchema():
+    schema = {
+        "version": SCHEMA_VERSION,
+        "format": READINGS_STRUCT.format,
+        "fields": [[name, kind, scale] for name, kind, scale in READINGS_LAYOUT],
+        "strings": STRINGS,
+        "inlineText": INLINE_TEXT,
+    }
+    schema["id"] = zlib.crc32(json.dumps(schema, sort_keys=True).encode()) & 0xFFFF
+    return schema
+
+
+SCHEMA = buildSchema()
+SCHEMA_JSON = json.dumps(SCHEMA, separators=(',', ':'))
+
+
+# --------------------------------------------------------------------------- #
+# The binary readings as the readings dict, for the shared readings and the
+# binary readings client/classic_mqtt_client.py gets from MQTT
+# --------------------------------------------------------------------------- #
+def decodeReadings(payload, schema, layout):
+    values = layout.unpack_from(payload)
+    position = 2        #past the version and schema id
+    tail = layout.size  #inline texts start after the fields
+    readings = {}
+    for name, kind, scale in schema["fields"]:
+        if kind == "datetime":
+            readings[name] = "{:04n}-{:02n}-{:02n} {:02n}:{:02n}:{:02n}".format(*values[position:position + 6])
+            position += 6
+            continue
+        value = values[position]
+        position += 1
+        if kind == "text":
+            if value == schema["inlineText"]:
+                length = payload[tail]
+                value = bytes(payload[tail + 1:tail + 1 + length]).decode("utf-8")
+                tail += 1 + length
+            else:
+                value = schema["strings"][value]
+        elif scale is not None:
+            value = value / scale
+        readings[name] = value
+    return readings
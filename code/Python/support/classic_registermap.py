@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------------------------- #
+# Declarative map of the Classic register blocks.
+# Each block is described once as a list of fields (name, address, type,
+# scale, offset) and compiled into a struct.Struct, so a block is decoded with
+# a single unpack_from over the registers instead of one BinaryPayloadDecoder
+# call per field. The result matches doDecode in classic_modbusdecoder field
+# for field, including the "ignore"/"skip" entries, as a plain (ordered) dict.
+#
+# The registers are kept in an array('H') in little endian byte order. In that
+# layout the Classic's 32 bit values (low word first) are plain little endian
+# 32 bit ints, and the LSB of a register comes before its MSB.
+# --------------------------------------------------------------------------- #
+
+from array import array
+from collections import OrderedDict
+from operator import itemgetter
+import struct
+import sys
+
+# Field types, (struct code, register count, byte of the register)
+U8_MSB = ("B", 1, "msb")
+U8_LSB = ("B", 1, "lsb")
+I8_MSB = ("b", 1, "msb")
+I8_LSB = ("b", 1, "lsb")
+U16 = ("H", 1, None)
+I16 = ("h", 1, None)
+U32 = ("I", 2, None)
+I32 = ("i", 2, None)
+
+WORD_LITTLE = "little"  # Low word first, how the Classic sends 32 bit values
+WORD_BIG = "big"
+
+BYTESWAP = sys.byteorder != "little"
+
+
+# --------------------------------------------------------------------------- #
+# Field and skip helpers for the map
+# --------------------------------------------------------------------------- #
+def field(name, addr, kind, scale=None, offset=None, wordorder=WORD_LITTLE):
+    return (name, addr, kind, scale, offset, wordorder)
+
+
+def skip(name, addr, cnt):
+    return (name, addr, None, cnt, None, None)
+
+
+# --------------------------------------------------------------------------- #
+# The register map, in the same order as doDecode
+# --------------------------------------------------------------------------- #
+REGISTER_MAP = OrderedDict(
+    [
+        (
+            4100,
+            [
+                field("PCB", 4100, U8_MSB),  # 4101 MSB
+                field("Type", 4100, U8_LSB),  # 4101 LSB
+                field("Year", 4101, U16),  # 4102
+                field("Month", 4102, U8_MSB),  # 4103 MSB
+                field("Day", 4102, U8_LSB),  # 4103 LSB
+                field("InfoFlagBits3", 4103, U16),  # 4104
+                skip("ignore", 4104, 1),  # 4105 Reserved
+                field("mac_1", 4105, U8_MSB),  # 4106 MSB
+                field("mac_0", 4105, U8_LSB),  # 4106 LSB
+                field("mac_3", 4106, U8_MSB),  # 4107 MSB
+                field("mac_2", 4106, U8_LSB),  # 4107 LSB
+                field("mac_5", 4107, U8_MSB),  # 4108 MSB
+                field("mac_4", 4107, U8_LSB),  # 4108 LSB
+                skip("ignore2", 4108, 2),  # 4109, 4110
+                field("unitID", 4110, U32),  # 4111
+                field("StatusRoll", 4112, U16),  # 4113
+                field("RsetTmms", 4113, U16),  # 4114
+                field("BatVoltage", 4114, I16, 10.0),  # 4115
+                field("PVVoltage", 4115, U16, 10.0),  # 4116
+                field("BatCurrent", 4116, U16, 10.0),  # 4117
+                field("EnergyToday", 4117, U16, 10.0),  # 4118
+                field("Power", 4118, U16, 1.0),  # 4119
+                field("ChargeStage", 4119, U8_MSB),  # 4120 MSB
+                field("State", 4119, U8_LSB),  # 4120 LSB
+                field("PVCurrent", 4120, U16, 10.0),  # 4121
+                field("lastVOC", 4121, U16, 10.0),  # 4122
+                field("HighestVinputLog", 4122, U16),  # 4123
+                field("MatchPointShadow", 4123, U16),  # 4124
+                field("AmpHours", 4124, U16),  # 4125
+                field("TotalEnergy", 4125, U32, 10.0),  # 4126, 4127
+                field("LifetimeAmpHours", 4127, U32),  # 4128, 4129
+                field("InfoFlagsBits", 4129, U32),  # 4130, 31
+                field("BatTemperature", 4131, I16, 10.0),  # 4132
+                field("FETTemperature", 4132, I16, 10.0),  # 4133
+                field("PCBTemperature", 4133, I16, 10.0),  # 4134
+                field("NiteMinutesNoPwr", 4134, U16),  # 4135
+                field("MinuteLogIntervalSec", 4135, U16),  # 4136
+                field("modbus_port_register", 4136, U16),  # 4137
+                field("FloatTimeTodaySeconds", 4137, U16),  # 4138
+                field("AbsorbTime", 4138, U16),  # 4139
+                field("reserved1", 4139, U16),  # 4140
+                field("PWM_ReadOnly", 4140, U16),  # 4141
+                field("Reason_For_Reset", 4141, U16),  # 4142
+                field("EqualizeTime", 4142, U16),  # 4143
+            ],
+        ),
+        (
+            4163,
+            [
+                field("MPPTMode", 4163, U16),  # 4164
+                field("Aux2Function", 4164, I8_MSB),  # 4165 MSB
+                field("Aux1Function", 4164, I8_LSB),  # 4165 LSB
+            ],
+        ),
+        (
+            4209,
+            [
+                field("Name0", 4209, U8_MSB),  # 4210-MSB
+                field("Name1", 4209, U8_LSB),  # 4210-LSB
+                field("Name2", 4210, U8_MSB),  # 4211-MSB
+                field("Name3", 4210, U8_LSB),  # 4211-LSB
+                field("Name4", 4211, U8_MSB),  # 4212-MSB
+                field("Name5", 4211, U8_LSB),  # 4212-LSB
+                field("Name6", 4212, U8_MSB),  # 4213-MSB
+                field("Name7", 4212, U8_LSB),  # 4213-LSB
+            ],
+        ),
+        (
+            4213,
+            [
+                field("CTIME0", 4213, U32),  # 4214+#4215
+                field("CTIME1", 4215, U32),  # 4216+#4217
+                field("CTIME2", 4217, U32),  # 4218+#4219
+            ],
+        ),
+        (
+            4243,
+            [
+                field("VbattRegSetPTmpComp", 4243, I16, 10.0),  # 4244
+                field("nominalBatteryVoltage", 4244, U16),  # 4245
+                field("endingAmps", 4245, I16, 10.0),  # 4246
+                skip("skip", 4246, 28),  # 4247-4274
+                field("ReasonForResting", 4274, U16),  # 4275
+            ],
+        ),
+        (
+            4360,
+            [
+                field("WbangJrCmdS", 4360, U16),  # 4361
+                field("WizBangJrRawCurrent", 4361, I16),  # 4362
+                skip("skip", 4362, 2),  # 4363,4364
+                field("WbJrAmpHourPOSitive", 4364, U32),  # 4365,4366
+                field("WbJrAmpHourNEGative", 4366, I32),  # 4367,4368
+                field("WbJrAmpHourNET", 4368, I32),  # 4369,4370
+                field("WhizbangBatCurrent", 4370, I16, 10.0),  # 4371
+                field("WizBangCRC", 4371, I8_MSB),  # 4372 MSB
+                field("ShuntTemperature", 4371, I8_LSB, None, -50.0),  # 4372 LSB
+                field("SOC", 4372, U16),  # 4373
+                skip("skip2", 4373, 3),  # 4374,75, 76
+                field("RemainingAmpHours", 4376, U16),  # 4377
+                skip("skip3", 4377, 3),  # 4378,79,80
+                field("TotalAmpHours", 4380, U16),  # 4381
+            ],
+        ),
+        (
+            16386,
+            [
+                field("app_rev", 16386, U32),  # 16387, 16388
+                field("net_rev", 16388, U32),  # 16387, 16388
+            ],
+        ),
+    ]
+)
+
+
+# --------------------------------------------------------------------------- #
+# A block of the map compiled into a struct.Struct
+# --------------------------------------------------------------------------- #
+class CompiledBlock:
+    def __init__(self, addr, fields):
+        self.addr = addr
+
+        # Byte position of every value in the little endian registers
+        layout = []
+        end = addr
+        for index, (name, fieldAddr, kind, scale, offset, wordorder) in enumerate(fields):
+            if kind is None:  # skip, scale holds the register count
+                end = max(end, fieldAddr + scale)
+                continue
+            code, cnt, byte = kind
+            position = (fieldAddr - addr) * 2
+            if byte == "msb":
+                position += 1
+            if cnt == 2 and wordorder == WORD_BIG:
+                # Two words, high word first, put back together after unpacking
+                layout.append((position + 2, "H", index, 0))
+                layout.append((position, "H", index, 16))
+            else:
+                layout.append((position, code, index, None))
+            end = max(end, fieldAddr + cnt)
+        self.count = end - addr
+
+        layout.sort()
+        fmt = "<"
+        bytePosition = 0
+        self.words = []
+        for position, code, index, shift in layout:
+            if position > bytePosition:
+                fmt += "{}x".format(position - bytePosition)
+            fmt += code
+            bytePosition = position + struct.calcsize("<" + code)
+            self.words.append((index, shift))
+        self.struct = struct.Struct(fmt)
+
+        self.names = [f[0] for f in fields]
+        self.fields = fields
+
+        # Where each field is in the unpacked tuple, the skips point at the None
+        # put after it. The raw values are picked out in field order in one go,
+        # then the fields that are only scaled get theirs from (index, position,
+        # scale) and the ones offset or in two big endian words from (index,
+        # position, high, signed, scale, offset)
+        rawIndex = {}
+        for position, (index, shift) in enumerate(self.words):
+            rawIndex.setdefault(index, {})[shift] = position
+        picks = []
+        self.scaled = []
+        self.conversions = []
+        for index, (name, fieldAddr, kind, scale, offset, wordorder) in enumerate(fields):
+            if kind is None:
+                picks.append(len(self.words))
+                continue
+            positions = rawIndex[index]
+            if len(positions) == 1:
+                position, high, signed = positions[None], None, False
+            else:  # word order big, put the high and low words back together
+                position, high, signed = positions[0], positions[16], kind[0].islower()
+            picks.append(position)
+            if high is None and offset is None:
+                if scale is not None:
+                    self.scaled.append((index, position, scale))
+            else:
+                self.conversions.append((index, position, high, signed, scale, offset))
+        self.pick = itemgetter(*picks) if len(picks) > 1 else lambda raw: (raw[picks[0]],)
+
+    def decode(self, registers):
+        regs = array("H", registers)
+        if BYTESWAP:
+            regs.byteswap()
+        raw = self.struct.unpack_from(memoryview(regs)) + (None,)
+        values = list(self.pick(raw))
+        for index, position, scale in self.scaled:
+            values[index] = raw[position] / scale
+        for index, position, high, signed, scale, offset in self.conversions:
+            value = raw[position]
+            if high is not None:
+                value = value | raw[high] << 16
+                if signed:
+                    value = signed32(value)
+            if scale is not None:
+                value = value / scale
+            if offset is not None:
+                value = value + offset
+            values[index] = value
+        return dict(zip(self.names, values))
+
+
+def signed32(value):
+    return value - 0x100000000 if value & 0x80000000 else value
+
+
+COMPILED_MAP = OrderedDict(
+    (addr, CompiledBlock(addr, fields)) for addr, fields in REGISTER_MAP.items()
+)
+
+
+# --------------------------------------------------------------------------- #
+# Decode the registers read at addr
+# --------------------------------------------------------------------------- #
+def decodeBlock(addr, registers):
+    return COMPILED_MAP[addr].decode(registers)
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------------------------- #
+# Latest readings in shared memory.
+# Programs on the same host as classic_mqtt (classic_mqtt_client.py, scripts,
+# display drivers) can read the latest readings of each Classic from a
+# memory mapped file instead of subscribing to the broker and parsing the
+# readings JSON. On Linux a file in /dev/shm is shared memory.
+#
+#    header      4s magic "CLSS", H segment version, H schema id of the
+#                binary readings, I state (1 while classic_mqtt runs, 0 once
+#                it stopped), I slots, I slot size, I offset of the slots,
+#                I offset and I length of the layout descriptor
+#    descriptor  JSON: the segment version, the slot format, the Classics in
+#                slot order and the binary readings schema
+#    slots       one per Classic: I sequence, I length, d time taken (seconds
+#                since the epoch), then the binary readings of
+#                support/classic_binaryencoder.py
+#
+# The sequence is a seqlock: it is made odd before a slot is written and
+# even again after. A reader reads the sequence, copies the slot and reads
+# the sequence again, the copy is whole if both are the same and even.
+# The slots are sized for the longest binary readings, so the layout does
+# not change while classic_mqtt runs. The file is created anew (and moved
+# in place) when classic_mqtt starts, a reader that finds the state stopped
+# opens the file again to follow a restart.
+# --------------------------------------------------------------------------- #
+
+import argparse
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import time
+
+from support.classic_binaryencoder import encodeClassicData_readingsBinary
+from support.classic_readingsschema import READINGS_LAYOUT, READINGS_STRUCT, SCHEMA, decodeReadings
+from support.classic_jsonencoder import READINGS_KEYS
+
+log = logging.getLogger('classic_mqtt')
+
+SEGMENT_MAGIC = b"CLSS"
+SEGMENT_VERSION = 1
+HEADER = struct.Struct("<4sHHIIIIII")
+SLOT_HEADER = struct.Struct("<IId")     #sequence, length, taken
+SEQUENCE = struct.Struct("<I")
+SLOT_FIELDS = struct.Struct("<Id")      #length and taken, after the sequence
+STATE_OFFSET = 8                        #of the state in the header
+RUNNING, STOPPED = 1, 0
+TEXT_FIELDS = sum(1 for name, kind, scale in READINGS_LAYOUT if kind == "text")
+MAX_PAYLOAD = READINGS_STRUCT.size + TEXT_FIELDS * 256     #every text inline at its longest
+SLOT_SIZE = (SLOT_HEADER.size + MAX_PAYLOAD + 7) // 8 * 8
+READ_TRIES = 100
+
+
+# --------------------------------------------------------------------------- #
+# The layout descriptor put in the segment
+# --------------------------------------------------------------------------- #
+def segmentDescriptor(classicNames):
+    return {
+        "version": SEGMENT_VERSION,
+        "slotFormat": SLOT_HEADER.format,
+        "slotSize": SLOT_SIZE,
+        "classics": list(classicNames),
+        "schema": SCHEMA,
+    }
+
+
+class SharedStateWriter:
+
+    def __init__(self, path, classicNames):
+        self.path = path
+        self.classicNames = list(classicNames)
+        self.slots = {name: index for index, name in enumerate(self.classicNames)}
+        self.sequences = [0] * len(self.classicNames)
+        self.file = None
+        self.segment = None
+
+        descriptor = json.dumps(segmentDescriptor(self.classicNames), separators=(',', ':')).encode("utf-8")
+        self.slotsOffset = (HEADER.size + len(descriptor) + 7) // 8 * 8
+        self.size = self.slotsOffset + SLOT_SIZE * len(self.classicNames)
+        self.image = bytearray(self.size)
+        HEADER.pack_into(self.image, 0, SEGMENT_MAGIC, SEGMENT_VERSION, SCHEMA["id"], RUNNING, len(self.classicNames),
+                         SLOT_SIZE, self.slotsOffset, HEADER.size, len(descriptor))
+        self.image[HEADER.size:HEADER.size + len(descriptor)] = descriptor
+
+    # --------------------------------------------------------------------------- #
+    # Write the segment out with no readings and map it, it is written next to
+    # its place and moved there so a reader never opens half a file
+    # --------------------------------------------------------------------------- #
+    def open(self):
+        temporary = self.path + ".tmp"
+        with open(temporary, "wb") as file:
+            file.write(self.image)
+        os.replace(temporary, self.path)
+        self.image = None
+        self.file = open(self.path, "r+b")
+        self.segment = mmap.mmap(self.file.fileno(), self.size)
+        log.info("Latest readings shared in {}, {} bytes".format(self.path, self.size))
+        return self
+
+    # --------------------------------------------------------------------------- #
+    # The readings (readingsValues) of a Classic taken at taken (seconds since
+    # the epoch) into its slot
+    # --------------------------------------------------------------------------- #
+    def update(self, classicName, values, taken):
+        index = self.slots[classicName]
+        payload = encodeClassicData_readingsBinary(dict(zip(READINGS_KEYS, values)))
+        offset = self.slotsOffset + index * SLOT_SIZE
+        sequence = self.sequences[index]
+        segment = self.segment
+        SEQUENCE.pack_into(segment, offset, (sequence + 1) & 0xFFFFFFFF)
+        SLOT_FIELDS.pack_into(segment, offset + SEQUENCE.size, len(payload), taken)
+        segment[offset + SLOT_HEADER.size:offset + SLOT_HEADER.size + len(payload)] = payload
+        self.sequences[index] = sequence = (sequence + 2) & 0xFFFFFFFF
+        SEQUENCE.pack_into(segment, offset, sequence)
+
+    # --------------------------------------------------------------------------- #
+    # Mark the segment stopped, the readings stay for the readers
+    # --------------------------------------------------------------------------- #
+    def close(self):
+        if self.segment is not None:
+            SEQUENCE.pack_into(self.segment, STATE_OFFSET, STOPPED)
+            self.segment.close()
+            self.file.close()
+            self.segment = None
+
+
+class SharedStateReader:
+
+    def __init__(self, path):
+        with open(path, "rb") as file:
+            self.segment = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, schemaId, state, slots, slotSize, slotsOffset, descriptorOffset, descriptorLength = HEADER.unpack_from(self.segment)
+        if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION:
+            raise ValueError("{} is not a version {} readings segment".format(path, SEGMENT_VERSION))
+        self.descriptor = json.loads(self.segment[descriptorOffset:descriptorOffset + descriptorLength].decode("utf-8"))
+        self.schema = self.descriptor["schema"]
+        self.layout = struct.Struct(self.schema["format"])
+        self.slotHeader = struct.Struct(self.descriptor["slotFormat"])
+        self.slotSize = slotSize
+        self.slotsOffset = slotsOffset
+        self.classics = self.descriptor["classics"]
+
+    def running(self):
+        return SEQUENCE.unpack_from(self.segment, STATE_OFFSET)[0] == RUNNING
+
+    # --------------------------------------------------------------------------- #
+    # A whole copy of a Classic's slot, (sequence, taken, binary readings),
+    # taken is 0 before its first readings
+    # --------------------------------------------------------------------------- #
+    def slot(self, classicName):
+        offset = self.slotsOffset + self.classics.index(classicName) * self.slotSize
+        for tries in range(READ_TRIES):
+            before = SEQUENCE.unpack_from(self.segment, offset)[0]
+            if before & 1:
+                time.sleep(0)
+                continue
+            copy = self.segment[offset:offset + self.slotSize]
+            if SEQUENCE.unpack_from(self.segment, offset)[0] == before:
+                sequence, length, taken = self.slotHeader.unpack_from(copy)
+                return sequence, taken, copy[self.slotHeader.size:self.slotHeader.size + length]
+        raise TimeoutError("The slot of {} kept changing while being read".format(classicName))
+
+    # --------------------------------------------------------------------------- #
+    # The latest readings of a Classic, the same dict as the readings JSON, and
+    # when they were taken, or (None, 0) before its first readings
+    # --------------------------------------------------------------------------- #
+    def read(self, classicName):
+        sequence, taken, payload = self.slot(classicName)
+        if not payload:
+            return None, 0
+        return decodeReadings(payload, self.schema, self.layout), taken
+
+    def close(self):
+        self.segment.close()
+
+
+# --------------------------------------------------------------------------- #
+# Print the latest readings as JSON, once or every --watch seconds
+# --------------------------------------------------------------------------- #
+def run(argv):
+    parser = argparse.ArgumentParser(description="Print the latest readings from the classic_mqtt shared segment")
+    parser.add_argument("segment", help="the --shared_state file")
+    parser.add_argument("--classic", help="only this Classic")
+    parser.add_argument("--watch", type=float, help="print them again every this many seconds")
+    args = parser.parse_args(argv)
+
+    reader = SharedStateReader(args.segment)
+    classics = [args.classic] if args.classic else reader.classics
+    try:
+        while True:
+            if args.watch and not reader.running():
+                # classic_mqtt stopped, or started again with a new file
+                try:
+                    newReader = SharedStateReader(args.segment)
+                    reader.close()
+                    reader = newReader
+                except (OSError, ValueError):
+                    pass
+            for classicName in classics:
+                readings, taken = reader.read(classicName)
+                print(json.dumps({"classic": classicName, "taken": taken, "running": reader.running(), "readings": readings}))
+            if not args.watch:
+                break
+            time.sleep(args.watch)
+    except KeyboardInterrupt:
+        pass
+    reader.close()
+
+
+if __name__ == "__main__":
+    run(sys.argv[1:])
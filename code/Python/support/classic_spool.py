@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------------------------- #
+# Store and forward spool for broker outages.
+# While MQTT is down the readings of a Classic are appended to a spool on
+# disk instead of being lost, and replayed once MQTT is back (see
+# replaySpool in classic_mqtt.py).
+#
+# The spool is a directory of segment files, spool-<sequence>.log, each one
+# up to segmentBytes long, holding records of
+#
+#    d time the reading was taken, H topic length, I payload length
+#    the topic (UTF-8) and the payload
+#
+# The records are only ever appended. When the segments add up to more than
+# maxBytes the oldest segment is deleted, dropping the oldest readings. How
+# far the replay got is kept in the file "cursor", segments that have been
+# replayed are deleted, so a restart carries on where it left off. A record
+# cut short by a crash is cut off the end of the last segment when the spool
+# is opened again.
+# --------------------------------------------------------------------------- #
+
+import os
+import struct
+import logging
+from time import time
+
+log = logging.getLogger('classic_mqtt')
+
+RECORD_HEADER = struct.Struct("<dHI")
+SEGMENT_PREFIX = "spool-"
+SEGMENT_SUFFIX = ".log"
+CURSOR_FILE = "cursor"
+DEFAULT_SEGMENT_BYTES = 1024*1024
+
+
+class ReadingsSpool:
+
+    def __init__(self, directory, maxBytes, segmentBytes=DEFAULT_SEGMENT_BYTES):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.segmentBytes = min(segmentBytes, maxBytes)
+        self.writer = None
+
+        self.spooled = 0        #records appended
+        self.evicted = 0        #records dropped to stay under maxBytes
+
+        os.makedirs(directory, exist_ok=True)
+        self.segments = sorted(int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+                               if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX))
+        self.sizes = {}
+        self.counts = {}        #records in each segment
+        for sequence in self.segments:
+            self.counts[sequence], self.sizes[sequence] = self.scan(sequence)
+        if self.segments:
+            #cut off a record left half written
+            last = self.segments[-1]
+            if os.path.getsize(self.path(last)) != self.sizes[last]:
+                log.warning("Cutting a partial record off {}".format(self.path(last)))
+                os.truncate(self.path(last), self.sizes[last])
+
+        self.readSegment, self.readOffset = self.loadCursor()
+        self.pending = sum(self.counts[sequence] for sequence in self.segments if sequence >= self.readSegment)
+        if self.readOffset and self.readSegment in self.counts:
+            self.pending -= len(self.records(self.readSegment, 0, self.readOffset))
+        if self.pending:
+            log.info("Spool {} has {} readings to replay".format(directory, self.pending))
+
+    def path(self, sequence):
+        return os.path.join(self.directory, "{}{:08d}{}".format(SEGMENT_PREFIX, sequence, SEGMENT_SUFFIX))
+
+    # --------------------------------------------------------------------------- #
+    # The records of a segment from offset on, up to before stop (an offset) or
+    # count records, as [(time, topic, payload, offset after the record)]
+    # --------------------------------------------------------------------------- #
+    def records(self, sequence, offset=0, stop=None, count=None):
+        with open(self.path(sequence), "rb") as segment:
+            data = segment.read()
+        if stop is not None:
+            data = data[:stop]
+        found = []
+        while offset + RECORD_HEADER.size <= len(data) and (count is None or len(found) < count):
+            taken, topicLength, payloadLength = RECORD_HEADER.unpack_from(data, offset)
+            end = offset + RECORD_HEADER.size + topicLength + payloadLength
+            if end > len(data):
+                break
+            topicStart = offset + RECORD_HEADER.size
+            found.append((taken, data[topicStart:topicStart+topicLength].decode("utf-8"), data[topicStart+topicLength:end], end))
+            offset = end
+        return found
+
+    # The number of whole records in a segment and the length they take
+    def scan(self, sequence):
+        found = self.records(sequence)
+        return len(found), (found[-1][3] if found else 0)
+
+    def totalBytes(self):
+        return sum(self.sizes.values())
+
+    # --------------------------------------------------------------------------- #
+    # Add a reading to the end of the spool
+    # --------------------------------------------------------------------------- #
+    def append(self, topic, payload, taken=None):
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        topic = topic.encode("utf-8")
+        record = RECORD_HEADER.pack(time() if taken is None else taken, len(topic), len(payload)) + topic + payload
+
+        if not self.segments or self.sizes[self.segments[-1]] + len(record) > self.segmentBytes:
+            self.roll()
+        last = self.segments[-1]
+        if self.writer is None:
+            self.writer = open(self.path(last), "ab")
+        self.writer.write(record)
+        self.writer.flush()
+        self.sizes[last] += len(record)
+        self.counts[last] += 1
+        self.pending += 1
+        self.spooled += 1
+        self.evict()
+
+    def roll(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        sequence = self.segments[-1] + 1 if self.segments else 0
+        self.segments.append(sequence)
+        self.sizes[sequence] = 0
+        self.counts[sequence] = 0
+        if not self.pending:
+            self.readSegment, self.readOffset = sequence, 0
+
+    # Drop the oldest segments until the spool fits in maxBytes
+    def evict(self):
+        while self.totalBytes() > self.maxBytes and len(self.segments) > 1:
+            oldest = self.segments.pop(0)
+            if oldest > self.readSegment or (oldest == self.readSegment and not self.readOffset):
+                dropped = self.counts[oldest]
+            elif oldest == self.readSegment:
+                dropped = len(self.records(oldest, self.readOffset))
+            else:
+                dropped = 0
+            self.pending -= dropped
+            self.evicted += dropped
+            del self.sizes[oldest], self.counts[oldest]
+            os.remove(self.path(oldest))
+            if self.readSegment <= oldest:
+                self.readSegment, self.readOffset = self.segments[0], 0
+                self.saveCursor()
+            log.warning("Spool {} full, dropped {} of the oldest readings".format(self.directory, dropped))
+
+    # --------------------------------------------------------------------------- #
+    # Replay: read() the next records, and commit() the position it returned
+    # once they are published
+    # --------------------------------------------------------------------------- #
+    def read(self, count):
+        batch = []
+        sequence, offset = self.readSegment, self.readOffset
+        for candidate in self.segments:
+            if candidate < self.readSegment or len(batch) >= count:
+                continue
+            found = self.records(candidate, offset if candidate == self.readSegment else 0, self.sizes[candidate], count - len(batch))
+            batch += [(taken, topic, payload) for taken, topic, payload, _ in found]
+            if found:
+                sequence, offset = candidate, found[-1][3]
+        return batch, (sequence, offset, len(batch))
+
+    def commit(self, position):
+        sequence, offset, count = position
+        self.readSegment, self.readOffset = sequence, offset
+        self.pending -= count
+        #segments replayed all the way are not needed anymore, the one being written stays
+        while self.segments and self.segments[0] < self.readSegment or \
+                (len(self.segments) > 1 and self.segments[0] == self.readSegment and self.readOffset >= self.sizes[self.readSegment]):
+            finished = self.segments.pop(0)
+            del self.sizes[finished], self.counts[finished]
+            os.remove(self.path(finished))
+            if finished == self.readSegment:
+                self.readSegment, self.readOffset = self.segments[0], 0
+        self.saveCursor()
+
+    def loadCursor(self):
+        try:
+            with open(os.path.join(self.directory, CURSOR_FILE)) as cursor:
+                sequence, offset = (int(value) for value in cursor.read().split())
+            if sequence in self.sizes:
+                return sequence, min(offset, self.sizes[sequence])
+        except (OSError, ValueError):
+            pass
+        return (self.segments[0] if self.segments else 0), 0
+
+    def saveCursor(self):
+        path = os.path.join(self.directory, CURSOR_FILE)
+        with open(path + ".tmp", "w") as cursor:
+            cursor.write("{} {}".format(self.readSegment, self.readOffset))
+        os.replace(path + ".tmp", path)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
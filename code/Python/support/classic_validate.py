@@ -3,6 +3,7 @@ import logging
 import sys, getopt
 import os
 import re
+import json
 
 
 log = logging.getLogger('classic_mqtt')
@@ -51,12 +52,64 @@ def validateIntParameter(param, name, defaultValue):
     return temp
 
 
+# --------------------------------------------------------------------------- # 
+# Load the fleet file, a JSON list of the Classics to poll:
+# [{"host": "192.168.0.225", "port": 502, "name": "classic"}, ...]
+# --------------------------------------------------------------------------- # 
+def validateFleetParameter(param, name, defaultValue):
+    try:
+        with open(param) as fleetFile:
+            fleet = json.load(fleetFile)
+        assert isinstance(fleet, list) and len(fleet) > 0
+    except Exception as e:
+        log.error("Invalid parameter, {} passed for {}".format(param, name))
+        log.exception(e, exc_info=False)
+        return defaultValue
+
+    classics = []
+    for entry in fleet:
+        if not isinstance(entry, dict) or 'host' not in entry or 'name' not in entry:
+            log.error("Invalid entry {} in {}, host and name are required".format(entry, param))
+            return defaultValue
+        classics.append({'host':validateHostnameParameter(str(entry['host']).strip(), "{} host".format(name), entry['host']), \
+                         'port':validateIntParameter(entry.get('port', 502), "{} port".format(name), 502), \
+                         'name':validateStrParameter(entry['name'], "{} name".format(name), str(entry['name'])).strip()})
+
+    names = [classic['name'] for classic in classics]
+    if len(set(names)) != len(names):
+        log.error("The Classic names in {} must be unique".format(param))
+        return defaultValue
+
+    return classics
+
+
+# --------------------------------------------------------------------------- # 
+# Load the deadbands of the field topics, a JSON object of the fields:
+# {"Power": {"absolute": 5}, "BatVoltage": {"relative": 0.01}, "default": {...}}
+# "refresh" instead of a deadband only publishes the field with the refreshes
+# --------------------------------------------------------------------------- # 
+def validateDeadbandsParameter(param, name, defaultValue):
+    try:
+        with open(param) as deadbandsFile:
+            deadbands = json.load(deadbandsFile)
+        assert isinstance(deadbands, dict)
+        for field, deadband in deadbands.items():
+            if deadband != "refresh":
+                assert isinstance(deadband, dict) and set(deadband) <= {"absolute", "relative"}
+                assert all(float(value) >= 0 for value in deadband.values())
+    except Exception as e:
+        log.error("Invalid parameter, {} passed for {}".format(param, name))
+        log.exception(e, exc_info=False)
+        return defaultValue
+    return deadbands
+
+
 # --------------------------------------------------------------------------- # 
 # Handle the command line arguments
 # --------------------------------------------------------------------------- # 
 def handleArgs(argv,argVals):
     
-    from classic_mqtt import MAX_WAKE_RATE, MIN_WAKE_RATE, MIN_WAKE_PUBLISHES
+    from classic_mqtt import MAX_WAKE_RATE, MIN_WAKE_RATE, MIN_WAKE_PUBLISHES, READINGS_MODES, HA_DISCOVERY_MODES, MIN_CAPTURE_INTERVAL, MAX_CAPTURE_INTERVAL, MAX_HISTORY_HOURS
     
     try:
       opts, args = getopt.getopt(argv,"h",
@@ -71,6 +124,42 @@ def handleArgs(argv,argVals):
                      "wake_publish_rate=",
                      "snooze_publish_rate=",
                      "wake_publishes=",
+                     "modbus_read_gap=",
+                     "publish_queue=",
+                     "mqtt_qos=",
+                     "mqtt_v5",
+                     "mqtt_expiry=",
+                     "spool_dir=",
+                     "spool_max_mb=",
+                     "spool_replay_rate=",
+                     "fleet=",
+                     "metrics_interval=",
+                     "modbus_proxy_port=",
+                     "modbus_proxy_max_age=",
+                     "publish_on_change",
+                     "heartbeat_interval=",
+                     "readings_mode=",
+                     "field_refresh=",
+                     "field_deadbands=",
+                     "binary_readings",
+                     "batch_readings=",
+                     "batch_secs=",
+                     "batch_compress",
+                     "history_hours=",
+                     "influx_url=",
+                     "influx_token=",
+                     "influx_measurement=",
+                     "influx_batch=",
+                     "influx_flush=",
+                     "influx_buffer=",
+                     "archive_db=",
+                     "archive_flush=",
+                     "archive_days=",
+                     "shared_state=",
+                     "prometheus_port=",
+                     "capture_interval=",
+                     "capture_window=",
+                     "ha_discovery=",
                      "homeassistant"])
     except getopt.GetoptError:
         print("Error parsing command line parameters, please use: py --classic <{}> --classic_port <{}> --classic_name <{}> --mqtt <{}> --mqtt_port <{}> --mqtt_root <{}> --mqtt_user <username> --mqtt_pass <password> --wake_publish_rate <{}> --snooze_publish_rate <{}> --wake_publishes <{}> --homeassistant".format( \
@@ -103,8 +192,80 @@ def handleArgs(argv,argVals):
             argVals['snoozePublishRate'] = int(validateIntParameter(arg,"snooze_publish_rate", argVals['snoozePublishRate']))
         elif opt in ("--wake_publishes"):
             argVals['awakePublishLimit'] = int(validateIntParameter(arg,"wake_publishes", argVals['awakePublishLimit']))
+        elif opt in ("--publish_queue"):
+            argVals['publishQueue'] = int(validateIntParameter(arg,"publish_queue", argVals['publishQueue']))
+        elif opt in ("--mqtt_qos"):
+            argVals['mqttQos'] = int(validateIntParameter(arg,"mqtt_qos", argVals['mqttQos']))
+        elif opt in ("--mqtt_v5"):
+            argVals['mqttV5'] = True
+        elif opt in ("--mqtt_expiry"):
+            argVals['mqttExpiry'] = int(validateIntParameter(arg,"mqtt_expiry", argVals['mqttExpiry']))
+        elif opt in ("--spool_dir"):
+            argVals['spoolDir'] = validateStrParameter(arg,"spool_dir", argVals['spoolDir']).strip()
+        elif opt in ("--spool_max_mb"):
+            argVals['spoolMaxMB'] = int(validateIntParameter(arg,"spool_max_mb", argVals['spoolMaxMB']))
+        elif opt in ("--spool_replay_rate"):
+            argVals['spoolReplayRate'] = int(validateIntParameter(arg,"spool_replay_rate", argVals['spoolReplayRate']))
+        elif opt in ("--modbus_read_gap"):
+            argVals['modbusReadGap'] = int(validateIntParameter(arg,"modbus_read_gap", argVals['modbusReadGap']))
+        elif opt in ("--fleet"):
+            argVals['fleet'] = arg
+        elif opt in ("--metrics_interval"):
+            argVals['metricsInterval'] = int(validateIntParameter(arg,"metrics_interval", argVals['metricsInterval']))
+        elif opt in ("--modbus_proxy_port"):
+            argVals['modbusProxyPort'] = int(validateIntParameter(arg,"modbus_proxy_port", argVals['modbusProxyPort']))
+        elif opt in ("--modbus_proxy_max_age"):
+            argVals['modbusProxyMaxAge'] = int(validateIntParameter(arg,"modbus_proxy_max_age", argVals['modbusProxyMaxAge']))
+        elif opt in ("--heartbeat_interval"):
+            argVals['heartbeatInterval'] = int(validateIntParameter(arg,"heartbeat_interval", argVals['heartbeatInterval']))
+        elif opt in ("--readings_mode"):
+            argVals['readingsMode'] = validateStrParameter(arg,"readings_mode", argVals['readingsMode']).strip().lower()
+        elif opt in ("--field_refresh"):
+            argVals['fieldRefresh'] = int(validateIntParameter(arg,"field_refresh", argVals['fieldRefresh']))
+        elif opt in ("--field_deadbands"):
+            argVals['fieldDeadbands'] = arg
+        elif opt in ("--publish_on_change"):
+            argVals['publishOnChange'] = True
+        elif opt in ("--binary_readings"):
+            argVals['binaryReadings'] = True
+        elif opt in ("--batch_readings"):
+            argVals['batchReadings'] = int(validateIntParameter(arg,"batch_readings", argVals['batchReadings']))
+        elif opt in ("--batch_secs"):
+            argVals['batchSecs'] = int(validateIntParameter(arg,"batch_secs", argVals['batchSecs']))
+        elif opt in ("--batch_compress"):
+            argVals['batchCompress'] = True
+        elif opt in ("--history_hours"):
+            argVals['historyHours'] = int(validateIntParameter(arg,"history_hours", argVals['historyHours']))
+        elif opt in ("--influx_url"):
+            argVals['influxUrl'] = validateStrParameter(arg,"influx_url", argVals['influxUrl']).strip()
+        elif opt in ("--influx_token"):
+            argVals['influxToken'] = validateStrParameter(arg,"influx_token", argVals['influxToken']).strip()
+        elif opt in ("--influx_measurement"):
+            argVals['influxMeasurement'] = validateStrParameter(arg,"influx_measurement", argVals['influxMeasurement']).strip()
+        elif opt in ("--influx_batch"):
+            argVals['influxBatch'] = int(validateIntParameter(arg,"influx_batch", argVals['influxBatch']))
+        elif opt in ("--influx_flush"):
+            argVals['influxFlush'] = int(validateIntParameter(arg,"influx_flush", argVals['influxFlush']))
+        elif opt in ("--influx_buffer"):
+            argVals['influxBuffer'] = int(validateIntParameter(arg,"influx_buffer", argVals['influxBuffer']))
+        elif opt in ("--archive_db"):
+            argVals['archiveDb'] = validateStrParameter(arg,"archive_db", argVals['archiveDb']).strip()
+        elif opt in ("--archive_flush"):
+            argVals['archiveFlush'] = int(validateIntParameter(arg,"archive_flush", argVals['archiveFlush']))
+        elif opt in ("--archive_days"):
+            argVals['archiveDays'] = int(validateIntParameter(arg,"archive_days", argVals['archiveDays']))
+        elif opt in ("--shared_state"):
+            argVals['sharedState'] = validateStrParameter(arg,"shared_state", argVals['sharedState']).strip()
+        elif opt in ("--prometheus_port"):
+            argVals['prometheusPort'] = int(validateIntParameter(arg,"prometheus_port", argVals['prometheusPort']))
+        elif opt in ("--capture_interval"):
+            argVals['captureInterval'] = int(validateIntParameter(arg,"capture_interval", argVals['captureInterval']))
+        elif opt in ("--capture_window"):
+            argVals['captureWindow'] = int(validateIntParameter(arg,"capture_window", argVals['captureWindow']))
         elif opt in ("--homeassistant"):
             argVals['homeassistant'] = True
+        elif opt in ("--ha_discovery"):
+            argVals['haDiscovery'] = validateStrParameter(arg,"ha_discovery", argVals['haDiscovery']).strip().lower()
 
     #Validate the wake/snooze stuff
     if (argVals['snoozePublishRate'] < argVals['awakePublishRate']):
@@ -125,6 +286,122 @@ def handleArgs(argv,argVals):
         print("--wake_publishes must be greater than {} publishes".format(MIN_WAKE_PUBLISHES))
         sys.exit()
 
+    if ((argVals['modbusReadGap'])<0):
+        print("--modbus_read_gap must be greater than or equal to 0")
+        sys.exit()
+
+    if ((argVals['metricsInterval'])<0):
+        print("--metrics_interval must be greater than or equal to 0")
+        sys.exit()
+
+    if ((argVals['modbusProxyPort'])<0 or (argVals['modbusProxyPort'])>65535):
+        print("--modbus_proxy_port must be between 0 and 65535")
+        sys.exit()
+
+    if ((argVals['modbusProxyMaxAge'])<0):
+        print("--modbus_proxy_max_age must be greater than or equal to 0")
+        sys.exit()
+
+    if ((argVals['publishQueue'])<1):
+        print("--publish_queue must be greater than 0")
+        sys.exit()
+
+    if argVals['mqttQos'] not in (0, 1, 2):
+        print("--mqtt_qos must be 0, 1 or 2")
+        sys.exit()
+
+    if ((argVals['mqttExpiry'])<0):
+        print("--mqtt_expiry must be greater than or equal to 0")
+        sys.exit()
+
+    if ((argVals['spoolMaxMB'])<1):
+        print("--spool_max_mb must be greater than 0")
+        sys.exit()
+
+    if ((argVals['spoolReplayRate'])<1):
+        print("--spool_replay_rate must be greater than 0")
+        sys.exit()
+
+    if ((argVals['heartbeatInterval'])<0):
+        print("--heartbeat_interval must be greater than or equal to 0")
+        sys.exit()
+
+    if argVals['readingsMode'] not in READINGS_MODES:
+        print("--readings_mode must be one of {}".format(", ".join(READINGS_MODES)))
+        sys.exit()
+
+    if ((argVals['fieldRefresh'])<1):
+        print("--field_refresh must be greater than 0")
+        sys.exit()
+
+    if argVals['fieldDeadbands']:
+        argVals['fieldDeadbands'] = validateDeadbandsParameter(argVals['fieldDeadbands'], "field_deadbands", None)
+        if argVals['fieldDeadbands'] is None:
+            print("--field_deadbands must name a JSON file of the fields' deadbands: {\"<Field>\": {\"absolute\": <0>, \"relative\": <0>}, ...}")
+            sys.exit()
+
+    if argVals['haDiscovery'] not in HA_DISCOVERY_MODES:
+        print("--ha_discovery must be one of {}".format(", ".join(HA_DISCOVERY_MODES)))
+        sys.exit()
+
+    if argVals['binaryReadings'] and argVals['readingsMode'] == "fields":
+        print("--binary_readings is published with the readings JSON, use it with --readings_mode json or both")
+        sys.exit()
+
+    if ((argVals['batchReadings'])<0 or (argVals['batchSecs'])<0):
+        print("--batch_readings and --batch_secs must be greater than or equal to 0")
+        sys.exit()
+
+    if argVals['batchCompress'] and not (argVals['batchReadings'] or argVals['batchSecs']):
+        print("--batch_compress compresses the batches, use it with --batch_readings or --batch_secs")
+        sys.exit()
+
+    if (argVals['batchReadings'] or argVals['batchSecs']) and argVals['readingsMode'] == "fields":
+        print("--batch_readings and --batch_secs batch the readings JSON, use them with --readings_mode json or both")
+        sys.exit()
+
+    if ((argVals['historyHours'])<0 or (argVals['historyHours'])>MAX_HISTORY_HOURS):
+        print("--history_hours must be between 0 and {}".format(MAX_HISTORY_HOURS))
+        sys.exit()
+
+    if argVals['influxUrl'] and not argVals['influxUrl'].startswith(("http://", "https://")):
+        print("--influx_url must be the http:// or https:// url of the InfluxDB write endpoint")
+        sys.exit()
+
+    if ((argVals['influxBatch'])<1 or (argVals['influxFlush'])<1):
+        print("--influx_batch and --influx_flush must be greater than 0")
+        sys.exit()
+
+    if ((argVals['influxBuffer'])<argVals['influxBatch']):
+        print("--influx_buffer must be at least --influx_batch")
+        sys.exit()
+
+    if ((argVals['archiveFlush'])<1):
+        print("--archive_flush must be at least 1 second")
+        sys.exit()
+
+    if ((argVals['archiveDays'])<0):
+        print("--archive_days must be 0 (keep everything) or more")
+        sys.exit()
+
+    if ((argVals['prometheusPort'])<0 or (argVals['prometheusPort'])>65535):
+        print("--prometheus_port must be between 0 and 65535")
+        sys.exit()
+
+    if argVals['captureInterval'] != 0 and (argVals['captureInterval'] < MIN_CAPTURE_INTERVAL or argVals['captureInterval'] > MAX_CAPTURE_INTERVAL):
+        print("--capture_interval must be 0 (off) or between {} and {} milliseconds".format(MIN_CAPTURE_INTERVAL, MAX_CAPTURE_INTERVAL))
+        sys.exit()
+
+    if ((argVals['captureWindow'])*1000 < argVals['captureInterval'] or (argVals['captureWindow'])<1):
+        print("--capture_window must be at least 1 second and longer than --capture_interval")
+        sys.exit()
+
+    if argVals['fleet']:
+        argVals['fleet'] = validateFleetParameter(argVals['fleet'], "fleet", [])
+        if not argVals['fleet']:
+            print("--fleet must name a JSON file with a list of Classics: [{\"host\": <ClassicHost>, \"port\": <502>, \"name\": <classic>}, ...]")
+            sys.exit()
+
     argVals['classicHost'] = argVals['classicHost'].strip()
     argVals['classicName'] = argVals['classicName'].strip()
     argVals['mqttHost'] = argVals['mqttHost'].strip()
@@ -132,10 +409,13 @@ def handleArgs(argv,argVals):
 
 
     log.info("homeassistant = {}".format(argVals['homeassistant']))
+    log.info("haDiscovery = {}".format(argVals['haDiscovery']))
 
     log.info("classicHost = {}".format(argVals['classicHost']))
     log.info("classicPort = {}".format(argVals['classicPort']))
     log.info("classicName = {}".format(argVals['classicName']))
+    if argVals['fleet']:
+        log.info("fleet = {}".format(", ".join("{}@{}:{}".format(c['name'], c['host'], c['port']) for c in argVals['fleet'])))
     log.info("mqttHost = {}".format(argVals['mqttHost']))
     log.info("mqttPort = {}".format(argVals['mqttPort']))
     log.info("mqttRoot = {}".format(argVals['mqttRoot']))
@@ -145,6 +425,46 @@ def handleArgs(argv,argVals):
     log.info("awakePublishRate = {}".format(argVals['awakePublishRate']))
     log.info("snoozePublishRate = {}".format(argVals['snoozePublishRate']))
     log.info("awakePublishLimit = {}".format(argVals['awakePublishLimit']))
+    log.info("modbusReadGap = {}".format(argVals['modbusReadGap']))
+    log.info("publishQueue = {}".format(argVals['publishQueue']))
+    log.info("mqttQos = {}".format(argVals['mqttQos']))
+    log.info("mqttV5 = {}".format(argVals['mqttV5']))
+    if argVals['mqttV5']:
+        log.info("mqttExpiry = {}".format(argVals['mqttExpiry']))
+    log.info("spoolDir = {}".format(argVals['spoolDir']))
+    if argVals['spoolDir']:
+        log.info("spoolMaxMB = {}".format(argVals['spoolMaxMB']))
+        log.info("spoolReplayRate = {}".format(argVals['spoolReplayRate']))
+    log.info("metricsInterval = {}".format(argVals['metricsInterval']))
+    log.info("modbusProxyPort = {}".format(argVals['modbusProxyPort']))
+    log.info("modbusProxyMaxAge = {}".format(argVals['modbusProxyMaxAge']))
+    log.info("publishOnChange = {}".format(argVals['publishOnChange']))
+    log.info("heartbeatInterval = {}".format(argVals['heartbeatInterval']))
+    log.info("readingsMode = {}".format(argVals['readingsMode']))
+    if argVals['readingsMode'] != "json":
+        log.info("fieldRefresh = {}".format(argVals['fieldRefresh']))
+        log.info("fieldDeadbands = {}".format(argVals['fieldDeadbands']))
+    log.info("binaryReadings = {}".format(argVals['binaryReadings']))
+    log.info("batchReadings = {}".format(argVals['batchReadings']))
+    log.info("batchSecs = {}".format(argVals['batchSecs']))
+    if argVals['batchReadings'] or argVals['batchSecs']:
+        log.info("batchCompress = {}".format(argVals['batchCompress']))
+    log.info("historyHours = {}".format(argVals['historyHours']))
+    log.info("influxUrl = {}".format(argVals['influxUrl']))
+    if argVals['influxUrl']:
+        log.info("influxMeasurement = {}".format(argVals['influxMeasurement']))
+        log.info("influxBatch = {}".format(argVals['influxBatch']))
+        log.info("influxFlush = {}".format(argVals['influxFlush']))
+        log.info("influxBuffer = {}".format(argVals['influxBuffer']))
+    log.info("archiveDb = {}".format(argVals['archiveDb']))
+    if argVals['archiveDb']:
+        log.info("archiveFlush = {}".format(argVals['archiveFlush']))
+        log.info("archiveDays = {}".format(argVals['archiveDays']))
+    log.info("sharedState = {}".format(argVals['sharedState']))
+    log.info("prometheusPort = {}".format(argVals['prometheusPort']))
+    log.info("captureInterval = {}".format(argVals['captureInterval']))
+    if argVals['captureInterval']:
+        log.info("captureWindow = {}".format(argVals['captureWindow']))
 
     #Make sure the last character in the root is a "/"
     if (not argVals['mqttRoot'].endswith("/")):
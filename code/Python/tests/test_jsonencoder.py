@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------------------------- #
+# The templated readings and info JSON against the encoders they replaced.
+# encodeReadingsReference and encodeInfoReference are the dict building
+# encoders of classic_jsonencoder before the templates, kept as they were so
+# a wrong key or order in READINGS_KEYS or INFO_KEYS shows up here.
+#
+#    python3 -m pytest tests
+# --------------------------------------------------------------------------- #
+
+import datetime
+import json
+import logging
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from support.classic_modbusdecoder import decodeModbusData, REGISTER_BLOCKS
+from support.classic_jsonencoder import encodeClassicData_readings, encodeClassicData_info, updateClassicData_readingsTime
+
+RANDOM_SETS = 1000
+
+# Texts and values the templates must write the way json.dumps does
+EDGE_TEXTS = ["", 'say "hi"\\', "tab\there\nnewline", "café ☀", "%s %d %%", "\x00\x1f", "😀", "a" * 300]
+EDGE_NUMBERS = [float("nan"), float("inf"), float("-inf"), -0.0, 1e22, 1e-7, 2**70, -2**31, 0.1 + 0.2]
+EDGE_OTHERS = [None, True, False]
+
+READINGS_TEXTS = ["ChargeStateIcon", "ChargeStateText", "Aux1FunctionText", "Aux2FunctionText", "MPPTModeText",
+                  "ReasonForRestingText", "SOCicon"]
+READINGS_NUMBERS = ["BatTemperature", "WbJrAmpHourNET", "ChargeStage", "ReasonForResting", "WbJrAmpHourNEGative",
+                    "BatVoltage", "PVVoltage", "VbattRegSetPTmpComp", "TotalAmpHours", "WhizbangBatCurrent", "BatCurrent",
+                    "PVCurrent", "EnergyToday", "EqualizeTime", "SOC", "Power", "FETTemperature", "WbJrAmpHourPOSitive",
+                    "TotalEnergy", "FloatTimeTodaySeconds", "RemainingAmpHours", "AbsorbTime", "ShuntTemperature",
+                    "PCBTemperature"]
+INFO_TEXTS = ["app_rev", "net_rev", "IP"]
+INFO_NUMBERS = ["endingAmps", "lastVOC", "MPPTMode", "nominalBatteryVoltage", "unitID", "Type", "PCB"]
+
+
+def encodeReadingsReference(decoded):
+    classicData = {}
+    classicData["currentTime"] = decodeCTIMEReference( decoded["CTIME0"],decoded["CTIME1"], decoded["CTIME2"] )
+    classicData["BatTemperature"] = decoded["BatTemperature"]
+    classicData["NetAmpHours"] = decoded["WbJrAmpHourNET"]
+    classicData["ChargeState"] = decoded["ChargeStage"]
+    classicData["ChargeStateIcon"] = decoded["ChargeStateIcon"]
+    classicData["ChargeStateText"] = decoded["ChargeStateText"]
+    classicData["Aux1FunctionText"] = decoded["Aux1FunctionText"]
+    classicData["Aux2FunctionText"] = decoded["Aux2FunctionText"]
+    classicData["MPPTModeText"] = decoded["MPPTModeText"]
+    classicData["InfoFlagsBits"] = decoded["InfoFlagsBits"]
+    classicData["ReasonForResting"] = decoded["ReasonForResting"]
+    classicData["ReasonForRestingText"] = decoded["ReasonForRestingText"]
+    classicData["NegativeAmpHours"] = decoded["WbJrAmpHourNEGative"]
+    classicData["BatVoltage"] = decoded["BatVoltage"]
+    classicData["PVVoltage"] = decoded["PVVoltage"]
+    classicData["VbattRegSetPTmpComp"] = decoded["VbattRegSetPTmpComp"]
+    classicData["TotalAmpHours"] = decoded["TotalAmpHours"]
+    classicData["WhizbangBatCurrent"] = decoded["WhizbangBatCurrent"]
+    classicData["BatCurrent"] = decoded["BatCurrent"]
+    classicData["PVCurrent"] = decoded["PVCurrent"]
+    classicData["ConnectionState"] = 0
+    classicData["EnergyToday"] = decoded["EnergyToday"]
+    classicData["EqualizeTime"] = decoded["EqualizeTime"]
+    classicData["SOC"] = decoded["SOC"]
+    classicData["SOCicon"] = decoded["SOCicon"]
+    classicData["Aux1"] = ((decoded["InfoFlagsBits"] & 0x00004000) != 0)
+    classicData["Aux2"] = ((decoded["InfoFlagsBits"] & 0x00008000) != 0)
+    classicData["Power"] = decoded["Power"]
+    classicData["FETTemperature"] = decoded["FETTemperature"]
+    classicData["PositiveAmpHours"] = decoded["WbJrAmpHourPOSitive"]
+    classicData["TotalEnergy"] = decoded["TotalEnergy"]
+    classicData["FloatTimeTodaySeconds"] = decoded["FloatTimeTodaySeconds"]
+    classicData["RemainingAmpHours"] = decoded["RemainingAmpHours"]
+    classicData["AbsorbTime"] = decoded["AbsorbTime"]
+    classicData["ShuntTemperature"] = decoded["ShuntTemperature"]
+    classicData["PCBTemperature"] = decoded["PCBTemperature"]
+    return json.dumps(classicData, sort_keys=False, separators=(',', ':'))
+
+
+def encodeInfoReference(decoded):
+    classicData = {}
+    classicData["appVersion"] = decoded["app_rev"]
+    uint_array = [decoded["Name1"],decoded["Name0"],decoded["Name3"],decoded["Name2"],decoded["Name5"],decoded["Name4"],decoded["Name7"],decoded["Name6"]]
+    classicData["deviceName"] = "".join(chr(x) for x in uint_array).strip(chr(0))
+    bdate = datetime.date(decoded["Year"],decoded["Month"],decoded["Day"])
+    classicData["buildDate"] = bdate.strftime("%A, %B %d, %Y").replace(' 0', ' ')
+    classicData["deviceType"] = "Classic"
+    classicData["endingAmps"] = decoded["endingAmps"]
+    classicData["hasWhizbang"] = (decoded["Aux2Function"] & 0x3f) == 18
+    classicData["lastVOC"] = decoded["lastVOC"]
+    classicData["model"] = "Classic {}V (rev {})".format(decoded["Type"],decoded["PCB"])
+    classicData["mpptMode"] = decoded["MPPTMode"]
+    classicData["netVersion"] = decoded["net_rev"]
+    classicData["nominalBatteryVoltage"] = decoded["nominalBatteryVoltage"]
+    classicData["unitID"] = decoded["unitID"]
+    mac = "{:02x}:{:02x}:{:02x}:{:02x}:{:02x}:{:02x}".format(decoded["mac_5"],decoded["mac_4"],decoded["mac_3"],decoded["mac_2"],decoded["mac_1"],decoded["mac_0"])
+    classicData["macAddress"] = mac.upper()
+    classicData["IP"] = decoded["IP"]
+    return json.dumps(classicData, sort_keys=False, separators=(',', ':'))
+
+
+def decodeCTIMEReference( CTIME0, CTIME1, CTIME2):
+    tsecs = (CTIME0 & 0x0000003F)
+    tmins = (CTIME0 & 0x00003F00) >> 8
+    thour = (CTIME0 & 0x001F0000) >> 16
+    tdyom = (CTIME1 & 0x0000001F)
+    tmnth = (CTIME1 & 0x00000F00) >> 8
+    tyear = (CTIME1 & 0x0FFF0000) >> 16
+    return "{:04n}-{:02n}-{:02n} {:02n}:{:02n}:{:02n}".format(tyear,tmnth,tdyom,thour,tmins,tsecs)
+
+
+def randomDecoded(rnd):
+    blocks = {addr: [rnd.randint(0, 65535) for _ in range(cnt)] for addr, cnt in REGISTER_BLOCKS}
+    decoded = dict(decodeModbusData(blocks, "test"))
+    # a build date that exists
+    decoded["Year"], decoded["Month"], decoded["Day"] = rnd.randint(2010, 2030), rnd.randint(1, 12), rnd.randint(1, 28)
+    return decoded
+
+
+class JsonEncoderTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        logging.disable(logging.CRITICAL)
+
+    @classmethod
+    def tearDownClass(cls):
+        logging.disable(logging.NOTSET)
+
+    def assertSameAsReference(self, decoded, seed):
+        self.assertEqual(encodeClassicData_readings(decoded), encodeReadingsReference(decoded), "readings of seed {}".format(seed))
+        self.assertEqual(encodeClassicData_info(decoded), encodeInfoReference(decoded), "info of seed {}".format(seed))
+
+    def test_random_registers(self):
+        rnd = random.Random(1)
+        for seed in range(RANDOM_SETS):
+            self.assertSameAsReference(randomDecoded(rnd), seed)
+
+    def test_edge_values(self):
+        rnd = random.Random(2)
+        for seed in range(RANDOM_SETS):
+            decoded = randomDecoded(rnd)
+            for name in rnd.sample(READINGS_TEXTS, 2) + rnd.sample(INFO_TEXTS, 1):
+                decoded[name] = rnd.choice(EDGE_TEXTS + EDGE_OTHERS)
+            for name in rnd.sample(READINGS_NUMBERS, 3) + rnd.sample(INFO_NUMBERS, 2):
+                decoded[name] = rnd.choice(EDGE_NUMBERS + EDGE_OTHERS)
+            self.assertSameAsReference(decoded, seed)
+
+    def test_every_edge_text(self):
+        decoded = randomDecoded(random.Random(3))
+        for text in EDGE_TEXTS:
+            for name in READINGS_TEXTS + INFO_TEXTS:
+                edge = dict(decoded)
+                edge[name] = text
+                self.assertSameAsReference(edge, "{} = {!r}".format(name, text))
+
+    # Splicing a new time into the readings gives the readings encoded anew
+    def test_readings_time(self):
+        rnd = random.Random(4)
+        for seed in range(RANDOM_SETS):
+            decoded = randomDecoded(rnd)
+            readings = encodeClassicData_readings(decoded)
+            decoded["CTIME0"], decoded["CTIME1"] = rnd.randint(0, 2**31), rnd.randint(0, 2**31)
+            self.assertEqual(updateClassicData_readingsTime(readings, decoded), encodeReadingsReference(decoded), "seed {}".format(seed))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+# --------------------------------------------------------------------------- #
+# MqttPublisher with a fake paho client
+#
+#    python3 -m pytest tests
+# --------------------------------------------------------------------------- #
+
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from paho.mqtt import client as mqttclient
+
+from support import classic_publisher
+from support.classic_publisher import MqttPublisher
+
+
+class FakeInfo:
+
+    def __init__(self, mid):
+        self.rc = mqttclient.MQTT_ERR_SUCCESS
+        self.mid = mid
+
+    def is_published(self):
+        return True
+
+
+class FakeClient:
+
+    def __init__(self):
+        self.on_publish = None
+        self.published = []
+
+    def publish(self, topic, payload, qos=0, retain=False, properties=None):
+        self.published.append(topic)
+        return FakeInfo(len(self.published))
+
+
+class PublisherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.timeout = classic_publisher.AFTER_TIMEOUT_SECS
+        classic_publisher.AFTER_TIMEOUT_SECS = 0.2
+
+    def tearDown(self):
+        classic_publisher.AFTER_TIMEOUT_SECS = self.timeout
+
+    def run_publisher(self, test):
+        async def run():
+            client = FakeClient()
+            publisher = MqttPublisher(client, 10)
+            publisher.setConnected(True)
+            publisher.start()
+            try:
+                await test(client, publisher)
+            finally:
+                await publisher.stop(0)
+        asyncio.run(run())
+
+    def test_publishes_in_order(self):
+        async def test(client, publisher):
+            futures = [publisher.submit("topic/{}".format(n), "payload") for n in range(3)]
+            self.assertEqual(await asyncio.wait_for(asyncio.gather(*futures), 1), [True, True, True])
+            self.assertEqual(client.published, ["topic/0", "topic/1", "topic/2"])
+        self.run_publisher(test)
+
+    def test_waits_for_after(self):
+        async def test(client, publisher):
+            after = asyncio.get_running_loop().create_future()
+            state = publisher.submit("state", "payload", after=after)
+            await asyncio.sleep(0.05)
+            self.assertEqual(client.published, [])
+            after.set_result(True)
+            self.assertTrue(await asyncio.wait_for(state, 1))
+            self.assertEqual(client.published, ["state"])
+        self.run_publisher(test)
+
+    # A lost acknowledgement holds up its message for AFTER_TIMEOUT_SECS, not
+    # the queue for ever
+    def test_after_timeout_publishes(self):
+        async def test(client, publisher):
+            never = asyncio.get_running_loop().create_future()
+            state = publisher.submit("state", "payload", after=never)
+            other = publisher.submit("other", "payload")
+            self.assertEqual(await asyncio.wait_for(asyncio.gather(state, other), 2), [True, True])
+            self.assertEqual(client.published, ["state", "other"])
+        self.run_publisher(test)
+
+    def test_full_queue_drops_oldest(self):
+        async def test(client, publisher):
+            publisher.setConnected(False)
+            futures = [publisher.submit("topic/{}".format(n), "payload") for n in range(12)]
+            self.assertEqual(publisher.dropped, 2)
+            publisher.setConnected(True)
+            self.assertEqual(await asyncio.wait_for(asyncio.gather(*futures), 1), [False, False] + [True] * 10)
+            self.assertEqual(client.published, ["topic/{}".format(n) for n in range(2, 12)])
+        self.run_publisher(test)
+
+
+if __name__ == "__main__":
+    unittest.main()